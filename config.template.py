@@ -3,4 +3,15 @@ API_KEY = "<API_KEY>" # The API key for certain endpoints of the API
 ENVIRONMENT = "<development or production>" # The environment of the API server
 AUTH_SERVER_PREFIX = "<BASE URL OF AUTH SERVER>" # The base URL of the API server
 TESTING = "<True or False>" # If the API server is running in testing mode
-
+BOT_NOTIFY_URL = "<BASE URL OF THE BOT INTERNAL SERVER>" # The bot is notified here when a guild finishes signing in, leave empty to rely on polling. List the comma separated urls of every process when the bot runs sharded
+DATABASE_POOL_SIZE = 5 # The number of database connections each API worker keeps open
+DATABASE_MAX_OVERFLOW = 10 # The number of extra database connections each API worker may open under load
+DATABASE_ECHO = False # Log every SQL statement, only for debugging
+QUERY_PROFILING = False # Record per statement latency histograms, served at /stats/queries
+QUERY_SAMPLE_RATE = 1.0 # The fraction of statements timed when query profiling is on
+SLOW_QUERY_THRESHOLD = 0.5 # Statements slower than this many seconds are logged when query profiling is on
+SQLITE_JOURNAL_MODE = "WAL" # SQLite journal mode, WAL lets readers run while the bot or another worker writes
+SQLITE_BUSY_TIMEOUT = 5000 # Milliseconds a SQLite write waits for a lock before failing
+CLIENT_SECRETS_FILE = "creds.json" # The google oauth client secrets file, parsed once per worker and reloaded when it changes
+METRICS_PATH = "/metrics" # Prometheus metrics are served here with the API key, as is or as a bearer token. Leave empty to turn them off
+METRICS_DIR = "" # A directory the gunicorn workers share their metrics through so every scrape covers all of them, clear it when the API starts
@@ -0,0 +1,155 @@
+"""Load tests the oauth sign in under gunicorn with sync workers and with gthread workers, against a fake
+google token endpoint that takes --latency seconds to answer, and reports sustained callbacks/sec.
+
+usage: python benchmarks/callbacks.py [--seconds 10] [--clients 32] [--latency 0.2] [--workers 4] [--threads 8]
+"""
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_token_server(latency: float) -> ThreadingHTTPServer:
+    class TokenHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(latency)
+            body = json.dumps({'access_token': 'token', 'refresh_token': 'refresh', 'token_type': 'Bearer',
+                               'expires_in': 3599}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', free_port()), TokenHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def prepare(directory: str, token_port: int, guilds: int) -> str:
+    """writes the client secrets, the app config and a guilds database with pending sign ins
+
+    Returns:
+        str: the gunicorn app spec
+    """
+    instance = os.path.join(directory, 'instance')
+    os.mkdir(instance)
+    with open(os.path.join(directory, 'creds.json'), 'w') as f:
+        json.dump({'web': {
+            'client_id': 'benchmark',
+            'client_secret': 'secret',
+            'auth_uri': 'https://accounts.google.com/o/oauth2/auth',
+            'token_uri': f'http://127.0.0.1:{token_port}/token',
+        }}, f)
+    config = os.path.join(directory, 'config.py')
+    with open(config, 'w') as f:
+        f.write(f"SECRET_KEY = 'benchmark'\nAPI_KEY = 'key'\nCLIENT_SECRETS_FILE = {os.path.join(directory, 'creds.json')!r}\n")
+    con = sqlite3.connect(os.path.join(instance, 'guilds.db'))
+    con.execute('CREATE TABLE guild (guild_id TEXT PRIMARY KEY, credential TEXT, state TEXT)')
+    con.executemany('INSERT INTO guild VALUES (?, NULL, ?)', [(str(i), 'state') for i in range(guilds)])
+    con.commit()
+    con.close()
+    return f'api:create_app(config_name={config!r}, instance_path={instance!r})'
+
+def sign_in(base_url: str, guild_id: int) -> bool:
+    with requests.Session() as session:
+        res = session.get(f'{base_url}/authorize/{guild_id}/state', allow_redirects=False)
+        state = parse_qs(urlparse(res.headers['Location']).query)['state'][0]
+        res = session.get(f'{base_url}/oauth2callback', params={'state': state, 'code': 'code'}, allow_redirects=False)
+        return res.status_code == 302
+
+def run(worker_class: str, args) -> dict:
+    token_server = start_token_server(args.latency)
+    with tempfile.TemporaryDirectory() as directory:
+        guilds = args.clients * 1000
+        app = prepare(directory, token_server.server_port, guilds)
+        port = free_port()
+        # gunicorn runs in the temporary directory, so relative import paths are resolved here
+        paths = [os.path.join(API_DIR, 'src')] + [os.path.abspath(path) for path in os.environ.get('PYTHONPATH', '').split(os.pathsep) if path]
+        threads = args.threads if worker_class == 'gthread' else 1
+        # gunicorn silently switches sync workers to gthread when threads is above 1
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(paths),
+                   GUNICORN_BIND=f'127.0.0.1:{port}', GUNICORN_WORKER_CLASS=worker_class,
+                   GUNICORN_WORKERS=str(args.workers), GUNICORN_THREADS=str(threads))
+        server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(API_DIR, 'gunicorn.conf.py'), app],
+                                  cwd=directory, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        base_url = f'http://127.0.0.1:{port}'
+        try:
+            while True:
+                if server.poll() is not None:
+                    raise RuntimeError(f'gunicorn exited with code {server.returncode}')
+                try:
+                    requests.get(base_url, timeout=1)
+                    break
+                except requests.ConnectionError:
+                    time.sleep(0.1)
+
+            deadline = time.time() + args.seconds
+            def client(index: int) -> tuple[int, int]:
+                done = failed = 0
+                guild_id = index
+                while time.time() < deadline:
+                    try:
+                        if sign_in(base_url, guild_id):
+                            done += 1
+                        else:
+                            failed += 1
+                    except requests.RequestException:
+                        failed += 1
+                    guild_id += args.clients
+                return done, failed
+
+            start = time.time()
+            with ThreadPoolExecutor(args.clients) as pool:
+                results = list(pool.map(client, range(args.clients)))
+            elapsed = time.time() - start
+        finally:
+            server.terminate()
+            server.wait()
+            token_server.shutdown()
+    done = sum(result[0] for result in results)
+    return {
+        'worker_class': worker_class,
+        'workers': args.workers,
+        'threads': threads,
+        'clients': args.clients,
+        'token_latency': args.latency,
+        'callbacks': done,
+        'failed': sum(result[1] for result in results),
+        'callbacks_per_second': round(done / elapsed, 1),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+    os.environ.setdefault('OAUTHLIB_INSECURE_TRANSPORT', '1')
+    for worker_class in ('sync', 'gthread'):
+        print(json.dumps(run(worker_class, args)))
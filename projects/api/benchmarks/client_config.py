@@ -0,0 +1,59 @@
+"""Measures how long building the oauth Flow of a redirect endpoint takes when creds.json is parsed on
+every request compared to building it from the cached client config.
+
+usage: python benchmarks/client_config.py [--iterations 2000]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import google_auth_oauthlib.flow
+
+from api import ClientConfig, SCOPES
+
+CLIENT_SECRETS = {
+    'web': {
+        'client_id': 'benchmark.apps.googleusercontent.com',
+        'project_id': 'benchmark',
+        'auth_uri': 'https://accounts.google.com/o/oauth2/auth',
+        'token_uri': 'https://oauth2.googleapis.com/token',
+        'auth_provider_x509_cert_url': 'https://www.googleapis.com/oauth2/v1/certs',
+        'client_secret': 'secret',
+        'redirect_uris': ['http://localhost:5000/oauth2callback'],
+    }
+}
+
+
+def time_per_flow(build, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        build()
+    return (time.perf_counter() - start) / iterations
+
+def run(iterations: int) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'creds.json')
+        with open(path, 'w') as f:
+            json.dump(CLIENT_SECRETS, f)
+        client_config = ClientConfig(path)
+
+        from_file = time_per_flow(
+            lambda: google_auth_oauthlib.flow.Flow.from_client_secrets_file(path, scopes=SCOPES), iterations)
+        cached = time_per_flow(
+            lambda: google_auth_oauthlib.flow.Flow.from_client_config(client_config.get(), scopes=SCOPES), iterations)
+    return {
+        'iterations': iterations,
+        'from_file_us': round(from_file * 1e6, 2),
+        'cached_us': round(cached * 1e6, 2),
+        'file_loads': client_config.loads,
+        'speedup': round(from_file / cached, 2),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+    print(json.dumps(run(args.iterations)))
@@ -0,0 +1,24 @@
+# gunicorn settings for the api, every setting can be overridden with a GUNICORN_ environment variable.
+# gthread workers keep serving other requests while a thread waits on the google token exchange,
+# set GUNICORN_WORKER_CLASS=gevent (with the gevent extra installed) for many more concurrent callbacks
+import os
+
+bind = os.getenv('GUNICORN_BIND', '127.0.0.1:8000')
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.getenv('GUNICORN_WORKERS', 4))
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 0))
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+
+def post_fork(server, worker):
+    # with preload_app the app is created in the master, drop any pooled connections the worker
+    # inherited so every worker opens its own
+    if server.cfg.preload_app:
+        from db import dispose_engines
+        dispose_engines(server.app.wsgi())
@@ -4,9 +4,13 @@ import requests
 import google.oauth2.credentials
 import google_auth_oauthlib.flow
 import json
+import hmac
 from sqlalchemy import text
 import os
+import threading
+import time
 from werkzeug.middleware.proxy_fix import ProxyFix
+from push_channels import channel_token
 
 CLIENT_SECRETS_FILE = 'creds.json'
 SCOPES = [
@@ -16,6 +20,61 @@ SCOPES = [
 ]
 API_SERVICE_NAME = "calendar"
 API_VERSION = 'v3'
+BOT_NOTIFY_TIMEOUT = 2
+CLIENT_SECRETS_CHECK_INTERVAL = 5
+METRICS_PATH = '/metrics'
+METRICS_WRITE_INTERVAL = 1
+
+
+def bot_url_for(notify_url: str, guild_id: str) -> str:
+    """picks the internal server of the bot process that serves a guild, BOT_NOTIFY_URL lists one url per
+    shard process in process order and a guild belongs to the process its shard id for that many shards names
+
+    Args:
+        notify_url (str): the comma separated base urls of the bot processes
+        guild_id (str): the id of the guild
+
+    Returns:
+        str: the base url of the process
+    """
+    urls = [url.strip() for url in notify_url.split(',') if url.strip()]
+    return urls[(int(guild_id) >> 22) % len(urls)] if len(urls) > 1 else urls[0]
+
+
+class ClientConfig:
+
+    def __init__(self, path: str, check_interval: float = CLIENT_SECRETS_CHECK_INTERVAL):
+        """ caches the parsed oauth client secrets file of a worker, the file is read again only when its
+        mtime changes and the mtime is checked at most every check_interval seconds
+
+        Args:
+            path (str): the path of the client secrets file
+            check_interval (float): seconds between mtime checks
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self.config = None
+        self.mtime = None
+        self.checked = 0.0
+        self.loads = 0
+        self.lock = threading.Lock()
+
+    def get(self) -> dict:
+        """Returns:
+            dict: the parsed client secrets, in the format Flow.from_client_config expects
+        """
+        now = time.monotonic()
+        if self.config is not None and now - self.checked < self.check_interval:
+            return self.config
+        with self.lock:
+            mtime = os.stat(self.path).st_mtime_ns
+            if self.config is None or mtime != self.mtime:
+                with open(self.path, 'r') as f:
+                    self.config = json.load(f)
+                self.mtime = mtime
+                self.loads += 1
+            self.checked = now
+        return self.config
 
 
 def create_app(config_name='config.py', testing=False, instance_path: str | None = None, environment='development'):
@@ -49,23 +108,92 @@ def create_app(config_name='config.py', testing=False, instance_path: str | None
             print('database file is missing!')
             quit()
 
-    from db import init_app, db
+    from db import init_app, db, pool_stats, get_query_profiler
+    from metrics import Registry, ProcessSnapshots, CONTENT_TYPE
     init_app(app)
 
+    client_config = ClientConfig(app.config.get('CLIENT_SECRETS_FILE', CLIENT_SECRETS_FILE))
+    app.extensions['client_config'] = client_config
+
+    registry = Registry()
+    app.extensions['metrics'] = registry
+    request_latency = registry.histogram('api_request_seconds', 'time spent serving a request',
+                                         labels=('route', 'method', 'status'))
+    token_exchange_latency = registry.histogram('api_oauth_token_exchange_seconds',
+                                                'time the google oauth token exchange takes', labels=('result',))
+    app.extensions['db_statement_latency'] = registry.histogram(
+        'api_db_statement_seconds', 'time a database statement takes', labels=('statement',))
+    registry.counter('api_db_pool_wait_seconds_total', 'time requests waited for a pooled database connection',
+                     collect=lambda: sum(stats['wait_time_total'] for stats in pool_stats(app).values()))
+    # gunicorn workers each count their own requests, they share them through METRICS_DIR
+    snapshots = None
+    if app.config.get('METRICS_DIR'):
+        snapshots = ProcessSnapshots(registry, app.config['METRICS_DIR'], METRICS_WRITE_INTERVAL)
+
     def validate_auth_header(request: flask.Request):
         auth_header = request.headers.get('Authorization')
-        if auth_header == app.config.get('API_KEY'):
+        api_key = app.config.get('API_KEY')
+        if auth_header == api_key or (api_key is not None and auth_header == f'Bearer {api_key}'):
             return True
         return False
 
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response: flask.Response):
+        start = g.pop('request_start', None)
+        if start is not None:
+            rule = flask.request.url_rule
+            request_latency.observe(time.perf_counter() - start, rule.rule if rule is not None else 'unmatched',
+                                    flask.request.method, response.status_code)
+        if snapshots is not None:
+            response.call_on_close(snapshots.maybe_write)
+        return response
+
+    def notify_bot(guild_id: str):
+        """tells the bot that the credentials of a guild were stored so it can link the guild right away,
+        the bot falls back to polling if the notification fails
+
+        Args:
+            guild_id (str): the id of the guild that finished signing in
+
+        Returns:
+            bool: True if the bot accepted the notification
+        """
+        return post_to_bot(f'linked/{guild_id}', guild_id)
+
+    def post_to_bot(path: str, guild_id: str):
+        """sends a notification to the internal server of the bot process that serves a guild
+
+        Args:
+            path (str): the path of the notification relative to BOT_NOTIFY_URL
+            guild_id (str): the id of the guild the notification is about
+
+        Returns:
+            bool: True if the bot accepted the notification
+        """
+        notify_url = app.config.get('BOT_NOTIFY_URL')
+        if not notify_url:
+            return False
+        try:
+            res = requests.post(f'{bot_url_for(notify_url, guild_id)}{path}',
+                                headers={'Authorization': app.config.get('API_KEY')},
+                                timeout=BOT_NOTIFY_TIMEOUT)
+            return getattr(res, 'status_code') in (200, 202)
+        except requests.RequestException as err:
+            print(f'failed to notify bot: {err}')
+            return False
+
     @app.route("/")
     def index():
         return '<h1>return to discord!</h1>'
     
     @app.route('/authorize/<guild_id>/<app_state>')
     def authorize(guild_id, app_state):
-        flow = google_auth_oauthlib.flow.Flow.from_client_secrets_file(
-            CLIENT_SECRETS_FILE, scopes=SCOPES)
+        flow = google_auth_oauthlib.flow.Flow.from_client_config(
+            client_config.get(), scopes=SCOPES)
         flow.redirect_uri = flask.url_for('oauth2callback', _external=True)
         auth_url, state = flow.authorization_url(access_type='offline',
                                                  prompt='consent')
@@ -94,14 +222,20 @@ def create_app(config_name='config.py', testing=False, instance_path: str | None
             flask.abort(400)
 
         try:
-            flow = google_auth_oauthlib.flow.Flow.from_client_secrets_file(
-                CLIENT_SECRETS_FILE,
+            flow = google_auth_oauthlib.flow.Flow.from_client_config(
+                client_config.get(),
                 scopes=None,
                 state=state,
                 redirect_uri=flask.url_for('oauth2callback', _external=True))
 
             auth_resp = flask.request.url
-            flow.fetch_token(authorization_response=auth_resp)
+            start = time.perf_counter()
+            result = 'error'
+            try:
+                flow.fetch_token(authorization_response=auth_resp)
+                result = 'ok'
+            finally:
+                token_exchange_latency.observe(time.perf_counter() - start, result)
 
             credentials = flow.credentials
             con.execute(
@@ -111,6 +245,8 @@ def create_app(config_name='config.py', testing=False, instance_path: str | None
                     'id': guild_id,
                     'new_cred': json.dumps(credentials_to_dict(credentials)),
                 })
+            con.commit()
+            notify_bot(guild_id)
             return flask.redirect(flask.url_for('index'))
         finally:
             con.commit()
@@ -167,6 +303,44 @@ def create_app(config_name='config.py', testing=False, instance_path: str | None
 
 
 
+    @app.route('/notifications', methods=['POST'])
+    def calendar_notification():
+        """receives the google calendar push notifications of a guild's channel and wakes the bot
+        to pull the changed events
+        """
+        token = flask.request.headers.get('X-Goog-Channel-Token', '')
+        guild_id = token.split('.')[0]
+        if not guild_id or not hmac.compare_digest(token, channel_token(guild_id, app.config.get('API_KEY'))):
+            flask.abort(403)
+        # the first message of a channel only confirms it was opened
+        if flask.request.headers.get('X-Goog-Resource-State') != 'sync':
+            post_to_bot(f'changes/{guild_id}', guild_id)
+        return ('', 200)
+
+    @app.route('/stats/pool')
+    def stats_pool():
+        if not validate_auth_header(flask.request):
+            flask.abort(403)
+        return flask.jsonify(pool_stats())
+
+    @app.route('/stats/queries')
+    def stats_queries():
+        if not validate_auth_header(flask.request):
+            flask.abort(403)
+        profiler = get_query_profiler()
+        if profiler is None:
+            flask.abort(400)
+        return flask.jsonify(profiler.profile())
+
+    metrics_path = app.config.get('METRICS_PATH', METRICS_PATH)
+    if metrics_path:
+        @app.route(metrics_path)
+        def metrics():
+            if not validate_auth_header(flask.request):
+                flask.abort(403)
+            others = snapshots.others() if snapshots is not None else []
+            return flask.Response(registry.render(others), content_type=CONTENT_TYPE)
+
     @app.errorhandler(400)
     def bad_request(e):
         return 'bad request', 400
@@ -188,7 +362,8 @@ def credentials_to_dict(credentials):
         'token_uri': credentials.token_uri,
         'client_id': credentials.client_id,
         'client_secret': credentials.client_secret,
-        'scopes': credentials.scopes
+        'scopes': credentials.scopes,
+        'expiry': credentials.expiry.isoformat() + 'Z' if credentials.expiry is not None else None
     }
 #    if not app.config.get('TESTING'):
 #    ask_to_drop_table = input(
@@ -1,6 +1,10 @@
 from flask import session
 from sqlalchemy import Connection, text
 import json
+import os
+import requests
+import db as database
+import api
 
 def wipe_guild_table(con: Connection):
     con.execute(text("DELETE FROM guild"))
@@ -102,4 +106,166 @@ class TestApi:
     
     def test_revoke_credentials_invalid_api_key(self, client):
         response = client.get('/revoke/123', headers={'Authorization': 'invalid'})
-        assert response.status_code == 403
\ No newline at end of file
+        assert response.status_code == 403
+    def test_auth_flow_notifies_bot(self, app, client, db, mock_google_client, mock_post):
+        app.config.update({'BOT_NOTIFY_URL': 'http://bot:8765/'})
+        db.execute(text("INSERT INTO guild VALUES('123', NULL, 'xyz')"))
+        db.commit()
+        mock_google_client.authorization_url.return_value = (
+            'http://localhost:5000/oauth2callback', 'abc')
+        mock_post.status_code = 200
+        client.get('/authorize/123/xyz', follow_redirects=True)
+        requests.post.assert_called_once_with('http://bot:8765/linked/123',
+                                              headers={'Authorization': 'key'},
+                                              timeout=2)
+        wipe_guild_table(db)
+
+    def test_calendar_notification_forwarded(self, app, client, mock_post):
+        app.config.update({'BOT_NOTIFY_URL': 'http://bot:8765/'})
+        mock_post.status_code = 202
+        headers = {'X-Goog-Channel-Token': api.channel_token('123', 'key'), 'X-Goog-Resource-State': 'exists'}
+        response = client.post('/notifications', headers=headers)
+        assert response.status_code == 200
+        requests.post.assert_called_once_with('http://bot:8765/changes/123',
+                                              headers={'Authorization': 'key'},
+                                              timeout=2)
+
+    def test_calendar_notification_routed_to_shard_process(self, app, client, mock_post):
+        app.config.update({'BOT_NOTIFY_URL': 'http://bot-0:8765/, http://bot-1:8766/'})
+        mock_post.status_code = 202
+        guild_id = str(3 << 22)
+        headers = {'X-Goog-Channel-Token': api.channel_token(guild_id, 'key'), 'X-Goog-Resource-State': 'exists'}
+        assert client.post('/notifications', headers=headers).status_code == 200
+        requests.post.assert_called_once_with(f'http://bot-1:8766/changes/{guild_id}',
+                                              headers={'Authorization': 'key'},
+                                              timeout=2)
+        assert api.bot_url_for('http://bot-0:8765/,http://bot-1:8766/', str(4 << 22)) == 'http://bot-0:8765/'
+
+    def test_calendar_sync_notification_not_forwarded(self, app, client, mock_post):
+        app.config.update({'BOT_NOTIFY_URL': 'http://bot:8765/'})
+        headers = {'X-Goog-Channel-Token': api.channel_token('123', 'key'), 'X-Goog-Resource-State': 'sync'}
+        assert client.post('/notifications', headers=headers).status_code == 200
+        requests.post.assert_not_called()
+
+    def test_calendar_notification_rejects_bad_token(self, app, client, mock_post):
+        app.config.update({'BOT_NOTIFY_URL': 'http://bot:8765/'})
+        for token in (api.channel_token('123', 'wrong key'), '123', ''):
+            response = client.post('/notifications', headers={'X-Goog-Channel-Token': token,
+                                                                'X-Goog-Resource-State': 'exists'})
+            assert response.status_code == 403
+        requests.post.assert_not_called()
+
+    def test_auth_flow_without_bot_url(self, client, db, mock_google_client, mock_post):
+        db.execute(text("INSERT INTO guild VALUES('123', NULL, 'xyz')"))
+        db.commit()
+        mock_google_client.authorization_url.return_value = (
+            'http://localhost:5000/oauth2callback', 'abc')
+        response = client.get('/authorize/123/xyz', follow_redirects=True)
+        assert response.status_code == 200
+        requests.post.assert_not_called()
+        wipe_guild_table(db)
+
+    def test_engine_shared_between_requests(self, app, context, db):
+        with app.app_context():
+            engine = database.get_engine()
+        assert database.get_engine() is engine
+
+    def test_connection_returned_on_teardown(self, app, tmp_path):
+        uri = f'sqlite:///{tmp_path}/guilds.db'
+        with app.app_context():
+            database.db(uri)
+            assert database.pool_stats()[uri]['checked_out'] == 1
+        with app.app_context():
+            stats = database.pool_stats()[uri]
+            assert stats['checked_out'] == 0
+            assert stats['pool'] == 'QueuePool'
+            assert stats['size'] == 5
+
+    def test_pool_stats_requires_api_key(self, client):
+        assert client.get('/stats/pool').status_code == 403
+        response = client.get('/stats/pool', headers={'Authorization': 'key'})
+        assert response.status_code == 200
+        assert response.json['sqlite:///:memory:']['checkouts'] >= 1
+
+    def test_query_stats(self, app, client):
+        assert client.get('/stats/queries', headers={'Authorization': 'key'}).status_code == 400
+
+    def test_query_stats_profiling_enabled(self, mocker):
+        mocker.patch('requests.post')
+        app = api.create_app(testing=True)
+        app.config.update({'API_KEY': 'key', 'QUERY_PROFILING': True})
+        with app.app_context():
+            database.init_db()
+            with app.test_client() as test_client:
+                test_client.get('/clear/123')
+                response = test_client.get('/stats/queries', headers={'Authorization': 'key'})
+        assert response.status_code == 200
+        statements = [stats['statement'] for stats in response.json['statements']]
+        assert 'SELECT credential FROM guild WHERE guild_id=?' in statements
+
+    def test_sqlite_pragmas_applied(self, app, tmp_path):
+        uri = f'sqlite:///{tmp_path}/guilds.db'
+        app.config.update({'SQLITE_BUSY_TIMEOUT': 1234})
+        with app.app_context():
+            con = database.db(uri)
+            assert con.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+            assert con.execute(text('PRAGMA synchronous')).scalar() == 1
+            assert con.execute(text('PRAGMA busy_timeout')).scalar() == 1234
+
+    def test_engines_disposed_after_fork(self, app, tmp_path):
+        uri = f'sqlite:///{tmp_path}/guilds.db'
+        with app.app_context():
+            database.db(uri)
+            database.close_db()
+            engine = database.get_engine(uri)
+            assert engine.pool.checkedin() == 1
+            database.dispose_engines(app)
+            assert engine.pool.checkedin() == 0
+            assert database.get_engine(uri) is engine
+
+    def test_client_config_reloaded_on_change(self, tmp_path):
+        path = tmp_path / 'creds.json'
+        path.write_text(json.dumps({'web': {'client_id': 'ghi'}}))
+        client_config = api.ClientConfig(str(path), check_interval=0)
+        assert client_config.get() == {'web': {'client_id': 'ghi'}}
+        assert client_config.get() is client_config.get()
+        assert client_config.loads == 1
+
+        path.write_text(json.dumps({'web': {'client_id': 'new'}}))
+        os.utime(path, ns=(client_config.mtime + 1000, client_config.mtime + 1000))
+        assert client_config.get() == {'web': {'client_id': 'new'}}
+        assert client_config.loads == 2
+
+    def test_client_config_mtime_checked_per_interval(self, tmp_path, mocker):
+        path = tmp_path / 'creds.json'
+        path.write_text(json.dumps({'web': {}}))
+        client_config = api.ClientConfig(str(path), check_interval=60)
+        client_config.get()
+        stat_spy = mocker.spy(api.os, 'stat')
+        for _ in range(10):
+            client_config.get()
+        assert stat_spy.call_count == 0
+
+    def test_metrics_collected_outside_app_context(self, app):
+        # ProcessSnapshots writes after the response closed, when the app context is gone
+        snapshot = app.extensions['metrics'].snapshot()
+        [[labels, wait_time]] = snapshot['api_db_pool_wait_seconds_total']
+        assert labels == [] and wait_time >= 0
+
+    def test_metrics(self, client, db, mock_google_client, mock_post):
+        db.execute(text("INSERT INTO guild VALUES('123', NULL, 'xyz')"))
+        db.commit()
+        mock_google_client.authorization_url.return_value = (
+            'http://localhost:5000/oauth2callback', 'abc')
+        client.get('/authorize/123/xyz', follow_redirects=True)
+        client.get('/revoke/123')
+        assert client.get('/metrics').status_code == 403
+        response = client.get('/metrics', headers={'Authorization': 'Bearer key'})
+        assert response.status_code == 200
+        assert response.content_type.startswith('text/plain; version=0.0.4')
+        page = response.text
+        assert 'api_request_seconds_count{route="/revoke/<guild_id>",method="GET",status="403"} 1' in page
+        assert 'api_request_seconds_count{route="/oauth2callback",method="GET",status="302"} 1' in page
+        assert 'api_oauth_token_exchange_seconds_count{result="ok"} 1' in page
+        assert 'api_db_statement_seconds_count{statement="select"}' in page
+        wipe_guild_table(db)
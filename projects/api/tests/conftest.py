@@ -11,8 +11,9 @@ from unittest.mock import Mock
 @pytest.fixture
 def mock_google_client(mocker):
     mock_google_client = MagicMock(spec=flow.Flow)
-    mocker.patch('google_auth_oauthlib.flow.Flow.from_client_secrets_file',
+    mocker.patch('google_auth_oauthlib.flow.Flow.from_client_config',
                  return_value=mock_google_client)
+    mocker.patch('api.ClientConfig.get', return_value={'web': {'client_id': 'ghi', 'client_secret': 'jkl'}})
     return mock_google_client
 
 """patches the google.oauth2.credentials module to return a mock credential"""
@@ -56,7 +57,7 @@ def app(mocker):
 @pytest.fixture()
 def db(context):
     with context:
-        yield g.con
+        yield database.db()
         database.close_db()
 
 """Initializes the database before each test."""
@@ -0,0 +1,259 @@
+"""Load tests the scheduled event handlers of the bot end to end. A fake gateway feeds seeded streams of
+create/update/delete/user_add/user_remove dispatches into start.py's handlers, which sync them through the
+outbox, sync queue and calendar executor to a fake google calendar with --latency and --error-rate.
+It reports the latency from a dispatch to the google calendar sync that applied it, events/sec and google
+calls per event as one json line, runs offline and gives the same streams for the same --seed so results
+of different commits can be compared.
+
+usage: PYTHONPATH=src:tests:../../shared/googleauth/src:../../shared/db/src:../../shared/metrics/src \
+       python benchmarks/handlers.py [--guilds 20] [--events 50] [--rate 500] [--latency 0.02]
+       [--error-rate 0] [--seed 1] [--output results.jsonl]
+"""
+from contextlib import redirect_stdout
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CREATE_EVENT = 'create'
+UPDATE_EVENT = 'update'
+DELETE_EVENT = 'delete'
+USER_ADD = 'user_add'
+USER_REMOVE = 'user_remove'
+
+
+def percentile(values: list[float], share: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+def event_streams(guilds: int, events: int, users: int, seed: int) -> list[tuple]:
+    """builds the dispatches of every scheduled event, a create, a random mix of updates and attendee changes
+    and a delete, and interleaves the events the way busy guilds would
+
+    Returns:
+        list[tuple]: (kind, guild index, event id, user id) in dispatch order
+    """
+    rng = random.Random(seed)
+    streams = []
+    for guild in range(guilds):
+        for n in range(events):
+            event_id = (guild + 1) * 1_000_000 + n
+            stream = [(CREATE_EVENT, guild, event_id, None)]
+            attending = set()
+            for _ in range(rng.randint(2, 10)):
+                roll = rng.random()
+                if roll < 0.3:
+                    stream.append((UPDATE_EVENT, guild, event_id, None))
+                elif roll < 0.8 or not attending:
+                    user_id = rng.randrange(users)
+                    if user_id not in attending:
+                        attending.add(user_id)
+                        stream.append((USER_ADD, guild, event_id, user_id))
+                else:
+                    user_id = rng.choice(sorted(attending))
+                    attending.discard(user_id)
+                    stream.append((USER_REMOVE, guild, event_id, user_id))
+            stream.append((DELETE_EVENT, guild, event_id, None))
+            streams.append(stream)
+
+    dispatches = []
+    positions = [0] * len(streams)
+    live = list(range(len(streams)))
+    while live:
+        index = rng.randrange(len(live))
+        stream = live[index]
+        dispatches.append(streams[stream][positions[stream]])
+        positions[stream] += 1
+        if positions[stream] == len(streams[stream]):
+            live[index] = live[-1]
+            live.pop()
+    return dispatches
+
+
+class LinkedGuilds:
+    """the part of GoogeAuthConnect the handlers use, with every guild linked and every user's email known"""
+
+    def __init__(self, guild_ids: list[str], users: int):
+        self.linked = {guild_id: {'token': 'token', 'refresh_token': 'refresh'} for guild_id in guild_ids}
+        self.emails = {str(user_id): f'user{user_id}@example.com' for user_id in range(users)}
+
+    async def get_linked_credentials(self, guild_id: str):
+        return self.linked.get(str(guild_id))
+
+    async def get_user_emails(self, guild_id: str):
+        return (self.emails, None)
+
+
+class CalendarServices:
+    """hands out services of the fake calendar in place of CalendarServiceCache, one per guild"""
+
+    def __init__(self, calendar, guild_ids: list[str]):
+        self.services = {guild_id: calendar.service() for guild_id in guild_ids}
+
+    def get_service(self, guild_id: str, credentials_dict: dict):
+        return self.services[str(guild_id)]
+
+
+class LatencyTracker:
+    """matches every dispatch with the sync that applied it, a sync applies the dispatches of its kind that
+    arrived before it started, coalesced updates and netted attendee changes included. a delete applies
+    everything left of its event
+    """
+    KINDS = {CREATE_EVENT: 'create', UPDATE_EVENT: 'update', DELETE_EVENT: 'delete', USER_ADD: 'attendee',
+             USER_REMOVE: 'attendee'}
+
+    def __init__(self):
+        self.open = {}
+        self.latencies = {}
+        self.first = None
+        self.last = None
+
+    def dispatched(self, kind: str, guild_id: str, event_id: str):
+        now = time.perf_counter()
+        self.first = now if self.first is None else self.first
+        self.open.setdefault((guild_id, event_id), []).append((kind, now))
+
+    def wrap(self, sync_kind: str, handler):
+        async def tracked(guild_id, event_id, payload):
+            started = time.perf_counter()
+            result = await handler(guild_id, event_id, payload)
+            if result[0] is not None:
+                self.applied(sync_kind, str(guild_id), str(event_id), started)
+            return result
+        return tracked
+
+    def applied(self, sync_kind: str, guild_id: str, event_id: str, started: float):
+        now = time.perf_counter()
+        remaining = []
+        for kind, dispatched_at in self.open.pop((guild_id, event_id), []):
+            if dispatched_at <= started and (sync_kind == 'delete' or self.KINDS[kind] == sync_kind):
+                self.latencies.setdefault(kind, []).append(now - dispatched_at)
+            else:
+                remaining.append((kind, dispatched_at))
+        if remaining:
+            self.open[(guild_id, event_id)] = remaining
+        self.last = now
+
+    @property
+    def pending(self) -> int:
+        return sum(len(dispatches) for dispatches in self.open.values())
+
+
+async def run(args) -> dict:
+    import start
+    from calendar_service import CalendarExecutor
+    from fake_calendar import FakeCalendar
+    from fake_gateway import FakeGateway
+    from rate_limiter import RateLimiter
+
+    calendar = FakeCalendar(latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+    await calendar.start()
+    gateway = FakeGateway(start.bot)
+    await gateway.start()
+
+    owner_id = 1 << 40
+    guilds = [gateway.add_guild((1000 + guild) << 22, owner_id) for guild in range(args.guilds)]
+    for user_id in range(args.users):
+        gateway.add_user(user_id)
+    guild_ids = [str(guild.id) for guild in guilds]
+    start.google_auth = LinkedGuilds(guild_ids, args.users)
+    start.calendar_services = CalendarServices(calendar, guild_ids)
+    start.calendar_executor.shutdown()
+    start.calendar_executor = CalendarExecutor(limiter=RateLimiter(
+        project_rate=args.project_rate, project_burst=args.project_rate, guild_rate=args.guild_rate,
+        guild_burst=args.guild_rate, backoff_base=args.backoff))
+    tracker = LatencyTracker()
+    start.outbox.handlers = {kind: tracker.wrap(kind, handler) for kind, handler in start.outbox.handlers.items()}
+
+    dispatches = event_streams(args.guilds, args.events, args.users, args.seed)
+    began = time.perf_counter()
+    for n, (kind, guild, event_id, user_id) in enumerate(dispatches):
+        if args.rate:
+            delay = began + n / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif n % 100 == 0:
+            await asyncio.sleep(0)
+        guild_id = guilds[guild].id
+        tracker.dispatched(kind, str(guild_id), str(event_id))
+        if kind == CREATE_EVENT:
+            gateway.create_event(guild_id, event_id, owner_id)
+        elif kind == UPDATE_EVENT:
+            gateway.update_event(guild_id, event_id, owner_id, name=f'event {event_id} v{n}')
+        elif kind == DELETE_EVENT:
+            gateway.delete_event(guild_id, event_id, owner_id)
+        elif kind == USER_ADD:
+            gateway.add_event_user(guild_id, event_id, user_id)
+        else:
+            gateway.remove_event_user(guild_id, event_id, user_id)
+
+    deadline = time.perf_counter() + args.timeout
+    while tracker.pending and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    await start.sync_queue.join()
+
+    latencies = [latency for values in tracker.latencies.values() for latency in values]
+    elapsed = (tracker.last or time.perf_counter()) - tracker.first
+    result = {
+        'events': len(dispatches),
+        'unfinished': tracker.pending,
+        'seconds': round(elapsed, 2),
+        'events_per_second': round(len(dispatches) / elapsed, 1),
+        'google_calls': len(calendar.requests),
+        'google_calls_per_event': round(len(calendar.requests) / len(dispatches), 3),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'by_kind': {kind: {'count': len(values), 'p50_ms': round(percentile(values, 0.5) * 1000, 1),
+                           'p99_ms': round(percentile(values, 0.99) * 1000, 1)}
+                    for kind, values in sorted(tracker.latencies.items())},
+        'outbox': start.outbox.stats(),
+        'calendar': start.calendar_executor.limiter.stats(),
+    }
+    start.calendar_executor.shutdown()
+    await calendar.stop()
+    return result
+
+def commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BOT_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=20)
+    parser.add_argument('--events', type=int, default=50, help='scheduled events per guild')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=500, help='dispatches per second, 0 sends them all at once')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the fake calendar takes to answer')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of google requests that fail with 503')
+    parser.add_argument('--project-rate', type=float, default=1000, help='google requests per second for the project')
+    parser.add_argument('--guild-rate', type=float, default=100, help='google requests per second for a guild')
+    parser.add_argument('--backoff', type=float, default=0.05, help='seconds before the first retry of a request')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for the syncs to finish')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='appends the result to this file as a json line')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    # the outbox, logs and state files of the bot go to a scratch directory
+    os.chdir(tempfile.mkdtemp())
+    os.environ['OUTBOX_DATABASE_URL'] = f'sqlite:///{os.path.join(os.getcwd(), "outbox.db")}'
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        result = asyncio.run(run(args))
+    result = {'commit': commit(), 'python': sys.version.split()[0], 'options': vars(args), **result}
+    print(json.dumps(result))
+    if output:
+        with open(output, 'a') as f:
+            f.write(json.dumps(result) + '\n')
@@ -0,0 +1,108 @@
+"""Measures calendar syncs/sec per number of shard processes. Every process runs the sync pipeline of the
+guilds it owns, the outbox on a shared database, the sync queue and the calendar executor, against its own
+fake google calendar that answers after --latency seconds.
+
+usage: PYTHONPATH=src:tests python benchmarks/shards.py [--processes 1 2 4] [--guilds 64] [--events 2000]
+                                                        [--latency 0.05]
+"""
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+from calendar_service import CalendarExecutor, event_body
+from fake_calendar import FakeCalendar
+from outbox import Outbox, OutboxStore
+from rate_limiter import RateLimiter
+from sharding import owner_process
+from sync_queue import CREATE, EventSyncQueue
+
+
+def guild_ids(guilds: int) -> list[str]:
+    """spreads the guilds over the shards the way discord snowflakes do, the shard of a guild comes from
+    the timestamp bits above bit 22
+    """
+    return [str((1000 + n) << 22) for n in range(guilds)]
+
+async def run_process(index: int, processes: int, database_url: str, guilds: list[str], events: int,
+                      latency: float, start_at: float) -> dict:
+    owned = [guild_id for guild_id in guilds if owner_process(guild_id, processes) == index]
+    calendar = FakeCalendar(latency=latency)
+    await calendar.start()
+    services = {guild_id: calendar.service() for guild_id in owned}
+    limiter = RateLimiter(project_rate=1e6, project_burst=1e6, guild_rate=1e6, guild_burst=1e6)
+    executor = CalendarExecutor(max_workers=32, limiter=limiter)
+
+    async def sync_created_event(guild_id: str, event_id: str, payload: dict):
+        request = services[guild_id].events().insert(calendarId='primary', body=payload['body'])
+        await executor.execute(request, guild_id=guild_id)
+        return (True, None)
+
+    queue = EventSyncQueue(on_drop=lambda operation: outbox.drop(operation))
+    outbox = Outbox(OutboxStore(database_url), queue, {CREATE: sync_created_event}, concurrency=32,
+                    owns=lambda guild_id: owner_process(guild_id, processes) == index)
+    start_time = datetime(2030, 1, 1, tzinfo=timezone.utc)
+    # the events are spread evenly over the guilds so every process gets its share of them
+    mine = [(owned[n % len(owned)], f'{index}{n}') for n in range(events * len(owned) // len(guilds))]
+
+    await asyncio.sleep(max(0, start_at - time.time()))
+    started = time.time()
+    for guild_id, event_id in mine:
+        event = SimpleNamespace(id=event_id, guild_id=guild_id, name=f'event {event_id}', location='here',
+                                description='', start_time=start_time, end_time=None)
+        await outbox.submit(guild_id, event_id, CREATE, {'body': event_body(event)})
+    await queue.join()
+    finished = time.time()
+
+    stats = outbox.stats()
+    executor.shutdown()
+    await calendar.stop()
+    return {'started': started, 'finished': finished, 'syncs': stats['completed'], 'failed': stats['failed'],
+            'google_requests': calendar.requests_to('POST')}
+
+def process_main(index: int, processes: int, database_url: str, guilds: list[str], events: int, latency: float,
+                 start_at: float, results):
+    results.put(asyncio.run(run_process(index, processes, database_url, guilds, events, latency, start_at)))
+
+def run(processes: int, guilds: int, events: int, latency: float) -> dict:
+    database_url = f'sqlite:///{os.path.join(tempfile.mkdtemp(), "guilds.db")}'
+    OutboxStore(database_url).engine.dispose()
+    ids = guild_ids(guilds)
+    results = multiprocessing.Queue()
+    # give every process time to import and build its services before the clock starts
+    start_at = time.time() + 2 + processes
+    workers = [multiprocessing.Process(target=process_main,
+                                       args=(index, processes, database_url, ids, events, latency, start_at, results))
+               for index in range(processes)]
+    for worker in workers:
+        worker.start()
+    outcomes = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    elapsed = max(outcome['finished'] for outcome in outcomes) - min(outcome['started'] for outcome in outcomes)
+    syncs = sum(outcome['syncs'] for outcome in outcomes)
+    return {
+        'processes': processes,
+        'syncs': syncs,
+        'failed': sum(outcome['failed'] for outcome in outcomes),
+        'seconds': round(elapsed, 2),
+        'syncs_per_second': round(syncs / elapsed, 1),
+        'google_requests': sum(outcome['google_requests'] for outcome in outcomes),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--guilds', type=int, default=64)
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.05)
+    args = parser.parse_args()
+    print(f'{os.cpu_count()} cpus', flush=True)
+    for processes in args.processes:
+        print(json.dumps(run(processes, args.guilds, args.events, args.latency)), flush=True)
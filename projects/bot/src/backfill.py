@@ -0,0 +1,134 @@
+import asyncio
+import json
+import logging
+import os
+
+from googleapiclient.errors import HttpError
+
+from calendar_service import event_body
+
+BACKFILL_FILE = 'backfill.json'
+BACKFILL_CHUNK_SIZE = int(os.getenv('BACKFILL_CHUNK_SIZE', 50))
+BACKFILL_RETRIES = 3
+
+logger = logging.getLogger('discord.backfill')
+
+
+class Backfiller:
+
+    def __init__(self, executor, state_file: str = BACKFILL_FILE, chunk_size: int = BACKFILL_CHUNK_SIZE):
+        """ initializes the backfill of existing discord scheduled events into google calendar
+
+        Args:
+            executor (CalendarExecutor): the executor google calendar requests run on
+            state_file (str): the json file the ids of the events backfilled by an unfinished pass are saved to
+            chunk_size (int): the number of events sent in a single google batch request
+        """
+        self.executor = executor
+        self.state_file = state_file
+        self.chunk_size = chunk_size
+        self.completed = {}
+        self.running = set()
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'r') as f:
+                try:
+                    self.completed = {guild_id: set(event_ids) for guild_id, event_ids in json.load(f).items()}
+                except json.decoder.JSONDecodeError:
+                    pass
+
+    def save_state(self):
+        """atomically replaces the state file so a crash mid write never loses the progress of a backfill
+        """
+        temp_path = f'{self.state_file}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({guild_id: list(event_ids) for guild_id, event_ids in self.completed.items()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.state_file)
+
+    def forget(self, guild_id):
+        """drops the backfilled event ids of a guild, called when the guild links or unlinks a calendar
+        so the events are pushed again to a calendar of another account
+        """
+        if self.completed.pop(str(guild_id), None) is not None:
+            self.save_state()
+
+    async def push_chunk(self, service, guild_id: str, events: list) -> dict[str, str]:
+        """inserts a chunk of events with a single google batch request
+
+        Args:
+            service (googleapiclient.discovery.Resource): the google calendar service of the guild
+            guild_id (str): the id of the guild the events belong to
+            events (list[discord.ScheduledEvent]): the events to insert
+
+        Returns:
+            dict[str, str]: the ids of the events that failed mapped to their error
+        """
+        failed = {}
+        done = self.completed.setdefault(guild_id, set())
+
+        def callback(request_id, response, exception):
+            if exception is None or (isinstance(exception, HttpError) and exception.resp.status == 409):
+                # 409 means the event already exists in the calendar
+                done.add(request_id)
+            else:
+                failed[request_id] = str(exception)
+
+        batch = service.new_batch_http_request(callback=callback)
+        transport = None
+        for event in events:
+            request = service.events().insert(calendarId='primary', body=event_body(event))
+            transport = transport or request.http
+            batch.add(request, request_id=str(event.id))
+        await self.executor.execute(batch, transport=transport, guild_id=guild_id, cost=len(events))
+        return failed
+
+    async def backfill(self, guild_id, service, events: list, progress=None):
+        """pushes every event that has not been backfilled yet to the calendar of a guild, events that
+        were pushed before are skipped so a failed backfill resumes where it stopped. the ids are dropped
+        once a pass pushed every event, events that exist already are answered with 409 on the next pass
+
+        Args:
+            guild_id: the id of the guild to backfill
+            service (googleapiclient.discovery.Resource): the google calendar service of the guild
+            events (list[discord.ScheduledEvent]): the scheduled events of the guild
+            progress (Callable[[int, int], Awaitable] | None): called with (done, total) after every chunk
+
+        Returns:
+            result (Tuple[bool, str]): a tuple of a boolean and a summary of the backfill
+        """
+        guild_id = str(guild_id)
+        if guild_id in self.running:
+            return (None, f'backfill already running for guild {guild_id}')
+        self.running.add(guild_id)
+        try:
+            done = self.completed.setdefault(guild_id, set())
+            pending = [event for event in events if str(event.id) not in done]
+            total = len(pending)
+            pushed = 0
+            failed = {}
+            for attempt in range(BACKFILL_RETRIES):
+                failed = {}
+                for i in range(0, len(pending), self.chunk_size):
+                    chunk = pending[i:i + self.chunk_size]
+                    try:
+                        chunk_failed = await self.push_chunk(service, guild_id, chunk)
+                    except Exception as err:
+                        chunk_failed = {str(event.id): str(err) for event in chunk}
+                    failed.update(chunk_failed)
+                    pushed += len(chunk) - len(chunk_failed)
+                    await asyncio.to_thread(self.save_state)
+                    if progress is not None:
+                        await progress(pushed, total)
+                pending = [event for event in pending if str(event.id) in failed]
+                if not pending:
+                    break
+                logger.warning(f'backfill attempt {attempt + 1} for guild {guild_id} failed for {len(pending)} events')
+
+            if failed:
+                return (False, f'backfilled {pushed} of {total} events, {len(failed)} failed: {next(iter(failed.values()))}')
+            self.completed.pop(guild_id, None)
+            await asyncio.to_thread(self.save_state)
+            return (True, f'backfilled {pushed} events')
+        finally:
+            self.running.discard(guild_id)
@@ -0,0 +1,300 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
+import json
+import os
+import time
+import weakref
+
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+from google.oauth2.credentials import Credentials
+
+from rate_limiter import RateLimiter
+from telemetry import google_calls, google_call_latency, google_method
+
+SERVICE_CACHE_SIZE = int(os.getenv('SERVICE_CACHE_SIZE', 256))
+CALENDAR_WORKERS = int(os.getenv('CALENDAR_WORKERS', 8))
+CALENDAR_TIMEOUT = float(os.getenv('CALENDAR_TIMEOUT', 15))
+GUILD_PROPERTY = 'discordGuildId'
+HASH_PROPERTY = 'contentHash'
+HASHED_FIELDS = ('summary', 'location', 'description', 'start', 'end', 'endTimeUnspecified')
+
+
+class CalendarTimeoutError(Exception):
+    pass
+
+
+class RefreshingCredentials(Credentials):
+    """ google credentials that report every token refresh so the new access token can be saved
+    instead of being refreshed again the next time the credentials are loaded
+    """
+    on_refresh = None
+
+    def refresh(self, request):
+        super().refresh(request)
+        if self.on_refresh is not None:
+            self.on_refresh(self)
+
+
+def refreshed_info(credentials: Credentials) -> dict:
+    """gets the fields of refreshed credentials that have to be saved, in the format
+    Credentials.from_authorized_user_info reads
+
+    Args:
+        credentials (Credentials): the refreshed credentials
+
+    Returns:
+        dict: the access token, its expiry and the refresh token
+    """
+    return {
+        'token': credentials.token,
+        'refresh_token': credentials.refresh_token,
+        'expiry': credentials.expiry.isoformat() + 'Z' if credentials.expiry is not None else None,
+    }
+
+
+def event_body(event) -> dict:
+    """converts a discord scheduled event to the body of a google calendar event
+
+    Args:
+        event (discord.ScheduledEvent): the discord scheduled event to convert
+
+    Returns:
+        dict: the google calendar event body
+    """
+    event_details = {
+        "calendarId": "primary",
+        "id": str(event.id),
+        "summary": event.name,
+        "location": event.location,
+        "description": event.description,
+        "start": {
+            "dateTime": event.start_time.isoformat(),
+            "timeZone": "UTC",
+        },
+    }
+    if event.end_time is not None:
+        event_details["end"] = {
+            "dateTime": event.end_time.isoformat(),
+            "timeZone": "UTC",
+        }
+    else:
+        event_details["endTimeUnspecified"] = True
+    event_details["extendedProperties"] = {
+        "private": {
+            GUILD_PROPERTY: str(event.guild_id),
+            HASH_PROPERTY: content_hash(event_details),
+        }
+    }
+    return event_details
+
+
+def content_hash(event_details: dict) -> str:
+    """hashes the fields of a google calendar event body that come from discord, the hash is saved in the
+    private extended properties of the event so changes can be detected without comparing google's
+    normalized copy of the fields
+
+    Args:
+        event_details (dict): the google calendar event body
+
+    Returns:
+        str: the hex digest of the synced fields
+    """
+    fields = {field: event_details.get(field) for field in HASHED_FIELDS}
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()[:32]
+
+
+class CalendarServiceCache:
+
+    def __init__(self, max_size: int = SERVICE_CACHE_SIZE, on_refresh=None):
+        """ initializes a least recently used cache of google calendar services keyed by guild id
+
+        Args:
+            max_size (int): the maximum number of guild services to keep alive
+            on_refresh (Callable[[str, dict], None] | None): called on the event loop with the guild id and
+                refreshed_info of the credentials whenever google-auth refreshes the access token of a guild
+        """
+        self.max_size = max_size
+        self.on_refresh = on_refresh
+        self.services = OrderedDict()
+        self.credentials = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_service(self, guild_id: str, credentials_dict: dict):
+        """gets the cached calendar service for a guild, building it on a miss
+
+        Args:
+            guild_id (str): the id of the guild the service belongs to
+            credentials_dict (dict): the linked credentials of the guild
+
+        Returns:
+            googleapiclient.discovery.Resource: the google calendar service
+        """
+        guild_id = str(guild_id)
+        service = self.services.get(guild_id)
+        if service is not None:
+            self.hits += 1
+            self.services.move_to_end(guild_id)
+            return service
+
+        self.misses += 1
+        credentials = RefreshingCredentials.from_authorized_user_info(credentials_dict)
+        if self.on_refresh is not None:
+            loop = asyncio.get_running_loop()
+            # refreshes happen in the executor threads, the callback is handed back to the loop
+            credentials.on_refresh = lambda refreshed: loop.call_soon_threadsafe(
+                self.on_refresh, guild_id, refreshed_info(refreshed))
+        service = build('calendar', 'v3', credentials=credentials, cache_discovery=False)
+        self.services[guild_id] = service
+        self.credentials[guild_id] = credentials
+        if len(self.services) > self.max_size:
+            evicted_id, evicted = self.services.popitem(last=False)
+            self.credentials.pop(evicted_id, None)
+            evicted.close()
+        return service
+
+    def get_credentials(self, guild_id: str) -> Credentials | None:
+        """gets the live credentials of a cached guild service
+
+        Args:
+            guild_id (str): the id of the guild
+
+        Returns:
+            Credentials | None: the credentials, None if the guild has no cached service
+        """
+        return self.credentials.get(str(guild_id))
+
+    def update_credentials(self, guild_id: str, refreshed: Credentials):
+        """hands a token refreshed outside the cache to the cached credentials of a guild, so its service keeps
+        sending requests with the new token instead of refreshing it again
+
+        Args:
+            guild_id (str): the id of the guild
+            refreshed (Credentials): the refreshed credentials of the guild
+        """
+        credentials = self.credentials.get(str(guild_id))
+        if credentials is not None:
+            credentials.token = refreshed.token
+            credentials.expiry = refreshed.expiry
+
+    def invalidate(self, guild_id: str):
+        """drops the cached service of a guild so the next call rebuilds it from the linked credentials
+
+        Args:
+            guild_id (str): the id of the guild to invalidate
+        """
+        service = self.services.pop(str(guild_id), None)
+        self.credentials.pop(str(guild_id), None)
+        if service is not None:
+            service.close()
+
+    def __len__(self):
+        return len(self.services)
+
+
+class CalendarExecutor:
+
+    def __init__(self, max_workers: int = CALENDAR_WORKERS, timeout: float = CALENDAR_TIMEOUT,
+                 limiter: RateLimiter | None = None):
+        """ initializes a bounded thread pool that runs blocking google calendar requests off the event loop,
+        all google calendar traffic of the bot goes through it so it is where requests are throttled and retried
+
+        Args:
+            max_workers (int): the maximum number of google calendar requests in flight at once
+            timeout (float): the default number of seconds to wait for a request
+            limiter (RateLimiter | None): the rate limits and retry policy of the requests, defaults to the
+                limits from the environment
+        """
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='calendar')
+        self.timeout = timeout
+        self.limiter = RateLimiter() if limiter is None else limiter
+        self.transport_locks = weakref.WeakKeyDictionary()
+
+    def transport_lock(self, http) -> asyncio.Lock:
+        """gets the lock guarding an http transport, httplib2 transports are not thread safe so
+        requests sharing a cached service run one at a time. the requests wait on the event loop, a busy
+        guild never holds pool threads the requests of other guilds could use
+
+        Args:
+            http: the http transport of a request
+
+        Returns:
+            asyncio.Lock: the lock for the transport
+        """
+        lock = self.transport_locks.get(http)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.transport_locks[http] = lock
+        return lock
+
+    async def run(self, request, transport):
+        """runs a request in the thread pool once no other request uses its transport
+
+        Returns:
+            asyncio.Future: the future of the request, the transport is released when it finishes
+        """
+        lock = self.transport_lock(transport)
+        await lock.acquire()
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self.pool, request.execute)
+        except BaseException:
+            lock.release()
+            raise
+        # a request that timed out keeps the transport until its thread is done with it
+        future.add_done_callback(lambda _: lock.release())
+        return future
+
+    async def execute(self, request, timeout: float | None = None, transport=None, guild_id=None, cost: int = 1):
+        """executes a google api request in the thread pool once the rate limits allow it, throttled and
+        failed requests are retried with backoff
+
+        Args:
+            request (googleapiclient.http.HttpRequest | BatchHttpRequest): the request to execute
+            timeout (float | None): seconds to wait for a single attempt, defaults to the executor timeout
+            transport: the http transport the request goes through, defaults to request.http
+            guild_id: the id of the guild the request is sent for
+            cost (int): the number of google requests it counts as, the size of a batch request
+
+        Returns:
+            dict: the response body of the request
+
+        Raises:
+            CalendarTimeoutError: if the request did not finish in time
+            HttpError: if google rejected the request or it still failed after the last retry
+        """
+        timeout = self.timeout if timeout is None else timeout
+        transport = request.http if transport is None else transport
+        method = google_method(request)
+        statuses = []
+        if isinstance(request, HttpRequest):
+            request.add_response_callback(lambda resp: statuses.append(resp.status))
+        attempt = 0
+        while True:
+            await self.limiter.acquire(guild_id, cost)
+            start = time.perf_counter()
+            try:
+                future = await self.run(request, transport)
+                start = time.perf_counter()
+                response = await asyncio.wait_for(asyncio.shield(future), timeout)
+                # a batch request only returns once google answered the batch itself with 200
+                google_calls.inc(method, statuses[-1] if statuses else 200)
+                return response
+            except asyncio.TimeoutError:
+                google_calls.inc(method, 'timeout')
+                raise CalendarTimeoutError(f'google calendar request timed out after {timeout}s')
+            except Exception as err:
+                google_calls.inc(method, err.resp.status if isinstance(err, HttpError) else 'error')
+                delay = self.limiter.should_retry(guild_id, attempt, err)
+                if delay is None:
+                    raise
+            finally:
+                google_call_latency.observe(time.perf_counter() - start, method)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,313 @@
+from datetime import datetime, timezone
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+from googleapiclient.errors import HttpError
+
+from calendar_service import GUILD_PROPERTY
+from push_channels import channel_token
+
+CHANGE_FEED_FILE = 'change_feed.json'
+CHANNEL_TTL = int(os.getenv('CHANNEL_TTL', 604800))
+CHANNEL_RENEW_MARGIN = float(os.getenv('CHANNEL_RENEW_MARGIN', 3600))
+CHANNEL_CHECK_INTERVAL = float(os.getenv('CHANNEL_CHECK_INTERVAL', 600))
+
+logger = logging.getLogger('discord.changes')
+
+
+def parse_time(value: dict | None) -> datetime | None:
+    if not value or 'dateTime' not in value:
+        return None
+    return datetime.fromisoformat(value['dateTime']).astimezone(timezone.utc)
+
+
+def discord_changes(event, google_event: dict) -> dict:
+    """finds the fields of a discord scheduled event that were edited in google calendar
+
+    Args:
+        event (discord.ScheduledEvent): the discord scheduled event
+        google_event (dict): the changed google calendar event
+
+    Returns:
+        dict: the keyword arguments for ScheduledEvent.edit, empty if the event matches
+    """
+    changes = {}
+    if 'summary' in google_event and google_event['summary'] != event.name:
+        changes['name'] = google_event['summary']
+    if 'description' in google_event and google_event['description'] != (event.description or ''):
+        changes['description'] = google_event['description']
+    # only external events have a location, voice and stage events are bound to a channel
+    if event.location is not None and 'location' in google_event and google_event['location'] != event.location:
+        changes['location'] = google_event['location']
+    start_time = parse_time(google_event.get('start'))
+    if start_time is not None and start_time != event.start_time:
+        changes['start_time'] = start_time
+    end_time = parse_time(google_event.get('end'))
+    if end_time is not None and event.end_time is not None and end_time != event.end_time:
+        changes['end_time'] = end_time
+    return changes
+
+
+class ChangeFeed:
+
+    def __init__(self, executor, get_service, apply, push_url: str | None = None, secret: str | None = None,
+                 state_file: str = CHANGE_FEED_FILE, channel_ttl: int = CHANNEL_TTL,
+                 renew_margin: float = CHANNEL_RENEW_MARGIN, check_interval: float = CHANNEL_CHECK_INTERVAL):
+        """ initializes the incremental feed of google calendar changes, every guild keeps the syncToken of
+        its last pull so a pull only returns the events changed since then
+
+        Args:
+            executor (CalendarExecutor): the executor google calendar requests run on
+            get_service (Callable[[str], Awaitable[Resource | None]]): gets the calendar service of a guild,
+                None if the guild is not linked
+            apply (Callable[[str, list[dict]], Awaitable]): applies the changed google events of a guild
+            push_url (str | None): the https address google sends push notifications to, channels are only
+                opened if it is set
+            secret (str | None): the key channel tokens are signed with, shared with the api
+            state_file (str): the json file sync tokens and channels are saved to
+            channel_ttl (int): the requested lifetime of a channel in seconds
+            renew_margin (float): channels are renewed this many seconds before they expire
+            check_interval (float): seconds between checks for expiring channels
+        """
+        self.executor = executor
+        self.get_service = get_service
+        self.apply = apply
+        self.push_url = push_url
+        self.secret = secret
+        self.state_file = state_file
+        self.channel_ttl = channel_ttl
+        self.renew_margin = renew_margin
+        self.check_interval = check_interval
+        self.state = {}
+        self.pulling = {}
+        self.pending = set()
+        self.renew_task = None
+        self.save_lock = asyncio.Lock()
+        self.pulls = 0
+        self.changes = 0
+        self.resyncs = 0
+        self.renewals = 0
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'r') as f:
+                try:
+                    self.state = json.load(f)
+                except json.decoder.JSONDecodeError:
+                    pass
+
+    def save_state(self, snapshot: str):
+        """atomically replaces the state file so a crash mid write never leaves invalid json behind
+
+        Args:
+            snapshot (str): the serialized state
+        """
+        temp_path = f'{self.state_file}.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.state_file)
+
+    async def save(self):
+        """saves the state off the loop, the state is serialized on the loop so no pull or watch changes it
+        while it is written, and the lock keeps an older snapshot from replacing a newer one
+        """
+        snapshot = json.dumps(self.state)
+        async with self.save_lock:
+            await asyncio.to_thread(self.save_state, snapshot)
+
+    async def list_changes(self, service, guild_id: str, sync_token: str | None) -> tuple[list[dict], str]:
+        """lists the events changed since a sync token, without a token it only pages through the calendar
+        to get the token of its current state
+
+        Returns:
+            tuple[list[dict], str]: the changed events and the sync token for the next pull
+        """
+        items = []
+        page_token = None
+        fields = 'items,nextPageToken,nextSyncToken' if sync_token else 'nextPageToken,nextSyncToken'
+        while True:
+            response = await self.executor.execute(service.events().list(
+                calendarId='primary', syncToken=sync_token, pageToken=page_token, maxResults=2500,
+                showDeleted=True if sync_token else None, fields=fields), guild_id=guild_id)
+            items.extend(response.get('items', []))
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return items, response['nextSyncToken']
+
+    async def pull(self, guild_id: str):
+        """applies the google events of a guild that changed since the last pull
+
+        Args:
+            guild_id (str): the id of the guild
+
+        Returns:
+            tuple: tuple[bool, list[dict]] True and the applied changes, None and an error otherwise
+        """
+        guild_id = str(guild_id)
+        service = await self.get_service(guild_id)
+        if service is None:
+            return (None, f'guild {guild_id} is not linked')
+        state = self.state.setdefault(guild_id, {})
+        sync_token = state.get('sync_token')
+        try:
+            items, next_token = await self.list_changes(service, guild_id, sync_token)
+        except HttpError as err:
+            if err.resp.status != 410:
+                raise
+            # google expired the sync token, start over from the current state of the calendar
+            self.resyncs += 1
+            sync_token = None
+            items, next_token = await self.list_changes(service, guild_id, None)
+
+        changes = []
+        if sync_token is not None:
+            # deleted events only carry their id, the discord side checks if the event belongs to the guild
+            changes = [item for item in items if item.get('status') == 'cancelled'
+                       or item.get('extendedProperties', {}).get('private', {}).get(GUILD_PROPERTY) == guild_id]
+            if changes:
+                await self.apply(guild_id, changes)
+        state['sync_token'] = next_token
+        await self.save()
+        self.pulls += 1
+        self.changes += len(changes)
+        return (True, changes)
+
+    def notify(self, guild_id: str):
+        """pulls the changes of a guild, notifications arriving during a pull cause a single extra pull
+
+        Args:
+            guild_id (str): the id of the guild whose calendar changed
+        """
+        guild_id = str(guild_id)
+        if guild_id in self.pulling:
+            self.pending.add(guild_id)
+            return
+        self.pulling[guild_id] = asyncio.create_task(self.pull_until_idle(guild_id), name=f'pull_{guild_id}')
+
+    async def pull_until_idle(self, guild_id: str):
+        try:
+            while True:
+                self.pending.discard(guild_id)
+                try:
+                    await self.pull(guild_id)
+                except Exception:
+                    logger.exception(f'pulling calendar changes failed for guild {guild_id}')
+                if guild_id not in self.pending:
+                    break
+        finally:
+            self.pulling.pop(guild_id, None)
+
+    async def watch(self, guild_id: str):
+        """opens a push channel for the calendar of a guild and closes the channel it replaces
+
+        Args:
+            guild_id (str): the id of the guild
+
+        Returns:
+            dict | None: the channel, None if push notifications are disabled or the guild is not linked
+        """
+        guild_id = str(guild_id)
+        if not self.push_url:
+            return None
+        service = await self.get_service(guild_id)
+        if service is None:
+            return None
+        response = await self.executor.execute(service.events().watch(calendarId='primary', body={
+            'id': str(uuid.uuid4()),
+            'type': 'web_hook',
+            'address': self.push_url,
+            'token': channel_token(guild_id, self.secret),
+            'params': {'ttl': str(self.channel_ttl)},
+        }), guild_id=guild_id)
+        state = self.state.setdefault(guild_id, {})
+        old_channel = state.get('channel')
+        state['channel'] = {
+            'id': response['id'],
+            'resource_id': response['resourceId'],
+            'expiration': int(response['expiration']) / 1000,
+        }
+        await self.save()
+        if old_channel is not None:
+            await self.stop_channel(service, guild_id, old_channel)
+        return state['channel']
+
+    async def stop_channel(self, service, guild_id: str, channel: dict):
+        try:
+            await self.executor.execute(service.channels().stop(
+                body={'id': channel['id'], 'resourceId': channel['resource_id']}), guild_id=guild_id)
+        except HttpError as err:
+            if err.resp.status != 404:
+                logger.warning(f'failed to stop channel {channel["id"]}: {err}')
+
+    async def ensure(self, guild_id: str):
+        """catches a guild up on the changes made while the bot was offline and makes sure its push channel
+        is open and not about to expire
+
+        Args:
+            guild_id (str): the id of the guild
+        """
+        guild_id = str(guild_id)
+        await self.pull(guild_id)
+        channel = self.state.get(guild_id, {}).get('channel')
+        if channel is None or channel['expiration'] - self.renew_margin <= time.time():
+            await self.watch(guild_id)
+
+    async def forget(self, guild_id: str):
+        """drops the sync token and push channel of a guild that was unlinked
+
+        Args:
+            guild_id (str): the id of the guild
+        """
+        state = self.state.pop(str(guild_id), None)
+        if state is None:
+            return
+        await self.save()
+        if state.get('channel') is not None:
+            service = await self.get_service(str(guild_id))
+            if service is not None:
+                await self.stop_channel(service, guild_id, state['channel'])
+
+    async def renew_expiring(self):
+        """replaces every channel that expires within the renew margin
+        """
+        deadline = time.time() + self.renew_margin
+        for guild_id, state in list(self.state.items()):
+            channel = state.get('channel')
+            if channel is not None and channel['expiration'] <= deadline:
+                try:
+                    await self.watch(guild_id)
+                    self.renewals += 1
+                except Exception:
+                    logger.exception(f'renewing the push channel failed for guild {guild_id}')
+
+    async def run_renewals(self):
+        while True:
+            await self.renew_expiring()
+            await asyncio.sleep(self.check_interval)
+
+    def start(self):
+        if self.renew_task is None:
+            self.renew_task = asyncio.create_task(self.run_renewals(), name='channel_renewals')
+
+    async def stop(self):
+        if self.renew_task is not None:
+            self.renew_task.cancel()
+            await asyncio.gather(self.renew_task, return_exceptions=True)
+            self.renew_task = None
+
+    def stats(self) -> dict:
+        """Returns:
+            dict: the number of tracked guilds, open channels and the feed counters
+        """
+        return {
+            'guilds': len(self.state),
+            'channels': sum(1 for state in self.state.values() if state.get('channel') is not None),
+            'pulls': self.pulls,
+            'changes': self.changes,
+            'resyncs': self.resyncs,
+            'renewals': self.renewals,
+        }
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+import os
+
+from googleapiclient.errors import HttpError
+
+MIRROR_SIZE = int(os.getenv('MIRROR_SIZE', 4096))
+MIRRORED_FIELDS = ('id', 'etag', 'htmlLink', 'attendees')
+
+
+class EventMirror:
+
+    def __init__(self, max_size: int = MIRROR_SIZE):
+        """ initializes a local mirror of the synced google calendar events, keeping the fields needed
+        to change attendees without fetching the event first
+
+        Args:
+            max_size (int): the maximum number of events to mirror
+        """
+        self.max_size = max_size
+        self.events = OrderedDict()
+        self.refreshes = 0
+
+    def store(self, guild_id, google_event: dict, written: bool = True) -> dict:
+        """mirrors a google calendar event returned by the calendar api
+
+        Args:
+            guild_id: the id of the guild the event belongs to
+            google_event (dict): the event resource returned by google
+            written (bool): if the event was returned by a write of the bot, its etag and updated time are kept
+                so the change feed can tell the bot's own writes apart
+
+        Returns:
+            dict: the mirrored entry
+        """
+        entry = {field: google_event.get(field) for field in MIRRORED_FIELDS}
+        entry['attendees'] = entry['attendees'] or []
+        key = (str(guild_id), str(google_event['id']))
+        if written:
+            entry['written'] = (google_event.get('etag'), google_event.get('updated'))
+        else:
+            previous = self.events.get(key)
+            entry['written'] = previous['written'] if previous is not None else None
+        self.events[key] = entry
+        self.events.move_to_end(key)
+        if len(self.events) > self.max_size:
+            self.events.popitem(last=False)
+        return entry
+
+    def get(self, guild_id, event_id) -> dict | None:
+        return self.events.get((str(guild_id), str(event_id)))
+
+    def forget(self, guild_id, event_id):
+        self.events.pop((str(guild_id), str(event_id)), None)
+
+    def is_own_write(self, guild_id, google_event: dict) -> bool:
+        """checks if a changed google event is the version the bot last wrote itself
+
+        Args:
+            guild_id: the id of the guild the event belongs to
+            google_event (dict): the event resource from the change feed
+
+        Returns:
+            bool: True if its etag or updated time matches the last write of the bot
+        """
+        entry = self.get(guild_id, google_event['id'])
+        if entry is None or entry['written'] is None:
+            return False
+        etag, updated = entry['written']
+        return ((etag is not None and google_event.get('etag') == etag)
+                or (updated is not None and google_event.get('updated') == updated))
+
+    async def patch_attendees(self, executor, service, guild_id, event_id, change):
+        """applies a change to the attendees of an event as a conditional patch against the mirrored etag,
+        the event is only fetched when it is not mirrored or google rejects the etag
+
+        Args:
+            executor (CalendarExecutor): the executor to run the requests on
+            service (googleapiclient.discovery.Resource): the google calendar service of the guild
+            guild_id: the id of the guild the event belongs to
+            event_id: the id of the event
+            change (Callable[[list[dict]], list[dict]]): returns the new attendee list from the current one
+
+        Returns:
+            dict: the mirrored entry of the event after the change
+        """
+        for attempt in range(2):
+            entry = self.get(guild_id, event_id)
+            if entry is None:
+                self.refreshes += 1
+                entry = self.store(guild_id, await executor.execute(
+                    service.events().get(calendarId='primary', eventId=str(event_id)), guild_id=guild_id),
+                    written=False)
+
+            attendees = change(list(entry['attendees']))
+            if attendees == entry['attendees']:
+                return entry
+
+            request = service.events().patch(calendarId='primary', eventId=str(event_id), body={'attendees': attendees})
+            if entry.get('etag') is not None:
+                request.headers['If-Match'] = entry['etag']
+            try:
+                return self.store(guild_id, await executor.execute(request, guild_id=guild_id))
+            except HttpError as err:
+                if err.resp.status != 412 or attempt == 1:
+                    raise
+                # the event changed in google since it was mirrored
+                self.forget(guild_id, event_id)
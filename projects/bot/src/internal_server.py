@@ -0,0 +1,66 @@
+import os
+
+from aiohttp import web
+
+INTERNAL_HOST = os.getenv('INTERNAL_HOST', '127.0.0.1')
+INTERNAL_PORT = int(os.getenv('INTERNAL_PORT', 8765))
+
+
+class InternalServer:
+
+    def __init__(self, host: str = INTERNAL_HOST, port: int = INTERNAL_PORT, api_key: str | None = None):
+        """ initializes the http server the api uses to notify the bot
+
+        Args:
+            host (str): the host to listen on
+            port (int): the port to listen on, 0 picks a free port
+            api_key (str | None): the key requests have to send in the Authorization header, on its own or as
+                a bearer token the way prometheus sends it. without a key only the public routes are served
+        """
+        self.host = host
+        self.port = port
+        self.api_key = api_key
+        self.public_paths = set()
+        self.app = web.Application(middlewares=[self.authorize])
+        self.runner = None
+
+    @web.middleware
+    async def authorize(self, request: web.Request, handler):
+        if request.path not in self.public_paths and not self.authorized(request.headers.get('Authorization')):
+            raise web.HTTPForbidden(text='unauthorized request')
+        return await handler(request)
+
+    def authorized(self, header: str | None) -> bool:
+        if self.api_key is None:
+            return False
+        return header == self.api_key or header == f'Bearer {self.api_key}'
+
+    def add_route(self, method: str, path: str, handler, public: bool = False):
+        """registers a route, routes have to be added before the server starts
+
+        Args:
+            method (str): the http method of the route
+            path (str): the path of the route
+            handler (Callable[[web.Request], Awaitable[web.Response]]): the request handler
+            public (bool): if the route can be called without the api key
+        """
+        self.app.router.add_route(method, path, handler)
+        if public:
+            self.public_paths.add(path)
+
+    @property
+    def running(self) -> bool:
+        return self.runner is not None
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        if self.port == 0:
+            self.port = self.runner.addresses[0][1]
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
@@ -0,0 +1,116 @@
+"""Runs the bot as several shard processes. Every process connects its share of the gateway shards and serves
+the guilds on them, link state and pending syncs are shared through the guilds database.
+
+usage: python src/launcher.py --processes 4 [--shards 8] [--stagger 5]
+
+Process i serves the guilds whose shard id for a shard count of --processes is i, the api routes the
+notifications of a guild to the matching url when BOT_NOTIFY_URL lists the internal server of every process.
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from internal_server import INTERNAL_PORT
+from telemetry import METRICS_PORT
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+RESTART_DELAY = 5
+MAX_RESTART_DELAY = 300
+
+
+class Launcher:
+
+    def __init__(self, processes: int, shard_count: int, stagger: float, internal_port: int = INTERNAL_PORT,
+                 metrics_port: int | None = METRICS_PORT, script: str = os.path.join(SRC_DIR, 'start.py')):
+        """ initializes the supervisor of the shard processes
+
+        Args:
+            processes (int): the number of processes to run
+            shard_count (int): the total number of shards, a multiple of processes
+            stagger (float): seconds between process starts, discord only lets a bot identify one shard at a time
+            internal_port (int): the internal server port of the first process, process i listens on port + i
+            metrics_port (int | None): the metrics port of the first process, offset like the internal port.
+                None if the processes serve no separate metrics listener
+            script (str): the bot script every process runs
+        """
+        if shard_count % processes != 0:
+            raise ValueError(f'the shard count {shard_count} has to be a multiple of the number of processes {processes}')
+        self.processes = processes
+        self.shard_count = shard_count
+        self.stagger = stagger
+        self.internal_port = internal_port
+        self.metrics_port = metrics_port
+        self.script = script
+        self.children = {}
+        self.restarts = {}
+        self.restart_at = {}
+        self.stopping = False
+
+    def environment(self, index: int) -> dict:
+        environment = {
+            **os.environ,
+            'SHARD_INDEX': str(index),
+            'SHARD_PROCESSES': str(self.processes),
+            'SHARD_COUNT': str(self.shard_count),
+            'INTERNAL_PORT': str(self.internal_port + index),
+        }
+        if self.metrics_port is not None:
+            environment['METRICS_PORT'] = str(self.metrics_port + index)
+        return environment
+
+    def spawn(self, index: int):
+        print(f'launcher: starting process {index} on internal port {self.internal_port + index}', flush=True)
+        self.children[index] = subprocess.Popen([sys.executable, self.script], env=self.environment(index))
+
+    def stop(self, *args):
+        self.stopping = True
+        for child in self.children.values():
+            if child.poll() is None:
+                child.send_signal(signal.SIGTERM)
+
+    def supervise(self, poll_interval: float = 1.0):
+        """restarts processes that exit with a growing delay until the launcher is told to stop
+        """
+        while not self.stopping:
+            now = time.monotonic()
+            for index, child in list(self.children.items()):
+                code = child.poll()
+                if code is None:
+                    continue
+                if index not in self.restart_at:
+                    self.restarts[index] = self.restarts.get(index, 0) + 1
+                    delay = min(MAX_RESTART_DELAY, RESTART_DELAY * 2 ** (self.restarts[index] - 1))
+                    self.restart_at[index] = now + delay
+                    print(f'launcher: process {index} exited with {code}, restarting in {delay}s', flush=True)
+                elif self.restart_at[index] <= now:
+                    del self.restart_at[index]
+                    self.spawn(index)
+            time.sleep(poll_interval)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.processes):
+            if self.stopping:
+                break
+            self.spawn(index)
+            if index < self.processes - 1:
+                time.sleep(self.stagger)
+        self.supervise()
+        for child in self.children.values():
+            try:
+                child.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                child.kill()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=int(os.getenv('SHARD_PROCESSES', 1)))
+    parser.add_argument('--shards', type=int, default=None, help='the total number of shards, defaults to --processes')
+    parser.add_argument('--stagger', type=float, default=5)
+    args = parser.parse_args()
+    Launcher(args.processes, args.shards or args.processes, args.stagger).run()
@@ -0,0 +1,644 @@
+"""A durable outbox for calendar sync operations. Every sync is saved with an idempotency key before it runs
+and only marked done once google accepted it, so syncs that were pending when the bot stopped are replayed
+when it starts again.
+
+Run it as a script to inspect the outbox and replay stuck entries:
+
+    python src/outbox.py stats
+    python src/outbox.py list --state dead
+    python src/outbox.py replay --state dead
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+
+from sqlalchemy import bindparam, create_engine, text
+
+from pragmas import set_sqlite_pragmas, sqlite_pragmas
+from sync_queue import UPDATE, DELETE, ATTENDEE
+
+OUTBOX_DATABASE_URL = os.getenv('OUTBOX_DATABASE_URL', os.getenv('DATABASE_URL', 'sqlite:///database/guilds.db'))
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', 8))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 10))
+OUTBOX_RETRY_DELAY = float(os.getenv('OUTBOX_RETRY_DELAY', 30))
+OUTBOX_RETRY_MAX_DELAY = float(os.getenv('OUTBOX_RETRY_MAX_DELAY', 3600))
+OUTBOX_SWEEP_INTERVAL = float(os.getenv('OUTBOX_SWEEP_INTERVAL', 15))
+OUTBOX_RETENTION = float(os.getenv('OUTBOX_RETENTION', 86400))
+OUTBOX_SWEEP_SIZE = 500
+
+PENDING = 'pending'
+DONE = 'done'
+SUPERSEDED = 'superseded'
+DEAD = 'dead'
+STATES = (PENDING, DONE, SUPERSEDED, DEAD)
+
+logger = logging.getLogger('discord.outbox')
+
+
+def idempotency_key(guild_id: str, event_id: str, kind: str, payload: dict) -> str:
+    """builds the key that identifies a sync, the same change of an event recorded twice gets the same key
+
+    Returns:
+        str: the key
+    """
+    content = json.dumps([str(guild_id), str(event_id), kind, payload], sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()[:32]
+
+
+class OutboxStore:
+
+    def __init__(self, database_url: str = OUTBOX_DATABASE_URL):
+        """ initializes the outbox table, the methods block so the bot calls them from a thread
+
+        Args:
+            database_url (str): the database the outbox table lives in, the guilds database by default
+        """
+        self.engine = create_engine(database_url)
+        if self.engine.dialect.name == 'sqlite':
+            # the same WAL setup as the guilds database the outbox table usually shares
+            set_sqlite_pragmas(self.engine, sqlite_pragmas(os.environ))
+        with self.engine.begin() as con:
+            con.execute(text('''CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY,
+                idempotency_key TEXT NOT NULL,
+                guild_id TEXT NOT NULL,
+                event_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                available_at REAL NOT NULL
+            )'''))
+            # a sync is only a duplicate of the latest pending sync of its event, the same change made again
+            # after another one has to run again even if the older copy is still pending
+            con.execute(text('DROP INDEX IF EXISTS outbox_pending_key'))
+            con.execute(text('CREATE INDEX IF NOT EXISTS outbox_event ON outbox (guild_id, event_id, state)'))
+            con.execute(text('CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, available_at)'))
+
+    @staticmethod
+    def to_entry(row) -> dict:
+        entry = dict(row._mapping)
+        entry['payload'] = json.loads(entry['payload'])
+        return entry
+
+    def add(self, guild_id: str, event_id: str, kind: str, payload: dict) -> dict | None:
+        """saves a sync
+
+        Returns:
+            dict | None: the saved entry, None if the same sync is the latest pending sync of its kind for the event
+        """
+        entry = self.new_entry(guild_id, event_id, kind, payload, time.time())
+        with self.engine.begin() as con:
+            latest = con.execute(text('''SELECT idempotency_key FROM outbox WHERE guild_id=:guild_id
+                AND event_id=:event_id AND kind=:kind AND state=:state ORDER BY id DESC LIMIT 1'''), entry).scalar()
+            if latest == entry['idempotency_key']:
+                return None
+            return self.insert(con, entry)
+
+    @staticmethod
+    def new_entry(guild_id: str, event_id: str, kind: str, payload: dict, available_at: float) -> dict:
+        now = time.time()
+        return {
+            'idempotency_key': idempotency_key(guild_id, event_id, kind, payload),
+            'guild_id': str(guild_id),
+            'event_id': str(event_id),
+            'kind': kind,
+            'payload': payload,
+            'state': PENDING,
+            'attempts': 0,
+            'last_error': None,
+            'created_at': now,
+            'updated_at': now,
+            'available_at': available_at,
+        }
+
+    @staticmethod
+    def insert(con, entry: dict) -> dict:
+        entry['id'] = con.execute(text('''INSERT INTO outbox (idempotency_key, guild_id, event_id, kind, payload,
+            state, created_at, updated_at, available_at)
+            VALUES (:idempotency_key, :guild_id, :event_id, :kind, :payload, :state, :created_at, :updated_at,
+            :available_at)
+            RETURNING id'''), {**entry, 'payload': json.dumps(entry['payload'])}).scalar()
+        return entry
+
+    def net_attendee_change(self, guild_id: str, event_id: str, member_id: str, added: bool,
+                            window: float) -> dict | None:
+        """saves an attendee change as soon as it is buffered, netted into the open attendee sync of the event.
+        an add and a remove of the same member cancel each other out. a sync stays open for `window` seconds
+        or until the buffer flushes and closes it, if the bot stops before that the sweep runs it once the
+        window passed
+
+        Args:
+            guild_id (str): the id of the guild the event belongs to
+            event_id (str): the id of the discord scheduled event
+            member_id (str): the id of the member that was added or removed
+            added (bool): True if the member was added, False if removed
+            window (float): the seconds a new attendee sync stays open for more changes
+
+        Returns:
+            dict | None: the new entry if the change opened a sync, None if it was netted into an open one
+        """
+        now = time.time()
+        member_id = str(member_id)
+        with self.engine.begin() as con:
+            row = con.execute(text('''SELECT id, payload FROM outbox WHERE guild_id=:guild_id AND event_id=:event_id
+                AND kind=:kind AND state=:pending AND attempts=0 AND available_at > :now
+                ORDER BY id DESC LIMIT 1'''), {
+                'guild_id': str(guild_id), 'event_id': str(event_id), 'kind': ATTENDEE, 'pending': PENDING, 'now': now,
+            }).first()
+            if row is None:
+                return self.insert(con, self.new_entry(guild_id, event_id, ATTENDEE, {'changes': {member_id: added}},
+                                                       now + window))
+            payload = json.loads(row.payload)
+            changes = payload.setdefault('changes', {})
+            if changes.get(member_id, added) != added:
+                del changes[member_id]
+            else:
+                changes[member_id] = added
+            if changes:
+                con.execute(text('''UPDATE outbox SET payload=:payload, idempotency_key=:key, updated_at=:now
+                    WHERE id=:id'''), {
+                    'payload': json.dumps(payload), 'key': idempotency_key(guild_id, event_id, ATTENDEE, payload),
+                    'now': now, 'id': row.id,
+                })
+            else:
+                con.execute(text('UPDATE outbox SET state=:state, updated_at=:now WHERE id=:id'),
+                            {'state': SUPERSEDED, 'now': now, 'id': row.id})
+        return None
+
+    def close_attendee_changes(self, guild_id: str, event_id: str) -> list[dict]:
+        """closes the attendee syncs of an event that were not tried yet, changes made after this open a new sync
+
+        Returns:
+            list[dict]: the closed entries, oldest first
+        """
+        now = time.time()
+        with self.engine.begin() as con:
+            rows = con.execute(text('''SELECT * FROM outbox WHERE guild_id=:guild_id AND event_id=:event_id
+                AND kind=:kind AND state=:pending AND attempts=0 ORDER BY id'''), {
+                'guild_id': str(guild_id), 'event_id': str(event_id), 'kind': ATTENDEE, 'pending': PENDING,
+            }).fetchall()
+            con.execute(text('''UPDATE outbox SET available_at=:now WHERE guild_id=:guild_id AND event_id=:event_id
+                AND kind=:kind AND state=:pending AND attempts=0 AND available_at > :now'''), {
+                'guild_id': str(guild_id), 'event_id': str(event_id), 'kind': ATTENDEE, 'pending': PENDING, 'now': now,
+            })
+            return [self.to_entry(row) for row in rows]
+
+    def complete(self, entry: dict) -> int:
+        """marks a sync done, pending syncs of the event it makes obsolete are marked superseded so a retry
+        does not undo it. an update replaces the whole event, a delete makes every earlier sync pointless and
+        an attendee sync makes the older changes of the same members pointless
+
+        Returns:
+            int: the number of superseded entries
+        """
+        now = time.time()
+        with self.engine.begin() as con:
+            con.execute(text('UPDATE outbox SET state=:state, updated_at=:now WHERE id=:id'),
+                        {'state': DONE, 'now': now, 'id': entry['id']})
+            if entry['kind'] == ATTENDEE:
+                return self.trim_attendee_changes(con, entry, now)
+            if entry['kind'] not in (UPDATE, DELETE):
+                return 0
+            kinds = '' if entry['kind'] == DELETE else f" AND kind = '{UPDATE}'"
+            return con.execute(text(f'''UPDATE outbox SET state=:superseded, updated_at=:now
+                WHERE guild_id=:guild_id AND event_id=:event_id AND id < :id AND state=:pending{kinds}'''), {
+                'superseded': SUPERSEDED, 'pending': PENDING, 'now': now,
+                'guild_id': entry['guild_id'], 'event_id': entry['event_id'], 'id': entry['id'],
+            }).rowcount
+
+    @staticmethod
+    def trim_attendee_changes(con, entry: dict, now: float) -> int:
+        """drops the members of a completed attendee sync from the older pending attendee syncs of the event,
+        the changes of other members are kept. a retried older sync would otherwise undo the newer change of a
+        member, older syncs left without changes are superseded
+
+        Returns:
+            int: the number of superseded entries
+        """
+        applied = {str(member_id) for member_id in entry['payload'].get('changes', {})}
+        if not applied:
+            return 0
+        rows = con.execute(text('''SELECT id, payload FROM outbox WHERE guild_id=:guild_id AND event_id=:event_id
+            AND id < :id AND state=:pending AND kind=:kind'''), {
+            'guild_id': entry['guild_id'], 'event_id': entry['event_id'], 'id': entry['id'], 'pending': PENDING,
+            'kind': ATTENDEE,
+        }).fetchall()
+        superseded = 0
+        for row in rows:
+            payload = json.loads(row.payload)
+            older = payload.get('changes', {})
+            changes = {member_id: add for member_id, add in older.items() if member_id not in applied}
+            if len(changes) == len(older):
+                continue
+            if changes:
+                con.execute(text('UPDATE outbox SET payload=:payload, updated_at=:now WHERE id=:id'),
+                            {'payload': json.dumps({**payload, 'changes': changes}), 'now': now, 'id': row.id})
+            else:
+                con.execute(text('UPDATE outbox SET state=:state, updated_at=:now WHERE id=:id'),
+                            {'state': SUPERSEDED, 'now': now, 'id': row.id})
+                superseded += 1
+        return superseded
+
+    def fail(self, entry: dict, error: str, delay: float, max_attempts: int) -> str:
+        """records a failed attempt, the sync is retried after the delay until it runs out of attempts
+
+        Returns:
+            str: the new state of the entry, PENDING or DEAD
+        """
+        entry['attempts'] += 1
+        entry['state'] = DEAD if entry['attempts'] >= max_attempts else PENDING
+        now = time.time()
+        with self.engine.begin() as con:
+            con.execute(text('''UPDATE outbox SET state=:state, attempts=:attempts, last_error=:error,
+                updated_at=:now, available_at=:available_at WHERE id=:id'''), {
+                'state': entry['state'], 'attempts': entry['attempts'], 'error': error[:1000], 'now': now,
+                'available_at': now + delay, 'id': entry['id'],
+            })
+        return entry['state']
+
+    def supersede(self, entry_ids: list[int]):
+        with self.engine.begin() as con:
+            for entry_id in entry_ids:
+                con.execute(text('UPDATE outbox SET state=:state, updated_at=:now WHERE id=:id AND state=:pending'),
+                            {'state': SUPERSEDED, 'pending': PENDING, 'now': time.time(), 'id': entry_id})
+
+    def pending_events(self, guild_id: str, kinds: tuple[str, ...]) -> set[str]:
+        """Returns:
+            set[str]: the ids of the events of a guild with a pending sync of one of the kinds
+        """
+        kinds = ', '.join(f"'{kind}'" for kind in kinds)
+        with self.engine.connect() as con:
+            rows = con.execute(text(f'''SELECT DISTINCT event_id FROM outbox
+                WHERE guild_id=:guild_id AND state=:pending AND kind IN ({kinds})'''),
+                               {'guild_id': str(guild_id), 'pending': PENDING})
+            return {row.event_id for row in rows}
+
+    def supersede_events(self, guild_id: str, event_ids: set[str], kinds: tuple[str, ...], before: float) -> int:
+        """marks the pending syncs of events recorded before a time as superseded
+
+        Returns:
+            int: the number of superseded entries
+        """
+        if not event_ids:
+            return 0
+        with self.engine.begin() as con:
+            return con.execute(text('''UPDATE outbox SET state=:superseded, updated_at=:now
+                WHERE guild_id=:guild_id AND state=:pending AND created_at < :before
+                AND event_id IN :event_ids AND kind IN :kinds''').bindparams(
+                bindparam('event_ids', expanding=True), bindparam('kinds', expanding=True)), {
+                'superseded': SUPERSEDED, 'pending': PENDING, 'now': time.time(), 'guild_id': str(guild_id),
+                'before': before, 'event_ids': [str(event_id) for event_id in event_ids], 'kinds': list(kinds),
+            }).rowcount
+
+    def due(self, limit: int = OUTBOX_SWEEP_SIZE) -> list[dict]:
+        """Returns:
+            list[dict]: the pending entries whose retry delay passed, oldest first
+        """
+        with self.engine.connect() as con:
+            rows = con.execute(text('''SELECT * FROM outbox WHERE state=:state AND available_at <= :now
+                ORDER BY id LIMIT :limit'''), {'state': PENDING, 'now': time.time(), 'limit': limit})
+            return [self.to_entry(row) for row in rows]
+
+    def entries(self, state: str | None = None, guild_id: str | None = None, limit: int = 50) -> list[dict]:
+        """Returns:
+            list[dict]: the newest entries, optionally only the ones in a state or of a guild
+        """
+        with self.engine.connect() as con:
+            rows = con.execute(text('''SELECT * FROM outbox
+                WHERE (:state IS NULL OR state=:state) AND (:guild_id IS NULL OR guild_id=:guild_id)
+                ORDER BY id DESC LIMIT :limit'''), {'state': state, 'guild_id': guild_id, 'limit': limit})
+            return [self.to_entry(row) for row in rows]
+
+    def get(self, entry_id: int) -> dict | None:
+        with self.engine.connect() as con:
+            row = con.execute(text('SELECT * FROM outbox WHERE id=:id'), {'id': entry_id}).first()
+            return self.to_entry(row) if row is not None else None
+
+    def counts(self) -> dict[str, int]:
+        """Returns:
+            dict[str, int]: the number of entries in every state
+        """
+        with self.engine.connect() as con:
+            rows = con.execute(text('SELECT state, COUNT(*) FROM outbox GROUP BY state'))
+            return {**{state: 0 for state in STATES}, **{state: count for state, count in rows}}
+
+    def replay(self, entry_ids: list[int] | None = None, state: str = DEAD, guild_id: str | None = None) -> int:
+        """makes entries pending again so the bot runs them on its next sweep, entries whose sync is already
+        pending again are left alone
+
+        Args:
+            entry_ids (list[int] | None): the entries to replay, every entry in the state if None
+            state (str): the state of the entries to replay when no ids are given
+            guild_id (str | None): only replays the entries of this guild
+
+        Returns:
+            int: the number of replayed entries
+        """
+        now = time.time()
+        ids = f'AND id IN ({",".join(str(int(entry_id)) for entry_id in entry_ids)})' if entry_ids else ''
+        with self.engine.begin() as con:
+            return con.execute(text(f'''UPDATE outbox SET state=:pending, attempts=0, updated_at=:now,
+                available_at=:now
+                WHERE state != :pending {ids if entry_ids else 'AND state=:state'}
+                AND (:guild_id IS NULL OR guild_id=:guild_id)
+                AND NOT EXISTS (SELECT 1 FROM outbox AS other
+                    WHERE other.idempotency_key = outbox.idempotency_key AND other.state=:pending)'''), {
+                'pending': PENDING, 'state': state, 'guild_id': guild_id, 'now': now,
+            }).rowcount
+
+    def purge(self, older_than: float = OUTBOX_RETENTION) -> int:
+        """deletes the finished entries that have not changed in a while
+
+        Returns:
+            int: the number of deleted entries
+        """
+        with self.engine.begin() as con:
+            return con.execute(text('DELETE FROM outbox WHERE state IN (:done, :superseded) AND updated_at < :before'), {
+                'done': DONE, 'superseded': SUPERSEDED, 'before': time.time() - older_than,
+            }).rowcount
+
+
+class Outbox:
+
+    def __init__(self, store: OutboxStore, queue, handlers: dict, owns=None, concurrency: int = OUTBOX_CONCURRENCY,
+                 max_attempts: int = OUTBOX_MAX_ATTEMPTS, retry_delay: float = OUTBOX_RETRY_DELAY,
+                 retry_max_delay: float = OUTBOX_RETRY_MAX_DELAY, sweep_interval: float = OUTBOX_SWEEP_INTERVAL,
+                 retention: float = OUTBOX_RETENTION):
+        """ initializes the worker side of the outbox, saved syncs run on the sync queue so the syncs of an event
+        keep their order, at most `concurrency` at a time. a sync that failed or was pending when the bot
+        stopped is picked up by the periodic sweep, so every sync runs at least once and handlers must be
+        safe to run again
+
+        Args:
+            store (OutboxStore): the outbox table
+            queue (EventSyncQueue): the queue syncs run on, its on_drop has to call Outbox.drop
+            handlers (dict[str, Callable[[str, str, dict], Awaitable[tuple]]]): the kind of a sync mapped to the
+                coroutine function that runs it with the guild id, event id and payload. it returns True when the
+                sync was applied, False when there was nothing to do and None with an error to retry later
+            owns (Callable[[str], bool] | None): decides if a guild is served by this process, the sweep leaves the
+                syncs of other processes sharing the table alone. every guild is served if None
+            concurrency (int): the maximum number of syncs running at once
+            max_attempts (int): failed syncs are given up as dead after this many attempts
+            retry_delay (float): seconds before the first retry of a failed sync, doubled with every attempt
+            retry_max_delay (float): the longest delay between retries
+            sweep_interval (float): seconds between sweeps for syncs to retry
+            retention (float): finished entries are deleted after this many seconds
+        """
+        self.store = store
+        self.queue = queue
+        self.handlers = handlers
+        self.owns = owns if owns is not None else (lambda guild_id: True)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.sweep_interval = sweep_interval
+        self.retention = retention
+        # a single thread keeps the writes in the order they were made
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='outbox')
+        self.inflight = set()
+        self.sweep_task = None
+        self.recorded = 0
+        self.deduped = 0
+        self.completed = 0
+        self.failed = 0
+        self.dead = 0
+        self.superseded = 0
+        self.replayed = 0
+
+    async def run_store(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.writer, method, *args)
+
+    async def record(self, guild_id, event_id, kind: str, payload: dict) -> dict | None:
+        entry = await self.run_store(self.store.add, guild_id, event_id, kind, payload)
+        if entry is None:
+            self.deduped += 1
+        else:
+            self.recorded += 1
+        return entry
+
+    async def submit(self, guild_id, event_id, kind: str, payload: dict) -> int | None:
+        """saves a sync and queues it
+
+        Args:
+            guild_id: the id of the guild the event belongs to
+            event_id: the id of the discord scheduled event
+            kind (str): one of CREATE, UPDATE, DELETE or ATTENDEE
+            payload (dict): the data the handler of the kind needs, it has to be json serializable
+
+        Returns:
+            int | None: the id of the entry, None if the same sync is already pending
+        """
+        entry = await self.record(guild_id, event_id, kind, payload)
+        if entry is None:
+            return None
+        self.dispatch(entry)
+        return entry['id']
+
+    async def perform(self, guild_id, event_id, kind: str, payload: dict):
+        """saves a sync and runs it right away, for callers already running on the event's queue
+
+        Returns:
+            tuple | None: the result of the handler, None if the same sync is already pending
+        """
+        entry = await self.record(guild_id, event_id, kind, payload)
+        if entry is None:
+            return None
+        self.inflight.add(entry['id'])
+        return await self.run(entry)
+
+    async def buffer_attendee_change(self, guild_id, event_id, member_id, added: bool, window: float):
+        """saves an attendee change before it waits in the attendee buffer, see OutboxStore.net_attendee_change
+        """
+        if await self.run_store(self.store.net_attendee_change, guild_id, event_id, member_id, added,
+                                window) is not None:
+            self.recorded += 1
+
+    async def flush_attendee_changes(self, guild_id, event_id) -> tuple | None:
+        """closes the attendee syncs of an event and runs them right away, for the flush of the attendee buffer
+        running on the event's queue
+
+        Returns:
+            tuple | None: the result of the last sync, None if there was nothing to run
+        """
+        entries = [entry for entry in await self.run_store(self.store.close_attendee_changes, guild_id, event_id)
+                   if entry['id'] not in self.inflight]
+        self.inflight.update(entry['id'] for entry in entries)
+        result = None
+        for entry in entries:
+            result = await self.run(entry, recheck=True)
+        return result
+
+    async def supersede_events(self, guild_id, event_ids: set[str], kinds: tuple[str, ...], before: float) -> int:
+        superseded = await self.run_store(self.store.supersede_events, guild_id, event_ids, kinds, before)
+        self.superseded += superseded
+        return superseded
+
+    def dispatch(self, entry: dict, recheck: bool = False):
+        self.inflight.add(entry['id'])
+
+        async def operation():
+            await self.run(entry, recheck)
+        operation.entry_id = entry['id']
+        self.queue.submit(entry['guild_id'], entry['event_id'], entry['kind'], operation)
+
+    def drop(self, operation):
+        """marks the entry of an operation the sync queue coalesced away as superseded
+
+        Args:
+            operation: the dropped operation
+        """
+        entry_id = getattr(operation, 'entry_id', None)
+        if entry_id is None:
+            return
+        self.inflight.discard(entry_id)
+        self.superseded += 1
+        asyncio.get_running_loop().run_in_executor(self.writer, self.store.supersede, [entry_id])
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.retry_max_delay, self.retry_delay * 2 ** attempts)
+        return random.uniform(delay / 2, delay)
+
+    async def run(self, entry: dict, recheck: bool = False):
+        """runs the handler of a sync and records the outcome
+
+        Args:
+            entry (dict): the outbox entry
+            recheck (bool): if the entry has to be read again first, a replayed sync may have been superseded
+                or lost attendee changes to a newer sync while it waited in the queue
+
+        Returns:
+            tuple: the result of the handler
+        """
+        try:
+            async with self.semaphore:
+                if recheck:
+                    current = await self.run_store(self.store.get, entry['id'])
+                    if current is None or current['state'] != PENDING:
+                        return (False, 'superseded')
+                    entry['payload'] = current['payload']
+                try:
+                    result = await self.handlers[entry['kind']](entry['guild_id'], entry['event_id'], entry['payload'])
+                except Exception as e:
+                    logger.exception(f'{entry["kind"]} sync {entry["id"]} failed for event {entry["event_id"]}')
+                    result = (None, str(e))
+            if result[0] is None:
+                self.failed += 1
+                state = await self.run_store(self.store.fail, entry, str(result[1]), self.backoff(entry['attempts']),
+                                             self.max_attempts)
+                if state == DEAD:
+                    self.dead += 1
+                    logger.error(f'{entry["kind"]} sync {entry["id"]} for event {entry["event_id"]} in guild '
+                                 f'{entry["guild_id"]} gave up after {entry["attempts"]} attempts: {result[1]}')
+            else:
+                self.completed += 1
+                self.superseded += await self.run_store(self.store.complete, entry)
+            return result
+        finally:
+            self.inflight.discard(entry['id'])
+
+    async def sweep(self) -> int:
+        """queues the pending syncs that are due and not already queued, which replays the syncs that were
+        pending when the bot stopped
+
+        Returns:
+            int: the number of queued syncs
+        """
+        entries = [entry for entry in await self.run_store(self.store.due)
+                   if entry['id'] not in self.inflight and self.owns(entry['guild_id'])]
+        for entry in entries:
+            self.dispatch(entry, recheck=True)
+        self.replayed += len(entries)
+        return len(entries)
+
+    async def run_sweeps(self):
+        while True:
+            try:
+                await self.sweep()
+                await self.run_store(self.store.purge, self.retention)
+            except Exception:
+                logger.exception('outbox sweep failed')
+            await asyncio.sleep(self.sweep_interval)
+
+    def start(self):
+        if self.sweep_task is None:
+            self.sweep_task = asyncio.create_task(self.run_sweeps(), name='outbox_sweep')
+
+    async def stop(self):
+        if self.sweep_task is not None:
+            self.sweep_task.cancel()
+            await asyncio.gather(self.sweep_task, return_exceptions=True)
+            self.sweep_task = None
+
+    def stats(self) -> dict:
+        """Returns:
+            dict: the outbox counters and the number of queued syncs
+        """
+        return {
+            'recorded': self.recorded,
+            'deduped': self.deduped,
+            'completed': self.completed,
+            'failed': self.failed,
+            'dead': self.dead,
+            'superseded': self.superseded,
+            'replayed': self.replayed,
+            'inflight': len(self.inflight),
+        }
+
+
+def print_entries(entries: list[dict]):
+    for entry in entries:
+        error = f' error: {entry["last_error"]}' if entry['last_error'] else ''
+        print(f'{entry["id"]:>8} {entry["state"]:<10} {entry["kind"]:<8} guild {entry["guild_id"]} '
+              f'event {entry["event_id"]} attempts {entry["attempts"]} '
+              f'updated {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["updated_at"]))}{error}')
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description='inspect and replay the calendar sync outbox')
+    parser.add_argument('--database', default=OUTBOX_DATABASE_URL, help='the database url of the outbox')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('stats', help='count the entries in every state')
+    list_parser = commands.add_parser('list', help='list the newest entries')
+    list_parser.add_argument('--state', choices=STATES)
+    list_parser.add_argument('--guild')
+    list_parser.add_argument('--limit', type=int, default=50)
+    show_parser = commands.add_parser('show', help='print an entry with its payload')
+    show_parser.add_argument('id', type=int)
+    replay_parser = commands.add_parser('replay', help='make entries pending again, the bot runs them on its next sweep')
+    replay_parser.add_argument('ids', type=int, nargs='*')
+    replay_parser.add_argument('--state', choices=(DEAD, DONE, SUPERSEDED), default=DEAD)
+    replay_parser.add_argument('--guild')
+    purge_parser = commands.add_parser('purge', help='delete finished entries')
+    purge_parser.add_argument('--older-than', type=float, default=OUTBOX_RETENTION, help='seconds')
+    args = parser.parse_args(argv)
+
+    store = OutboxStore(args.database)
+    if args.command == 'stats':
+        for state, count in store.counts().items():
+            print(f'{state:<10} {count}')
+    elif args.command == 'list':
+        print_entries(store.entries(args.state, args.guild, args.limit))
+    elif args.command == 'show':
+        entry = store.get(args.id)
+        if entry is None:
+            parser.exit(1, f'entry {args.id} not found\n')
+        print(json.dumps(entry, indent=2))
+    elif args.command == 'replay':
+        print(f'{store.replay(args.ids, args.state, args.guild)} entries replayed')
+    elif args.command == 'purge':
+        print(f'{store.purge(args.older_than)} entries deleted')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+from email.utils import parsedate_to_datetime
+import asyncio
+import logging
+import os
+import random
+import time
+
+from googleapiclient.errors import HttpError
+
+PROJECT_RATE = float(os.getenv('CALENDAR_PROJECT_RATE', 50))
+PROJECT_BURST = float(os.getenv('CALENDAR_PROJECT_BURST', 100))
+GUILD_RATE = float(os.getenv('CALENDAR_GUILD_RATE', 5))
+GUILD_BURST = float(os.getenv('CALENDAR_GUILD_BURST', 20))
+MAX_RETRIES = int(os.getenv('CALENDAR_MAX_RETRIES', 5))
+BACKOFF_BASE = float(os.getenv('CALENDAR_BACKOFF_BASE', 1))
+BACKOFF_MAX = float(os.getenv('CALENDAR_BACKOFF_MAX', 64))
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+MAX_GUILD_BUCKETS = 1024
+
+logger = logging.getLogger('discord.ratelimit')
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float):
+        """ initializes a full bucket
+
+        Args:
+            rate (float): the number of tokens added per second
+            capacity (float): the maximum number of tokens, the size of the bursts the bucket lets through
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, cost: float = 1) -> float:
+        """takes tokens from the bucket, the bucket goes into debt if it does not have enough so callers
+        are served in the order they arrived
+
+        Args:
+            cost (float): the number of tokens to take
+
+        Returns:
+            float: the seconds to wait before the tokens may be used
+        """
+        now = time.monotonic()
+        self.refill(now)
+        self.tokens -= cost
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.paused_until - now)
+
+    def pause(self, seconds: float):
+        """holds back every caller of the bucket, used when google reports the quota was exceeded
+
+        Args:
+            seconds (float): the number of seconds to pause for
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        """Returns:
+            bool: if the bucket is full and not paused, an idle bucket can be dropped
+        """
+        now = time.monotonic()
+        self.refill(now)
+        return self.tokens >= self.capacity and self.paused_until <= now
+
+
+def error_reasons(error: HttpError) -> set[str]:
+    """Returns:
+        set[str]: the reasons google gave for a failed request, like rateLimitExceeded
+    """
+    details = error.error_details if isinstance(error.error_details, list) else []
+    return {detail.get('reason') for detail in details if isinstance(detail, dict)}
+
+
+def is_retryable(error: Exception) -> bool:
+    """Returns:
+        bool: if a failed request may succeed when it is sent again, google asks for retries of
+            429, 5xx and 403 rate limit errors
+    """
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    return status == 429 or status >= 500 or (status == 403 and bool(error_reasons(error) & set(RATE_LIMIT_REASONS)))
+
+
+def retry_after(error: HttpError) -> float | None:
+    """reads the Retry-After header of a failed request
+
+    Returns:
+        float | None: the seconds google asked to wait, None if it did not say
+    """
+    value = error.resp.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+
+    def __init__(self, project_rate: float = PROJECT_RATE, project_burst: float = PROJECT_BURST,
+                 guild_rate: float = GUILD_RATE, guild_burst: float = GUILD_BURST, max_retries: int = MAX_RETRIES,
+                 backoff_base: float = BACKOFF_BASE, backoff_max: float = BACKOFF_MAX):
+        """ initializes the limits of the outbound google calendar traffic, every request takes a token from
+        the bucket of its guild and then from the bucket of the google project, so a busy guild slows down
+        before it uses up the quota of every other guild
+
+        Args:
+            project_rate (float): requests per second allowed for the whole google project
+            project_burst (float): the burst size of the project bucket
+            guild_rate (float): requests per second allowed for a single guild
+            guild_burst (float): the burst size of the guild buckets
+            max_retries (int): the number of times a throttled or failed request is sent again
+            backoff_base (float): the seconds to wait before the first retry, doubled on every retry
+            backoff_max (float): the longest wait between retries
+        """
+        self.project = TokenBucket(project_rate, project_burst)
+        self.guild_rate = guild_rate
+        self.guild_burst = guild_burst
+        self.guilds = {}
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.requests = 0
+        self.throttled = 0
+        self.throttle_seconds = 0.0
+        self.retries = 0
+        self.rate_limited = 0
+        self.gave_up = 0
+
+    def guild_bucket(self, guild_id) -> TokenBucket:
+        bucket = self.guilds.get(str(guild_id))
+        if bucket is None:
+            if len(self.guilds) >= MAX_GUILD_BUCKETS:
+                self.guilds = {key: value for key, value in self.guilds.items() if not value.idle()}
+            bucket = self.guilds[str(guild_id)] = TokenBucket(self.guild_rate, self.guild_burst)
+        return bucket
+
+    async def acquire(self, guild_id=None, cost: float = 1) -> float:
+        """waits until a request may be sent
+
+        Args:
+            guild_id: the id of the guild the request is sent for, None for requests that only count
+                against the project
+            cost (float): the number of google requests, a batch counts every request in it
+
+        Returns:
+            float: the seconds spent waiting
+        """
+        self.requests += 1
+        waited = 0.0
+        buckets = [self.project] if guild_id is None else [self.guild_bucket(guild_id), self.project]
+        for bucket in buckets:
+            # the project token is only taken once the guild may send, waiting guilds do not hold back others
+            wait = bucket.reserve(cost)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                waited += wait
+        if waited > 0:
+            self.throttled += 1
+            self.throttle_seconds += waited
+        return waited
+
+    def backoff(self, attempt: int, error: HttpError | None = None) -> float:
+        """gets the seconds to wait before a retry, exponential with full jitter and never shorter than
+        the Retry-After google sent
+
+        Args:
+            attempt (int): the number of retries made so far
+            error (HttpError | None): the error of the failed request
+
+        Returns:
+            float: the seconds to wait
+        """
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        after = retry_after(error) if error is not None else None
+        return max(delay, after) if after is not None else delay
+
+    def should_retry(self, guild_id, attempt: int, error: Exception) -> float | None:
+        """decides if a failed request is sent again
+
+        Args:
+            guild_id: the id of the guild the request was sent for
+            attempt (int): the number of retries made so far
+            error (Exception): the error of the request
+
+        Returns:
+            float | None: the seconds to wait before the retry, None if the error has to be raised
+        """
+        if not is_retryable(error):
+            return None
+        if attempt >= self.max_retries:
+            self.gave_up += 1
+            return None
+        delay = self.backoff(attempt, error)
+        if error.resp.status in (403, 429):
+            # the quota of the guild's account ran out, hold back its other requests as well
+            self.rate_limited += 1
+            if guild_id is not None:
+                self.guild_bucket(guild_id).pause(delay)
+        self.retries += 1
+        logger.warning(f'google calendar request for guild {guild_id} failed with {error.resp.status}, '
+                       f'retry {attempt + 1} in {delay:.2f}s')
+        return delay
+
+    def stats(self) -> dict:
+        """Returns:
+            dict: the throttle and retry counters
+        """
+        return {
+            'requests': self.requests,
+            'throttled': self.throttled,
+            'throttle_seconds': self.throttle_seconds,
+            'retries': self.retries,
+            'rate_limited': self.rate_limited,
+            'gave_up': self.gave_up,
+            'guilds': len(self.guilds),
+        }
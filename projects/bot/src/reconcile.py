@@ -0,0 +1,217 @@
+from datetime import datetime, timezone
+import asyncio
+import logging
+import os
+import time
+
+from googleapiclient.errors import HttpError
+
+from calendar_service import event_body, GUILD_PROPERTY, HASH_PROPERTY
+
+RECONCILE_CONCURRENCY = int(os.getenv('RECONCILE_CONCURRENCY', 4))
+RECONCILE_BATCH_SIZE = 50
+
+logger = logging.getLogger('discord.reconcile')
+
+
+class Reconciler:
+
+    def __init__(self, executor, mirror=None, on_reconciled=None, concurrency: int = RECONCILE_CONCURRENCY,
+                 batch_size: int = RECONCILE_BATCH_SIZE):
+        """ initializes the reconciliation of discord scheduled events with the google events the bot created,
+        it catches up on changes that happened while the bot was not connected
+
+        Args:
+            executor (CalendarExecutor): the executor google calendar requests run on
+            mirror (EventMirror | None): the mirror to keep up to date with the applied changes
+            on_reconciled (Callable[[str, set[str], float], Awaitable] | None): called with the guild id, the ids of
+                the events whose google event now matches discord and the time the discord events were loaded at,
+                syncs of those events recorded before that are made obsolete by the reconcile
+            concurrency (int): the maximum number of guilds reconciled at once
+            batch_size (int): the number of changes sent in a single google batch request
+        """
+        self.executor = executor
+        self.mirror = mirror
+        self.on_reconciled = on_reconciled
+        self.batch_size = batch_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.last_run = None
+
+    async def list_owned(self, service, guild_id: str) -> dict[str, dict]:
+        """lists the upcoming google events the bot created for a guild, events that already ended are left
+        out since they are no longer scheduled in discord
+
+        Args:
+            service (googleapiclient.discovery.Resource): the google calendar service of the guild
+            guild_id (str): the id of the guild
+
+        Returns:
+            dict[str, dict]: event ids mapped to their id, status and extended properties
+        """
+        google_events = {}
+        page_token = None
+        now = datetime.now(timezone.utc).isoformat()
+        while True:
+            response = await self.executor.execute(service.events().list(
+                calendarId='primary', privateExtendedProperty=f'{GUILD_PROPERTY}={guild_id}', timeMin=now,
+                showDeleted=True, maxResults=2500, pageToken=page_token,
+                fields='items(id,status,extendedProperties),nextPageToken'), guild_id=guild_id)
+            for item in response.get('items', []):
+                google_events[item['id']] = item
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return google_events
+
+    def diff(self, events: list, google_events: dict[str, dict]) -> tuple[list[dict], list[dict], list[str]]:
+        """finds the minimal set of changes that makes the google events match the discord events
+
+        Args:
+            events (list[discord.ScheduledEvent]): the scheduled events of the guild
+            google_events (dict[str, dict]): the google events from list_owned
+
+        Returns:
+            tuple: the bodies of the events to create, the bodies of the events to update and the ids of the events to delete
+        """
+        creates = []
+        updates = []
+        for event in events:
+            body = event_body(event)
+            existing = google_events.get(body['id'])
+            if existing is None:
+                creates.append(body)
+                continue
+            stored_hash = existing.get('extendedProperties', {}).get('private', {}).get(HASH_PROPERTY)
+            if existing.get('status') == 'cancelled' or stored_hash != body['extendedProperties']['private'][HASH_PROPERTY]:
+                updates.append(body)
+
+        event_ids = {str(event.id) for event in events}
+        deletes = [event_id for event_id, item in google_events.items()
+                   if event_id not in event_ids and item.get('status') != 'cancelled']
+        return creates, updates, deletes
+
+    @staticmethod
+    def patch_request(service, body: dict):
+        # patch keeps the attendees, status brings back events that were deleted in google
+        patch = {key: value for key, value in body.items() if key not in ('calendarId', 'id')}
+        patch['status'] = 'confirmed'
+        return service.events().patch(calendarId='primary', eventId=body['id'], body=patch)
+
+    async def send(self, service, guild_id: str, requests: list[tuple], callback):
+        for i in range(0, len(requests), self.batch_size):
+            chunk = requests[i:i + self.batch_size]
+            batch = service.new_batch_http_request(callback=callback)
+            for request_id, request in chunk:
+                batch.add(request, request_id=request_id)
+            await self.executor.execute(batch, transport=chunk[0][1].http, guild_id=guild_id, cost=len(chunk))
+
+    async def apply(self, service, guild_id: str, creates: list[dict], updates: list[dict],
+                    deletes: list[str]) -> dict[str, str]:
+        """applies the changes with google batch requests. a create that conflicts with an existing event is
+        sent again as a patch, events synced before the guild property existed are not listed by list_owned
+        and the patch adds the property so the next pass finds them
+
+        Returns:
+            dict[str, str]: the request ids of the changes that failed mapped to their error
+        """
+        requests = []
+        for body in creates:
+            requests.append((f'create:{body["id"]}', service.events().insert(calendarId='primary', body=body)))
+        for body in updates:
+            requests.append((f'update:{body["id"]}', self.patch_request(service, body)))
+        for event_id in deletes:
+            requests.append((f'delete:{event_id}', service.events().delete(calendarId='primary', eventId=event_id)))
+
+        failed = {}
+        conflicts = []
+
+        def callback(request_id, response, exception):
+            kind, event_id = request_id.split(':', 1)
+            if exception is not None:
+                status = exception.resp.status if isinstance(exception, HttpError) else None
+                if kind == 'delete' and status in (404, 410):
+                    return
+                if kind == 'create' and status == 409:
+                    conflicts.append(event_id)
+                    return
+                failed[request_id] = str(exception)
+            elif self.mirror is not None:
+                if kind == 'delete':
+                    self.mirror.forget(guild_id, event_id)
+                else:
+                    self.mirror.store(guild_id, response)
+
+        await self.send(service, guild_id, requests, callback)
+        if conflicts:
+            bodies = {body['id']: body for body in creates}
+            await self.send(service, guild_id, [(f'adopt:{event_id}', self.patch_request(service, bodies[event_id]))
+                                                for event_id in conflicts], callback)
+        return failed
+
+    async def reconcile(self, guild_id, service, events: list, loaded_at: float | None = None):
+        """brings the google events of a guild in line with its discord scheduled events
+
+        Args:
+            guild_id: the id of the guild
+            service (googleapiclient.discovery.Resource): the google calendar service of the guild
+            events (list[discord.ScheduledEvent]): the scheduled events of the guild
+            loaded_at (float | None): the time.time() the events were loaded at, on_reconciled is only called
+                when it is given
+
+        Returns:
+            tuple: tuple[bool, dict] True and a summary of the applied changes, None and the summary if changes failed
+        """
+        guild_id = str(guild_id)
+        start = time.perf_counter()
+        google_events = await self.list_owned(service, guild_id)
+        creates, updates, deletes = self.diff(events, google_events)
+        failed = await self.apply(service, guild_id, creates, updates, deletes)
+        if self.on_reconciled is not None and loaded_at is not None:
+            failed_ids = {request_id.split(':', 1)[1] for request_id in failed}
+            reconciled = ({str(event.id) for event in events} | set(google_events)) - failed_ids
+            await self.on_reconciled(guild_id, reconciled, loaded_at)
+        summary = {
+            'guild_id': guild_id,
+            'created': len(creates),
+            'updated': len(updates),
+            'deleted': len(deletes),
+            'unchanged': len(events) - len(creates) - len(updates),
+            'failed': len(failed),
+            'seconds': time.perf_counter() - start,
+        }
+        for request_id, error in failed.items():
+            logger.warning(f'reconcile {request_id} failed in guild {guild_id}: {error}')
+        return (None if failed else True, summary)
+
+    async def reconcile_guild(self, guild_id: str, load):
+        async with self.semaphore:
+            try:
+                loaded_at = time.time()
+                service, events = await load()
+                return await self.reconcile(guild_id, service, events, loaded_at)
+            except Exception as e:
+                logger.exception(f'reconcile failed for guild {guild_id}')
+                return (None, {'guild_id': str(guild_id), 'error': str(e)})
+
+    async def reconcile_all(self, guilds: dict) -> dict:
+        """reconciles several guilds concurrently, at most `concurrency` at a time
+
+        Args:
+            guilds (dict[str, Callable[[], Awaitable[tuple[Resource, list[discord.ScheduledEvent]]]]]): guild ids
+                mapped to a coroutine function that loads the calendar service and scheduled events of the guild
+
+        Returns:
+            dict: the totals of the pass, the time it took and the summary of every guild
+        """
+        start = time.perf_counter()
+        results = await asyncio.gather(*(self.reconcile_guild(guild_id, load) for guild_id, load in guilds.items()))
+        summaries = [result[1] for result in results]
+        self.last_run = {
+            'guilds': len(results),
+            'failed_guilds': sum(1 for result in results if result[0] is None),
+            'created': sum(summary.get('created', 0) for summary in summaries),
+            'updated': sum(summary.get('updated', 0) for summary in summaries),
+            'deleted': sum(summary.get('deleted', 0) for summary in summaries),
+            'seconds': time.perf_counter() - start,
+            'summaries': summaries,
+        }
+        return self.last_run
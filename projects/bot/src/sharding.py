@@ -0,0 +1,76 @@
+import os
+
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0)) or None
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', 0))
+SHARD_PROCESSES = int(os.getenv('SHARD_PROCESSES', 1))
+
+
+def shard_id(guild_id, shard_count: int) -> int:
+    """gets the gateway shard discord sends the events of a guild to
+
+    Args:
+        guild_id: the id of the guild
+        shard_count (int): the total number of shards
+
+    Returns:
+        int: the id of the shard
+    """
+    return (int(guild_id) >> 22) % shard_count
+
+
+def process_shard_ids(index: int, processes: int, shard_count: int) -> list[int]:
+    """deals the shards out to the processes round robin, with a shard count that is a multiple of the number
+    of processes the process of a guild is then its shard id for a shard count of `processes`
+
+    Args:
+        index (int): the index of the process
+        processes (int): the number of processes
+        shard_count (int): the total number of shards
+
+    Returns:
+        list[int]: the ids of the shards the process connects
+    """
+    return list(range(index, shard_count, processes))
+
+
+def owner_process(guild_id, processes: int) -> int:
+    """Returns:
+        int: the index of the process that serves a guild
+    """
+    return shard_id(guild_id, processes)
+
+
+def owns(guild_id) -> bool:
+    """Returns:
+        bool: if this process serves a guild
+    """
+    return SHARD_PROCESSES == 1 or owner_process(guild_id, SHARD_PROCESSES) == SHARD_INDEX
+
+
+def shard_file(path: str) -> str:
+    """names a local state file after the process so processes sharing a directory do not overwrite
+    each other's files
+
+    Args:
+        path (str): the path of the file
+
+    Returns:
+        str: the path with the process index before the extension, unchanged with a single process
+    """
+    if SHARD_PROCESSES == 1:
+        return path
+    root, extension = os.path.splitext(path)
+    return f'{root}.{SHARD_INDEX}{extension}'
+
+
+def bot_shard_options() -> dict:
+    """Returns:
+        dict: the shard_count and shard_ids arguments for AutoShardedBot, empty to let discord pick the
+            shard count when one process runs every shard
+    """
+    if SHARD_COUNT is None and SHARD_PROCESSES == 1:
+        return {}
+    shard_count = SHARD_COUNT or SHARD_PROCESSES
+    if shard_count % SHARD_PROCESSES != 0:
+        raise ValueError(f'SHARD_COUNT {shard_count} has to be a multiple of SHARD_PROCESSES {SHARD_PROCESSES}')
+    return {'shard_count': shard_count, 'shard_ids': process_shard_ids(SHARD_INDEX, SHARD_PROCESSES, shard_count)}
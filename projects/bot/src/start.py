@@ -6,13 +6,30 @@ import asyncio
 from logging.handlers import RotatingFileHandler
 from termcolor import colored, cprint
 import googleauth
+from calendar_service import CalendarServiceCache, CalendarExecutor, event_body, refreshed_info
+from backfill import Backfiller, BACKFILL_FILE
+from event_mirror import EventMirror
+from sync_queue import EventSyncQueue, AttendeeBuffer, CREATE, UPDATE, DELETE, ATTENDEE, BATCH_SIZE_BUCKETS
+from outbox import Outbox, OutboxStore
+from internal_server import InternalServer
+from token_refresher import TokenRefresher
+from reconcile import Reconciler
+from change_feed import ChangeFeed, discord_changes, CHANGE_FEED_FILE
+from sharding import SHARD_INDEX, SHARD_PROCESSES, bot_shard_options, owns, shard_file
+from telemetry import (registry, event_handler_latency, sync_latency, handle_metrics, METRICS_PATH, METRICS_HOST,
+                       METRICS_PORT)
+from aiohttp import web
+from google.oauth2.credentials import Credentials
+import google_auth_httplib2
+import httplib2
 
 intents = discord.Intents.default()
 intents.message_content = True
 global google_auth
+# set in on_ready
+google_auth = None
 
-from googleapiclient.discovery import build, MutualTLSChannelError
-from google.oauth2.credentials import Credentials
+from googleapiclient.errors import HttpError
 
 
 # setup logging
@@ -27,7 +44,7 @@ logger.setLevel(logging.DEBUG)
 logging.getLogger('discord.http').setLevel(logging.INFO)
 
 handler = RotatingFileHandler(
-    filename='discord.log',
+    filename=shard_file('discord.log'),
     encoding='utf-8',
     maxBytes=32 * 1024 * 1024,
     backupCount=5,
@@ -41,12 +58,13 @@ formatter = logging.Formatter('[{asctime}] [{levelname:<8}] {name}: {message}',
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
-async def create_calendar_event(service, event: discord.ScheduledEvent):
+async def create_calendar_event(service, guild_id: str, event_details: dict):
     """Creates a google calendar event from a discord scheduled event
 
     Args:
         service (googleapiclient.discovery.Resource): the google calendar service
-        event (discord.ScheduledEvent): the discord scheduled event to convert to a google calendar event
+        guild_id (str): the id of the guild the event belongs to
+        event_details (dict): the google calendar event body of the discord scheduled event, from event_body
 
     Returns:
         result (Tuple[bool, Error or str]): a tuple of a boolean and an error object or None if unsuccessful, true if successful, 
@@ -54,69 +72,47 @@ async def create_calendar_event(service, event: discord.ScheduledEvent):
     """
     try:
         result = (False, None)
-        event_details = {
-            "calendarId": "primary",
-            "id": event.id,
-            "summary": event.name,
-            "location": event.location,
-            "description": event.description,
-            "start": {
-                "dateTime": event.start_time.isoformat(),
-                "timeZone": "UTC",
-            },
-        }
-        if event.end_time is not None:
-            print(f'end time for event: {event.end_time.isoformat()}')
-            event_details["end"] = {
-                "dateTime": event.end_time.isoformat(),
-                "timeZone": "UTC",
-            }
-        else:
-            event_details["endTimeUnspecified"] = True
 
-        google_event = service.events().insert(calendarId="primary",
-                                               body=event_details).execute()
+        google_event = await calendar_executor.execute(
+            service.events().insert(calendarId="primary", body=event_details), guild_id=guild_id)
+        event_mirror.store(guild_id, google_event)
 
         if google_event.get("htmlLink") is not None:
             result = (True, google_event)
 
         return result
+    except HttpError as err:
+        if err.resp.status == 409:
+            # the event was created before and the sync is being replayed from the outbox
+            return (False, None)
+        return (None, str(err))
     except Exception as err:
         return (None, str(err))
 
-async def update_calendar_event(service, event: discord.ScheduledEvent):
+async def update_calendar_event(service, guild_id: str, event_id: str, event_details: dict):
     """Updates a google calendar event from a discord scheduled event
 
     Args: 
         service (googleapiclient.discovery.Resource): the google calendar service
-        event (discord.ScheduledEvent): the discord scheduled event to convert to a google calendar event
+        guild_id (str): the id of the guild the event belongs to
+        event_id (str): the id of the discord scheduled event
+        event_details (dict): the google calendar event body of the discord scheduled event, from event_body
     
     returns:
         result (Tuple[bool, Error or None]): a tuple of a boolean and an error object or None if successful
     """
     try:
         result = (False, None)
-        event_details = {
-            "calendarId": "primary",
-            "id": event.id,
-            "summary": event.name,
-            "location": event.location,
-            "description": event.description,
-            "start": {
-                "dateTime": event.start_time.isoformat(),
-                "timeZone": "UTC",
-            },
-        }
-        if event.end_time is not None:
-            print(f'end time for event: {event.end_time.isoformat()}')
-            event_details["end"] = {
-                "dateTime": event.end_time.isoformat(),
-                "timeZone": "UTC",
-            }
-        else:
-            event_details["endTimeUnspecified"] = True
+        event_details = dict(event_details)
+        if "end" in event_details:
+            # patch keeps the fields it is not sent, an end time set later has to clear the unspecified end
+            event_details["endTimeUnspecified"] = False
 
-        google_event = service.events().update(calendarId="primary", eventId=str(event.id), body=event_details).execute()
+        # patch only replaces the content fields, the attendees are left to update_calendar_event_attendees
+        google_event = await calendar_executor.execute(
+            service.events().patch(calendarId="primary", eventId=str(event_id), body=event_details),
+            guild_id=guild_id)
+        event_mirror.store(guild_id, google_event)
 
         if google_event.get("htmlLink") is not None:
             result = (True, google_event) 
@@ -125,89 +121,454 @@ async def update_calendar_event(service, event: discord.ScheduledEvent):
     except Exception as err:
         return (None, str(err))
 
-async def add_user_to_calendar_event(service, event: discord.ScheduledEvent,
-                                     member_id: str):
-    """Adds a user to a google calendar event
+async def update_calendar_event_attendees(service, guild_id: str, event_id: str,
+                                         changes: dict[str, bool]):
+    """Adds and removes users from a google calendar event with a single request
 
     Args:
         service (googleapiclient.discovery.Resource): the google calendar service
-        event (discord.ScheduledEvent): the discord scheduled event to convert to a google calendar event
-        email (str): the email of the user to add to the event
-    
+        guild_id (str): the id of the guild the event belongs to
+        event_id (str): the id of the discord scheduled event
+        changes (dict[str, bool]): member ids mapped to True to add or False to remove the member
+
     Returns:
         result (Tuple[bool, Error or None]): a tuple of a boolean and an error object or None if successful
     """
     try:
-        user_emails = await google_auth.get_user_emails(event.guild.id)
-        if user_emails is None:
+        user_emails = await google_auth.get_user_emails(guild_id)
+        if user_emails[0] is None:
             return user_emails
-        member_email = user_emails[0].get(member_id)    
-        if member_email is None:
-            return (None, 'User has not added their email to the bot')
-
-        cal_event = service.events().get(calendarId='primary', eventId=str(event.id)).execute()
-        cal_event['attendees'].append({'email': member_email})
-
-        updated_cal_event = service.events().update(calendarId='primary', eventId=cal_event['id'], body=cal_event).execute()
+        added = {user_emails[0][member_id] for member_id, add in changes.items() if add and member_id in user_emails[0]}
+        removed = {user_emails[0][member_id] for member_id, add in changes.items() if not add and member_id in user_emails[0]}
+        if not added and not removed:
+            return (None, 'Users have not added their email to the bot')
+
+        def apply_changes(attendees):
+            attendees = [attendee for attendee in attendees if attendee['email'] not in removed]
+            known = {attendee['email'] for attendee in attendees}
+            return attendees + [{'email': email} for email in added if email not in known]
+
+        updated_cal_event = await event_mirror.patch_attendees(
+            calendar_executor, service, guild_id, event_id, apply_changes)
         if updated_cal_event.get("htmlLink") is None:
-            return (None, 'Failed to add user to calendar event')
-        return (True, updated_cal_event)    
+            return (None, 'Failed to update users of calendar event')
+        return (True, updated_cal_event)
     except Exception as e:
         return (None, str(e))
 
-async def remove_user_from_calendar_event(service,
-                                          event: discord.ScheduledEvent,
-                                          member_id: str):
-    """Removes a user from a google calendar event
+async def sync_attendees(guild_id: str, event_id: str, payload: dict):
+    """Applies the batched attendee changes of an event to the google calendar, runs from the outbox
 
     Args:
-        service (googleapiclient.discovery.Resource): the google calendar service
-        event (discord.ScheduledEvent): the discord scheduled event to convert to a google calendar event
-        email (str): the email of the user to add to the event
+        guild_id (str): the id of the guild the event belongs to
+        event_id (str): the id of the discord scheduled event
+        payload (dict): the member ids of the changes mapped to True for added or False for removed members
 
     Returns:
-        result (Tuple[bool, Error or None]): a tuple of a boolean and an error object or None if successful
+        result (Tuple[bool, Error or None]): the result of the update, None and an error if it has to be retried
     """
-    try:
-        cal_event = service.events().get(calendarId='primary', eventId=str(event.id)).execute()
-        guild_users = await google_auth.get_user_emails(event.guild.id)
-        if guild_users[0] is None:
-            return guild_users
-        member_email = guild_users[0].get(member_id)
-        if member_email is None:
-            return (None, 'User has not added their email to the bot')
-
-        cal_event['attendees'] = [attendee for attendee in cal_event['attendees'] if attendee['email']!= member_email]
-
-        updated_cal_event = service.events().update(calendarId='primary', eventId=cal_event['id'], body=cal_event).execute()
-        if updated_cal_event.get("htmlLink") is None:
-            return (None, 'Failed to remove user from calendar event')
-        return (True, updated_cal_event)
-    except Exception as e:
-        return (None, str(e))
-
-async def delete_calendar_event(service, event: discord.ScheduledEvent):
+    changes = payload['changes']
+    service = await get_guild_service(guild_id)
+    if service is None:
+        print_log(f'No credentials found for guild {guild_id}')
+        return (False, None)
+    result = await update_calendar_event_attendees(service, guild_id, event_id, changes)
+    if result[0] is True:
+        print_log(
+            f'{len(changes)} attendee changes applied to event {event_id} in calendar with url {result[1]["htmlLink"]}'
+        )
+        return result
+    print_log(
+        f'{len(changes)} attendee changes failed for event {event_id} in calendar with error {result[1]}'
+    )
+    # users without an email are not an error worth retrying
+    return (False, result[1]) if result[1] == 'Users have not added their email to the bot' else result
+
+async def buffer_attendee_change(guild_id, event_id, member_id, added: bool):
+    # the change is saved to the outbox before it is buffered, a crash before the flush does not lose it
+    await outbox.buffer_attendee_change(guild_id, event_id, member_id, added, attendee_buffer.window)
+    attendee_buffer.record(guild_id, event_id, member_id, added)
+
+async def flush_attendee_changes(guild_id: str, event_id: str, changes: dict[str, bool]):
+    # the outbox netted the same changes as they were buffered, its open attendee sync is what runs
+    await outbox.flush_attendee_changes(guild_id, event_id)
+
+async def delete_calendar_event(service, guild_id: str, event_id: str):
     """Deletes a google calendar event
 
     Args:
         service (googleapiclient.discovery.Resource): the google calendar service
-        event (discord.ScheduledEvent): the discord scheduled event to convert to a google calendar event
+        guild_id (str): the id of the guild the event belongs to
+        event_id (str): the id of the discord scheduled event
 
     Returns:
         result (Tuple[bool, Error or None]): a tuple of a boolean and an error object or None if successful
     """
     try:
-        service.events().delete(calendarId='primary', eventId=str(event.id)).execute()
+        await calendar_executor.execute(
+            service.events().delete(calendarId='primary', eventId=str(event_id)), guild_id=guild_id)
+        event_mirror.forget(guild_id, event_id)
         return (True, None)
+    except HttpError as err:
+        if err.resp.status in (404, 410):
+            # already deleted, the sync is being replayed from the outbox
+            event_mirror.forget(guild_id, event_id)
+            return (False, None)
+        return (None, str(err))
     except Exception as e:
         return (None, str(e))
 
+async def sync_created_event(guild_id: str, event_id: str, payload: dict):
+    """Creates the google calendar event of a discord scheduled event, runs from the outbox
+
+    Args:
+        guild_id (str): the id of the guild the event belongs to
+        event_id (str): the id of the discord scheduled event
+        payload (dict): the google calendar event body
+
+    Returns:
+        result (Tuple[bool, Error or None]): the result of the create, None and an error if it has to be retried
+    """
+    name = payload['body']['summary']
+    service = await get_guild_service(guild_id)
+    if service is None:
+        print_log(f'No credentials found for guild {guild_id}')
+        return (False, None)
+    result = await create_calendar_event(service, guild_id, payload['body'])
+    if result[0] is True:
+        print_log(
+            f'Event {name} : {event_id} added to calendar with url {result[1]["htmlLink"]} and id {result[1]["id"]}'
+        )
+    elif result[1] is not None:
+        print_log(
+            f'Event {name} : {event_id} failed to add to calendar with error {result[1]}'
+        )
+    return result
+
+async def sync_updated_event(guild_id: str, event_id: str, payload: dict):
+    """Updates the google calendar event of a discord scheduled event, runs from the outbox
+
+    Args:
+        guild_id (str): the id of the guild the event belongs to
+        event_id (str): the id of the discord scheduled event
+        payload (dict): the google calendar event body
+
+    Returns:
+        result (Tuple[bool, Error or None]): the result of the update, None and an error if it has to be retried
+    """
+    name = payload['body']['summary']
+    service = await get_guild_service(guild_id)
+    if service is None:
+        print_log(f'No credentials found for guild {guild_id}')
+        return (False, None)
+    result = await update_calendar_event(service, guild_id, event_id, payload['body'])
+    if result[0] is True:
+        print_log(
+            f'Event {name} : {event_id} updated in calendar with url {result[1]["htmlLink"]} and id {result[1]["id"]}'
+        )
+    elif result[1] is not None:
+        print_log(
+            f'Event {name} : {event_id} failed to update in calendar with error {result[1]}'
+        )
+    return result
+
+async def sync_deleted_event(guild_id: str, event_id: str, payload: dict):
+    """Deletes the google calendar event of a discord scheduled event, runs from the outbox
+
+    Args:
+        guild_id (str): the id of the guild the event belongs to
+        event_id (str): the id of the discord scheduled event
+        payload (dict): the name of the event
+
+    Returns:
+        result (Tuple[bool, Error or None]): the result of the delete, None and an error if it has to be retried
+    """
+    service = await get_guild_service(guild_id)
+    if service is None:
+        print_log(f'No credentials found for guild {guild_id}')
+        return (False, None)
+    result = await delete_calendar_event(service, guild_id, event_id)
+    if result[0] is True:
+        print_log(
+            f'Event {payload["name"]} : {event_id} deleted from calendar'
+        )
+    elif result[1] is not None:
+        print_log(
+            f'Event {payload["name"]} : {event_id} failed to delete from calendar with error {result[1]}'
+        )
+    return result
+
 def print_log(message: str):
     cprint('===============================================================================================', 'cyan')
     cprint(message, 'yellow')
     cprint('===============================================================================================', 'cyan')
 
-bot = commands.Bot(command_prefix='/', intents=intents)
+async def backfill_guild(guild: discord.Guild, progress=None):
+    """Pushes the existing scheduled events of a guild to its linked google calendar
+
+    Args:
+        guild (discord.Guild): the guild to backfill
+        progress (Callable[[int, int], Awaitable] | None): called with (done, total) after every batch
+
+    Returns:
+        result (Tuple[bool, str]): a tuple of a boolean and a summary of the backfill
+    """
+    credentials_dict = await google_auth.get_linked_credentials(str(guild.id))
+    if credentials_dict is None:
+        return (None, f'No credentials found for guild {guild.name}')
+    events = await guild.fetch_scheduled_events()
+    service = calendar_services.get_service(str(guild.id), credentials_dict)
+    result = await backfiller.backfill(guild.id, service, events, progress=progress)
+    print_log(f'Backfill for guild {guild.name} finished: {result[1]}')
+    return result
+
+async def save_refreshed_credentials(guild_id: str, changes: dict):
+    result = await google_auth.update_credentials(guild_id, changes)
+    if result[0] is None:
+        print_log(f'Failed to save refreshed credentials of guild {guild_id}: {result[1]}')
+
+def on_credentials_refreshed(guild_id: str, changes: dict):
+    asyncio.create_task(save_refreshed_credentials(guild_id, changes), name=f'save_credentials_{guild_id}')
+    if changes.get('expiry') is not None:
+        token_refresher.schedule(guild_id, changes['expiry'])
+
+async def refresh_guild_credentials(guild_id: str):
+    """Refreshes the access token of a linked guild ahead of its expiry and saves the new token
+
+    Args: guild_id (str): the id of the guild
+
+    Returns:
+        datetime | None: the expiry of the new token, None if the guild is no longer linked
+    """
+    credentials_dict = await google_auth.get_linked_credentials(guild_id)
+    if credentials_dict is None:
+        return None
+    # a credentials object of its own, the cached one is shared with requests running in the executor threads
+    credentials = Credentials.from_authorized_user_info(credentials_dict)
+    await asyncio.to_thread(credentials.refresh, google_auth_httplib2.Request(httplib2.Http()))
+    await save_refreshed_credentials(guild_id, refreshed_info(credentials))
+    calendar_services.update_credentials(guild_id, credentials)
+    return credentials.expiry
+
+async def unlink_guild(guild_id: str):
+    result = await google_auth.unlink(guild_id)
+    print_log(f'Refresh token of guild {guild_id} was revoked: {result[1]}')
+
+async def reconcile_guilds():
+    """Catches the google calendars of every linked guild up on the scheduled event changes missed while
+    the bot was disconnected
+    """
+    guilds = {}
+    for guild in bot.guilds:
+        credentials_dict = google_auth.linked.get(str(guild.id))
+        if credentials_dict is None:
+            continue
+        async def load(guild=guild, credentials_dict=credentials_dict):
+            service = calendar_services.get_service(str(guild.id), credentials_dict)
+            events = await guild.fetch_scheduled_events()
+            # events the change feed just cancelled are deleted in google and have to stay deleted
+            return (service, [event for event in events if event.status in (discord.EventStatus.scheduled,
+                                                                             discord.EventStatus.active)])
+        guilds[str(guild.id)] = load
+    result = await reconciler.reconcile_all(guilds)
+    print_log(
+        f'Reconciled {result["guilds"]} guilds in {result["seconds"]:.2f}s: {result["created"]} created, '
+        f'{result["updated"]} updated, {result["deleted"]} deleted, {result["failed_guilds"]} guilds failed'
+    )
+
+async def supersede_reconciled_syncs(guild_id: str, event_ids: set[str], loaded_at: float):
+    # reconcile wrote the events as they were when they were loaded, a pending sync recorded before that would
+    # put an older version back when its retry comes up
+    superseded = await outbox.supersede_events(guild_id, event_ids, (CREATE, UPDATE, DELETE), loaded_at)
+    if superseded:
+        print_log(f'{superseded} pending syncs of guild {guild_id} superseded by reconcile')
+
+async def get_guild_service(guild_id: str):
+    credentials_dict = await google_auth.get_linked_credentials(str(guild_id))
+    if credentials_dict is None:
+        return None
+    return calendar_services.get_service(str(guild_id), credentials_dict)
+
+async def apply_calendar_changes(guild_id: str, google_events: list[dict]):
+    """Applies edits made in google calendar to the discord scheduled events the google events were created from
+
+    Args:
+        guild_id (str): the id of the guild
+        google_events (list[dict]): the google events that changed since the last pull
+    """
+    guild = bot.get_guild(int(guild_id))
+    if guild is None:
+        return
+    pending = await outbox.run_store(outbox.store.pending_events, guild_id, (CREATE, UPDATE))
+    for google_event in google_events:
+        if not google_event['id'].isdigit():
+            continue
+        event = guild.get_scheduled_event(int(google_event['id']))
+        if event is None:
+            continue
+        try:
+            if google_event.get('status') == 'cancelled':
+                if event.status == discord.EventStatus.scheduled:
+                    await event.cancel()
+                    print_log(f'Event {event.name} : {event.id} cancelled after it was deleted from calendar')
+                continue
+            if google_event['id'] in pending or event_mirror.is_own_write(guild_id, google_event):
+                # the bot wrote this version itself or a newer discord edit is about to replace it, applying it
+                # would revert the discord event to an older version
+                continue
+            changes = discord_changes(event, google_event)
+            if changes:
+                # the edit comes back as an update whose google event matches, which ends the round trip
+                await event.edit(**changes)
+                print_log(f'Event {event.name} : {event.id} updated from calendar: {", ".join(changes)}')
+        except discord.HTTPException as err:
+            print_log(f'Event {event.name} : {event.id} failed to update from calendar with error {err}')
+
+async def start_change_feed():
+    for guild_id in list(google_auth.linked):
+        try:
+            await change_feed.ensure(guild_id)
+        except Exception as err:
+            print_log(f'Failed to start the calendar change feed for guild {guild_id}: {err}')
+    change_feed.start()
+
+async def sync_on_ready():
+    # the change feed goes first, events deleted in google while the bot was offline are cancelled in discord
+    # before reconcile would patch them back to confirmed
+    await start_change_feed()
+    await reconcile_guilds()
+
+def on_guild_linked(guild_id: str):
+    # a new link may be another google account, its calendar gets every event again
+    backfiller.forget(guild_id)
+    credentials_dict = google_auth.linked.get(guild_id)
+    if credentials_dict is None:
+        token_refresher.unschedule(guild_id)
+        asyncio.create_task(change_feed.forget(guild_id), name=f'forget_changes_{guild_id}')
+        return
+    token_refresher.schedule(guild_id, credentials_dict.get('expiry'))
+    asyncio.create_task(change_feed.ensure(guild_id), name=f'watch_changes_{guild_id}')
+    guild = bot.get_guild(int(guild_id))
+    if guild is not None:
+        asyncio.create_task(backfill_guild(guild), name=f'backfill_{guild_id}')
+
+bot = commands.AutoShardedBot(command_prefix='/', intents=intents, **bot_shard_options())
+calendar_services = CalendarServiceCache(on_refresh=on_credentials_refreshed)
+calendar_executor = CalendarExecutor()
+sync_queue = EventSyncQueue(on_drop=lambda operation: outbox.drop(operation))
+outbox = Outbox(OutboxStore(), sync_queue, owns=owns, handlers={
+    CREATE: sync_latency.time(CREATE)(sync_created_event),
+    UPDATE: sync_latency.time(UPDATE)(sync_updated_event),
+    DELETE: sync_latency.time(DELETE)(sync_deleted_event),
+    ATTENDEE: sync_latency.time(ATTENDEE)(sync_attendees),
+})
+backfiller = Backfiller(calendar_executor, state_file=shard_file(BACKFILL_FILE))
+event_mirror = EventMirror()
+attendee_buffer = AttendeeBuffer(sync_queue, flush_attendee_changes)
+internal_server = InternalServer(api_key=os.getenv('API_KEY'))
+token_refresher = TokenRefresher(refresh_guild_credentials, unlink_guild)
+reconciler = Reconciler(calendar_executor, mirror=event_mirror, on_reconciled=supersede_reconciled_syncs)
+reconcile_task = None
+change_feed = ChangeFeed(calendar_executor, get_guild_service, apply_calendar_changes,
+                         push_url=os.getenv('CALENDAR_PUSH_URL'), secret=os.getenv('API_KEY'),
+                         state_file=shard_file(CHANGE_FEED_FILE))
+
+async def handle_linked(request: web.Request):
+    """Links a guild as soon as the api has stored its credentials
+
+    Args: request (aiohttp.web.Request): the notification sent by the api
+    """
+    guild_id = request.match_info['guild_id']
+    result = await google_auth.complete_sign_in(guild_id)
+    print_log(f'Sign in notification for guild {guild_id}: {result[1]}')
+    return web.json_response({'linked': result[0] is True, 'message': result[1]})
+
+internal_server.add_route('POST', '/linked/{guild_id}', handle_linked)
+
+async def handle_query_stats(request: web.Request):
+    if googleauth.query_profiler is None:
+        raise web.HTTPBadRequest(text='query profiling is disabled, set QUERY_PROFILING=true')
+    return web.json_response(googleauth.query_profiler.profile())
+
+internal_server.add_route('GET', '/stats/queries', handle_query_stats)
+
+async def handle_reconcile_stats(request: web.Request):
+    return web.json_response(reconciler.last_run)
+
+internal_server.add_route('GET', '/stats/reconcile', handle_reconcile_stats)
+
+async def handle_calendar_changes(request: web.Request):
+    """Pulls the calendar changes of a guild when the api forwards a google push notification
+
+    Args: request (aiohttp.web.Request): the notification forwarded by the api
+    """
+    change_feed.notify(request.match_info['guild_id'])
+    return web.json_response({'queued': True}, status=202)
+
+internal_server.add_route('POST', '/changes/{guild_id}', handle_calendar_changes)
+
+async def handle_change_feed_stats(request: web.Request):
+    return web.json_response(change_feed.stats())
+
+internal_server.add_route('GET', '/stats/changes', handle_change_feed_stats)
+
+async def handle_calendar_stats(request: web.Request):
+    return web.json_response(calendar_executor.limiter.stats())
+
+internal_server.add_route('GET', '/stats/calendar', handle_calendar_stats)
+
+async def handle_outbox_stats(request: web.Request):
+    counts = await outbox.run_store(outbox.store.counts)
+    return web.json_response({**outbox.stats(), 'entries': counts})
+
+internal_server.add_route('GET', '/stats/outbox', handle_outbox_stats)
+
+async def handle_shard_stats(request: web.Request):
+    return web.json_response({
+        'process': SHARD_INDEX,
+        'processes': SHARD_PROCESSES,
+        'shard_count': bot.shard_count,
+        'shard_ids': bot.shard_ids,
+        'guilds': len(bot.guilds),
+        'latencies': dict(bot.latencies),
+    })
+
+internal_server.add_route('GET', '/stats/shards', handle_shard_stats)
+
+# the counters kept by the components are read when the metrics are scraped
+registry.counter('bot_token_refreshes_total', 'proactive google token refreshes by result', labels=('result',),
+                 collect=lambda: {(result,): token_refresher.stats()[key] for result, key in
+                                  (('ok', 'refreshes'), ('failed', 'failures'), ('revoked', 'revoked'))})
+registry.histogram('bot_sign_in_poll_seconds', 'time a polling cycle over the active sign ins takes',
+                   collect=lambda: google_auth.poll_latency if google_auth is not None else {})
+registry.gauge('bot_active_sign_ins', 'sign ins waiting for credentials',
+               collect=lambda: len(google_auth.active_sign_ins) if google_auth is not None else 0)
+registry.gauge('bot_linked_guilds', 'guilds with linked google calendars',
+               collect=lambda: len(google_auth.linked) if google_auth is not None else 0)
+registry.gauge('bot_sync_queue_depth', 'calendar syncs waiting on the sync queue', collect=lambda: sync_queue.depth)
+registry.counter('bot_sync_queue_processed_total', 'calendar syncs run by the sync queue',
+                 collect=lambda: sync_queue.processed)
+registry.counter('bot_sync_queue_coalesced_total', 'calendar syncs dropped because a later sync of the event replaced them',
+                 collect=lambda: sync_queue.coalesced)
+registry.counter('bot_attendee_changes_received_total', 'attendee adds and removes buffered before a flush',
+                 collect=lambda: attendee_buffer.stats()['received'])
+registry.counter('bot_attendee_changes_applied_total', 'net attendee changes left after a flush netted them',
+                 collect=lambda: attendee_buffer.stats()['applied'])
+registry.counter('bot_attendee_flushes_total', 'attendee buffer flushes',
+                 collect=lambda: attendee_buffer.stats()['flushes'])
+registry.histogram('bot_attendee_batch_size', 'net attendee changes applied by a single flush',
+                   buckets=BATCH_SIZE_BUCKETS, collect=lambda: attendee_buffer.batch_sizes)
+registry.histogram('bot_attendee_flush_seconds', 'time from the first buffered attendee change to its applied flush',
+                   collect=lambda: attendee_buffer.flush_latency)
+registry.counter('bot_google_throttled_total', 'google calendar requests delayed by the rate limiter',
+                 collect=lambda: calendar_executor.limiter.stats()['throttled'])
+
+internal_server.add_route('GET', METRICS_PATH, handle_metrics)
+# a separate listener lets prometheus scrape without the api key, it only binds to METRICS_HOST
+metrics_server = None
+if METRICS_PORT is not None:
+    metrics_server = InternalServer(host=METRICS_HOST, port=METRICS_PORT)
+    metrics_server.add_route('GET', METRICS_PATH, handle_metrics, public=True)
 
 @bot.command()
 async def addEmail(ctx):
@@ -222,7 +583,7 @@ async def addEmail(ctx):
     try:
         msg = await bot.wait_for('message', check=check, timeout=60)
         print_log(f'addEmail command received email address {msg.content}')
-        result = google_auth.add_user_email(guild_id=ctx.guild.id, email=msg.content.strip(), user_id=str(ctx.author.id))
+        result = await google_auth.add_user_email(guild_id=str(ctx.guild.id), email=msg.content.strip(), member_id=str(ctx.author.id))
         if result[0]:
             await ctx.send(f'you will now recieve calendar invites for events in this guild to the google account associated with the given email')
             print_log(f'addEmail added email address for user {ctx.author} in guild {ctx.guild.id}')
@@ -235,15 +596,38 @@ async def addEmail(ctx):
 
 @bot.event
 async def on_ready():
-    global google_auth
+    global google_auth, reconcile_task
     print(colored('''
  ______   ______ _______ _______ _______ ______  _______  _____  __   _
  |     \\ |_____/    |    |______ |______ |_____] |______ |     | | \\  |
  |_____/ |    \\_ .  |    |______ |______ |_____] ______| |_____| |  \\_|
 ''', 'light_blue'))
     print(f'We have logged in as {colored(bot.user, 'light_magenta')}')
-    google_auth = googleauth.GoogeAuthConnect(api_prefix=os.getenv('API_PREFIX'))
+    google_auth = googleauth.GoogeAuthConnect(api_prefix=os.getenv('API_PREFIX'),
+                                              push_enabled=os.getenv('PUSH_LINKING', 'true').lower() == 'true',
+                                              async_db=os.getenv('ASYNC_DATABASE', 'true').lower() == 'true',
+                                              # several shard processes keep the link state in the database
+                                              shared_state=SHARD_PROCESSES > 1 or
+                                              os.getenv('SHARED_LINK_STATE', 'false').lower() == 'true',
+                                              owns=owns)
+    google_auth.add_link_listener(calendar_services.invalidate)
+    google_auth.add_link_listener(on_guild_linked)
     print(colored(f'google auth initialized', 'light_yellow'))
+    for guild_id, credentials_dict in google_auth.linked.items():
+        token_refresher.schedule(guild_id, credentials_dict.get('expiry'))
+    token_refresher.start()
+    # replays the syncs that were pending when the bot stopped
+    outbox.start()
+    if reconcile_task is None or reconcile_task.done():
+        reconcile_task = asyncio.create_task(sync_on_ready(), name='reconcile')
+    if not internal_server.running:
+        await internal_server.start()
+        print(colored(f'internal server listening on {internal_server.host}:{internal_server.port}', 'light_yellow'))
+        if internal_server.api_key is None:
+            print_log('API_KEY is not set, the internal server rejects every notification from the api')
+    if metrics_server is not None and not metrics_server.running:
+        await metrics_server.start()
+        print(colored(f'metrics served on {METRICS_HOST}:{metrics_server.port}{METRICS_PATH}', 'light_yellow'))
 
 
 @bot.command
@@ -261,7 +645,24 @@ async def login(ctx):
         return 
 
 
+@bot.command()
+async def backfill(ctx):
+    """Pushes the existing scheduled events of the guild to the linked google calendar
+
+    Args: ctx (discord.ext.commands.Context): the context of the command invocation
+    """
+    if ctx.guild and ctx.author.guild_permissions.administrator:
+        print_log(f'backfill command invoked by {ctx.author} in guild {ctx.guild.id}')
+
+        async def progress(done, total):
+            await ctx.send(f'backfilled {done} of {total} events')
+
+        result = await backfill_guild(ctx.guild, progress=progress)
+        await ctx.send(result[1])
+
+
 @bot.event
+@event_handler_latency.time('scheduled_event_create')
 async def on_scheduled_event_create(event):
     if event.guild:
         if event.creator_id == event.guild.owner_id or event.guild.get_member(
@@ -274,27 +675,12 @@ async def on_scheduled_event_create(event):
             if credentials_dict is None:
                 print_log(f'No credentials found for guild {event.guild.name}')
                 return
-            try:
-                credentials = Credentials.from_authorized_user_info(
-                    credentials_dict)
-                result = await create_calendar_event(
-                    build('calendar', 'v3', credentials=credentials), event)
-                if result[0] is True:
-                    print_log(
-                        f'Event {event.name} : {event.id} added to calendar with url {result[1]["htmlLink"]} and id {result[1]["id"]}'
-                    )
-                else:
-                    if result[1] is not None:
-                        print_log(
-                            f'Event {event.name} : {event.id} failed to add to calendar with error {result[1]}'
-                        )
-            except MutualTLSChannelError as err:
-                print(err)
-            except Exception as err:
-                raise err
+
+            await outbox.submit(event.guild.id, event.id, CREATE, {'body': event_body(event)})
 
 
 @bot.event
+@event_handler_latency.time('scheduled_event_delete')
 async def on_scheduled_event_delete(event):
     if event.guild:
         print_log(
@@ -305,27 +691,12 @@ async def on_scheduled_event_delete(event):
         if credentials_dict is None:
             print_log(f'No credentials found for guild {event.guild.name}')
             return
-        
-        try:
-            credentials = Credentials.from_authorized_user_info(credentials_dict)
-            result = await delete_calendar_event(
-                build('calendar', 'v3', credentials=credentials), event)
-            if result[0] is True:
-                print_log(
-                    f'Event {event.name} : {event.id} deleted from calendar'
-                )
-            else:
-                if result[1] is not None:
-                    print_log(
-                        f'Event {event.name} : {event.id} failed to delete from calendar with error {result[1]}'
-                    )
-        except MutualTLSChannelError as err:
-            print(err)
-        except Exception as err:
-            raise err
+
+        await outbox.submit(event.guild.id, event.id, DELETE, {'name': event.name})
 
 
 @bot.event
+@event_handler_latency.time('scheduled_event_update')
 async def on_scheduled_event_update(before, after):
     if after.guild:
         print_log(
@@ -337,81 +708,37 @@ async def on_scheduled_event_update(before, after):
         if credentials_dict is None:
             print_log(f'No credentials found for guild {after.guild.name}')
             return
-        
-        try:
-            credentials = Credentials.from_authorized_user_info(credentials_dict)
-            result = await update_calendar_event(
-                build('calendar', 'v3', credentials=credentials), before, after)
-            if result[0] is True:
-                print_log(
-                    f'Event {after.name} : {after.id} updated in calendar with url {result[1]["htmlLink"]} and id {result[1]["id"]}'
-                )
-            else:
-                if result[1] is not None:
-                    print_log(
-                        f'Event {after.name} : {after.id} failed to update in calendar with error {result[1]}'
-                    )
-        except MutualTLSChannelError as err:
-            print(err)
-        except Exception as err:
-            raise err
+
+        await outbox.submit(after.guild.id, after.id, UPDATE, {'body': event_body(after)})
 
 
 @bot.event
+@event_handler_latency.time('scheduled_event_user_add')
 async def on_scheduled_event_user_add(event: discord.ScheduledEvent,
                                       user: discord.User):
     if event.guild:
         print_log(
             f'User {user} added to event {event.name} in {event.guild} with id: {event.id}'
         )
-        credentials_dict = await google_auth.get_linked_credentials(str(event.guild.id))
-
-        if credentials_dict is None:
+        if await google_auth.get_linked_credentials(str(event.guild.id)) is None:
             print_log(f'No credentials found for guild {event.guild.name}')
             return
 
-        try:
-            credentials = Credentials.from_authorized_user_info(credentials_dict)
-            result = await add_user_to_calendar_event(service=build('calendar', 'v3', credentials=credentials), event=event, member_id=str(user.id))
-            if result[0] is True:
-                print_log(
-                    f'User {user.id} added to event {event.name} : {event.id} in calendar with url {result[1]["htmlLink"]} and id {result[1]["id"]}'
-                )
-            else:
-                print_log(
-                    f'User {user.id} added to event {event.name} : {event.id} in calendar with error {result[1]}'
-                )
-        except MutualTLSChannelError as err:
-            print(err)
-        except Exception as err:
-            raise err
+        await buffer_attendee_change(event.guild.id, event.id, user.id, True)
 
 @bot.event
+@event_handler_latency.time('scheduled_event_user_remove')
 async def on_scheduled_event_user_remove(event, user):
     if event.guild:
         print_log(
             f'User {user.id} removed from event {event.name} in {event.guild} with id: {event.id}'
         )
 
-        credentials_dict = await google_auth.get_linked_credentials(str(event.guild.id))
-        if credentials_dict is None:
+        if await google_auth.get_linked_credentials(str(event.guild.id)) is None:
             print_log(f'No credentials found for guild {event.guild.name}')
             return
-        
-        try:
-            credentials = Credentials.from_authorized_user_info(credentials_dict)
-            result = await remove_user_from_calendar_event(service=build('calendar', 'v3', credentials=credentials), event=event, member_id=str(user.id))
-            if result[0] is True:
-                print_log(
-                    f'User {user.id} removed from event {event.name} : {event.id} in calendar with url {result[1]["htmlLink"]} and id {result[1]["id"]}'
-                )
-            else:
-                print_log(
-                    f'User {user.id} failed to be removed from event {event.name} : {event.id} in calendar with error {result[1]}'
-                )
-        except MutualTLSChannelError as err:
-            print(err)
-        except Exception as err:
-            raise err
-        
-bot.run(os.getenv('DISCORD_TOKEN'), log_handler=None)
+
+        await buffer_attendee_change(event.guild.id, event.id, user.id, False)
+
+if __name__ == '__main__':
+    bot.run(os.getenv('DISCORD_TOKEN'), log_handler=None)
@@ -0,0 +1,201 @@
+from collections import deque
+import asyncio
+import logging
+import os
+
+from metrics import Histogram
+
+logger = logging.getLogger('discord.sync')
+
+CREATE = 'create'
+UPDATE = 'update'
+DELETE = 'delete'
+ATTENDEE = 'attendee'
+
+ATTENDEE_WINDOW = float(os.getenv('ATTENDEE_WINDOW', 0.5))
+ATTENDEE_MAX_CHANGES = int(os.getenv('ATTENDEE_MAX_CHANGES', 100))
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250)
+
+
+class EventSyncQueue:
+
+    def __init__(self, on_drop=None):
+        """ initializes a serialized work queue per (guild, event) so calendar syncs of an event
+        run one at a time and in the order the discord events arrived
+
+        Args:
+            on_drop (Callable[[Callable], None] | None): called with every operation that is dropped
+                because a later operation of the event replaced it
+        """
+        self.on_drop = on_drop
+        self.pending = {}
+        self.workers = {}
+        self.coalesced = 0
+        self.processed = 0
+
+    def submit(self, guild_id, event_id, kind: str, operation):
+        """queues a sync operation for an event, collapsing pending updates into the latest one
+
+        Args:
+            guild_id: the id of the guild the event belongs to
+            event_id: the id of the discord scheduled event
+            kind (str): one of CREATE, UPDATE, DELETE or ATTENDEE
+            operation (Callable[[], Awaitable]): a coroutine function that performs the sync
+        """
+        key = (str(guild_id), str(event_id))
+        queue = self.pending.setdefault(key, deque())
+        if kind == UPDATE and queue and queue[-1][0] == UPDATE:
+            self.dropped(queue[-1][1])
+            queue[-1] = (kind, operation)
+        elif kind == DELETE:
+            while queue and queue[-1][0] == UPDATE:
+                self.dropped(queue.pop()[1])
+            queue.append((kind, operation))
+        else:
+            queue.append((kind, operation))
+
+        if key not in self.workers:
+            self.workers[key] = asyncio.create_task(self.drain(key), name=f'sync_{key[0]}_{key[1]}')
+
+    def dropped(self, operation):
+        self.coalesced += 1
+        if self.on_drop is not None:
+            self.on_drop(operation)
+
+    async def drain(self, key: tuple[str, str]):
+        """runs the queued operations of an event until its queue is empty
+
+        Args:
+            key (tuple[str, str]): the (guild id, event id) of the queue to drain
+        """
+        queue = self.pending[key]
+        try:
+            while queue:
+                kind, operation = queue.popleft()
+                try:
+                    await operation()
+                except Exception:
+                    logger.exception(f'{kind} sync failed for event {key[1]} in guild {key[0]}')
+                self.processed += 1
+        finally:
+            self.workers.pop(key, None)
+            if not queue:
+                self.pending.pop(key, None)
+
+    def depth_of(self, guild_id, event_id) -> int:
+        return len(self.pending.get((str(guild_id), str(event_id)), ()))
+
+    @property
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self.pending.values())
+
+    async def join(self):
+        """waits for every queued operation to finish
+        """
+        while self.workers:
+            await asyncio.gather(*list(self.workers.values()), return_exceptions=True)
+
+
+class AttendeeBuffer:
+
+    def __init__(self, queue: EventSyncQueue, apply, window: float = ATTENDEE_WINDOW,
+                 max_changes: int = ATTENDEE_MAX_CHANGES):
+        """ initializes a buffer that collects the attendee changes of an event over a short window and
+        applies them as a single sync operation
+
+        Args:
+            queue (EventSyncQueue): the queue the netted changes are submitted to
+            apply (Callable[[str, str, dict[str, bool]], Awaitable]): applies the changes of an event, called with
+                the guild id, the event id and a dict of member ids to True for added or False for removed members
+            window (float): seconds to collect changes for before flushing
+            max_changes (int): the number of pending changes that flushes an event early
+        """
+        self.queue = queue
+        self.apply = apply
+        self.window = window
+        self.max_changes = max_changes
+        self.changes = {}
+        self.opened = {}
+        self.timers = {}
+        self.received = 0
+        self.flushes = 0
+        self.applied = 0
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.flush_latency = Histogram()
+
+    def add(self, guild_id, event_id, member_id):
+        self.record(guild_id, event_id, member_id, True)
+
+    def remove(self, guild_id, event_id, member_id):
+        self.record(guild_id, event_id, member_id, False)
+
+    def record(self, guild_id, event_id, member_id, added: bool):
+        """records an attendee change, an add and a remove of the same member cancel each other out
+
+        Args:
+            guild_id: the id of the guild the event belongs to
+            event_id: the id of the discord scheduled event
+            member_id: the id of the member that was added or removed
+            added (bool): True if the member was added, False if removed
+        """
+        key = (str(guild_id), str(event_id))
+        member_id = str(member_id)
+        self.received += 1
+        changes = self.changes.get(key)
+        if changes is None:
+            changes = self.changes[key] = {}
+            loop = asyncio.get_running_loop()
+            self.opened[key] = loop.time()
+            self.timers[key] = loop.call_later(self.window, self.flush, key)
+
+        if changes.get(member_id, added) != added:
+            del changes[member_id]
+        else:
+            changes[member_id] = added
+
+        if len(changes) >= self.max_changes:
+            self.flush(key)
+
+    def flush(self, key: tuple[str, str]):
+        """submits the pending changes of an event to the sync queue
+
+        Args:
+            key (tuple[str, str]): the (guild id, event id) to flush
+        """
+        changes = self.changes.pop(key, None)
+        opened = self.opened.pop(key, None)
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if not changes:
+            return
+
+        self.flushes += 1
+        self.applied += len(changes)
+        self.batch_sizes.observe(len(changes))
+
+        async def operation():
+            try:
+                await self.apply(key[0], key[1], changes)
+            finally:
+                self.flush_latency.observe(asyncio.get_running_loop().time() - opened)
+
+        self.queue.submit(key[0], key[1], ATTENDEE, operation)
+
+    def flush_all(self):
+        for key in list(self.changes):
+            self.flush(key)
+
+    def stats(self) -> dict:
+        """Returns:
+            dict: the batching metrics of the buffer
+        """
+        return {
+            'received': self.received,
+            'flushes': self.flushes,
+            'applied': self.applied,
+            'average_batch_size': self.applied / self.flushes if self.flushes else 0,
+            'max_batch_size': self.batch_sizes.max,
+            'average_flush_latency': self.flush_latency.sum / self.flush_latency.count if self.flush_latency.count else 0,
+            'max_flush_latency': self.flush_latency.max,
+        }
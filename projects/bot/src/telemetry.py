@@ -0,0 +1,31 @@
+import os
+
+from aiohttp import web
+from metrics import Registry, CONTENT_TYPE
+
+METRICS_PATH = os.getenv('METRICS_PATH', '/metrics')
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0)) or None
+
+registry = Registry()
+
+event_handler_latency = registry.histogram(
+    'bot_event_handler_seconds', 'time spent in the discord event handlers', labels=('event',))
+sync_latency = registry.histogram(
+    'bot_calendar_sync_seconds', 'time a google calendar sync from the outbox takes', labels=('kind',))
+google_calls = registry.counter(
+    'bot_google_calls_total', 'google calendar api requests by api method and http status, retries included',
+    labels=('method', 'status'))
+google_call_latency = registry.histogram(
+    'bot_google_call_seconds', 'time a single google calendar api request takes', labels=('method',))
+
+
+def google_method(request) -> str:
+    """Returns:
+        str: the api method of a google request like calendar.events.insert, batch for batch requests
+    """
+    return getattr(request, 'methodId', None) or 'batch'
+
+
+async def handle_metrics(request: web.Request):
+    return web.Response(body=registry.render().encode(), headers={'Content-Type': CONTENT_TYPE})
@@ -0,0 +1,158 @@
+from datetime import datetime, timezone
+import asyncio
+import heapq
+import logging
+import os
+import random
+import time
+
+logger = logging.getLogger('discord.tokens')
+
+REFRESH_MARGIN = float(os.getenv('TOKEN_REFRESH_MARGIN', 300))
+REFRESH_JITTER = float(os.getenv('TOKEN_REFRESH_JITTER', 60))
+REFRESH_CONCURRENCY = int(os.getenv('TOKEN_REFRESH_CONCURRENCY', 4))
+REFRESH_RETRY_DELAY = float(os.getenv('TOKEN_REFRESH_RETRY_DELAY', 60))
+
+
+def expiry_timestamp(expiry) -> float:
+    """converts a token expiry to a unix timestamp
+
+    Args:
+        expiry (str | datetime): an expiry as saved in the linked credentials or a naive utc datetime from google-auth
+
+    Returns:
+        float: the unix timestamp of the expiry
+    """
+    if isinstance(expiry, str):
+        expiry = datetime.strptime(expiry.rstrip('Z').split('.')[0], '%Y-%m-%dT%H:%M:%S')
+    return expiry.replace(tzinfo=timezone.utc).timestamp()
+
+
+def is_invalid_grant(error: Exception) -> bool:
+    """Returns:
+        bool: if a refresh error means the refresh token was revoked or expired
+    """
+    return 'invalid_grant' in str(error)
+
+
+class TokenRefresher:
+
+    def __init__(self, refresh, on_invalid_grant, margin: float = REFRESH_MARGIN, jitter: float = REFRESH_JITTER,
+                 concurrency: int = REFRESH_CONCURRENCY, retry_delay: float = REFRESH_RETRY_DELAY):
+        """ initializes a scheduler that refreshes the access tokens of guilds shortly before they expire,
+        so event syncs rarely wait on the oauth token endpoint
+
+        Args:
+            refresh (Callable[[str], Awaitable[datetime | None]]): refreshes the token of a guild and returns its new expiry,
+                None if the guild is no longer linked
+            on_invalid_grant (Callable[[str], Awaitable]): called when the refresh token of a guild was revoked
+            margin (float): seconds before the expiry a token is refreshed
+            jitter (float): up to this many extra seconds are taken off the refresh time to spread refreshes out
+            concurrency (int): the maximum number of refreshes running at once
+            retry_delay (float): seconds to wait before retrying a failed refresh
+        """
+        self.refresh = refresh
+        self.on_invalid_grant = on_invalid_grant
+        self.margin = margin
+        self.jitter = jitter
+        self.retry_delay = retry_delay
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.heap = []
+        self.due = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.refreshing = set()
+        self.refreshes = 0
+        self.failures = 0
+        self.revoked = 0
+
+    def schedule(self, guild_id: str, expiry):
+        """schedules the refresh of a guild's token, replacing an earlier schedule
+
+        Args:
+            guild_id (str): the id of the guild
+            expiry (str | datetime | float | None): when the token expires, None refreshes within the jitter so
+                the guilds loaded without an expiry at startup do not all hit the token endpoint at once
+        """
+        guild_id = str(guild_id)
+        if expiry is None:
+            due = time.time() + random.uniform(0, self.jitter)
+        else:
+            if not isinstance(expiry, (int, float)):
+                expiry = expiry_timestamp(expiry)
+            due = expiry - self.margin - random.uniform(0, self.jitter)
+        self.due[guild_id] = due
+        heapq.heappush(self.heap, (due, guild_id))
+        self.wakeup.set()
+
+    def unschedule(self, guild_id: str):
+        # the heap entry is skipped once it no longer matches self.due
+        self.due.pop(str(guild_id), None)
+
+    def next_due(self) -> float | None:
+        while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run(), name='token_refresher')
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            due = self.next_due()
+            now = time.time()
+            if due is None or due > now:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), None if due is None else due - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, guild_id = heapq.heappop(self.heap)
+            del self.due[guild_id]
+            if guild_id not in self.refreshing:
+                self.refreshing.add(guild_id)
+                asyncio.create_task(self.refresh_guild(guild_id), name=f'refresh_token_{guild_id}')
+
+    async def refresh_guild(self, guild_id: str):
+        """refreshes the token of a guild and schedules its next refresh
+
+        Args:
+            guild_id (str): the id of the guild
+        """
+        try:
+            async with self.semaphore:
+                expiry = await self.refresh(guild_id)
+            self.refreshes += 1
+            if expiry is not None:
+                self.schedule(guild_id, expiry)
+        except Exception as e:
+            if is_invalid_grant(e):
+                self.revoked += 1
+                logger.warning(f'refresh token of guild {guild_id} was revoked, unlinking')
+                await self.on_invalid_grant(guild_id)
+            else:
+                self.failures += 1
+                logger.exception(f'token refresh failed for guild {guild_id}')
+                self.schedule(guild_id, time.time() + self.margin + self.retry_delay)
+        finally:
+            self.refreshing.discard(guild_id)
+
+    def stats(self) -> dict:
+        """Returns:
+            dict: the number of scheduled guilds and the refresh counters
+        """
+        return {
+            'scheduled': len(self.due),
+            'refreshing': len(self.refreshing),
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'revoked': self.revoked,
+        }
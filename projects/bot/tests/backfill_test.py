@@ -0,0 +1,100 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+from googleapiclient.errors import HttpError
+import httplib2
+import pytest
+import backfill
+import calendar_service
+
+def make_event(event_id):
+    return SimpleNamespace(id=event_id, guild_id=1, name=f'event {event_id}', location='here', description='',
+                           start_time=datetime(2024, 1, 1, tzinfo=timezone.utc), end_time=None)
+
+class FakeBatch:
+    def __init__(self, callback, failing):
+        self.callback = callback
+        self.failing = failing
+        self.request_ids = []
+
+    def add(self, request, request_id=None):
+        self.request_ids.append(request_id)
+
+    def execute(self):
+        for request_id in self.request_ids:
+            if request_id in self.failing:
+                self.failing.discard(request_id)
+                self.callback(request_id, None, HttpError(httplib2.Response({'status': 500}), b'error'))
+            elif request_id == 'broken':
+                self.callback(request_id, None, HttpError(httplib2.Response({'status': 500}), b'error'))
+            elif request_id == 'exists':
+                self.callback(request_id, None, HttpError(httplib2.Response({'status': 409}), b'duplicate'))
+            else:
+                self.callback(request_id, {'id': request_id}, None)
+
+class FakeService:
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.batches = []
+
+    def new_batch_http_request(self, callback):
+        batch = FakeBatch(callback, self.failing)
+        self.batches.append(batch)
+        return batch
+
+    def events(self):
+        return MagicMock()
+
+@pytest.fixture
+def backfiller(tmp_path):
+    executor = calendar_service.CalendarExecutor(max_workers=2)
+    yield backfill.Backfiller(executor, state_file=str(tmp_path / 'backfill.json'), chunk_size=50)
+    executor.shutdown()
+
+@pytest.mark.asyncio
+async def test_backfill_sends_chunked_batches(backfiller):
+    service = FakeService()
+    events = [make_event(i) for i in range(120)]
+    progress = []
+    async def report(done, total):
+        progress.append((done, total))
+
+    result = await backfiller.backfill('1', service, events, progress=report)
+
+    assert result[0] is True
+    assert [len(batch.request_ids) for batch in service.batches] == [50, 50, 20]
+    assert progress == [(50, 120), (100, 120), (120, 120)]
+    # a finished pass keeps no ids around
+    assert '1' not in backfiller.completed
+    assert backfill.Backfiller(backfiller.executor, state_file=backfiller.state_file).completed == {}
+
+@pytest.mark.asyncio
+async def test_backfill_retries_failed_events(backfiller):
+    service = FakeService(failing={'3', '7'})
+    result = await backfiller.backfill('1', service, [make_event(i) for i in range(10)])
+    assert result[0] is True
+    assert service.batches[1].request_ids == ['3', '7']
+
+@pytest.mark.asyncio
+async def test_backfill_treats_existing_event_as_done(backfiller):
+    result = await backfiller.backfill('1', FakeService(), [make_event('exists'), make_event('broken')])
+    assert result[0] is False
+    assert backfiller.completed['1'] == {'exists'}
+
+@pytest.mark.asyncio
+async def test_backfill_resumes_from_saved_state(backfiller, tmp_path):
+    result = await backfiller.backfill('1', FakeService(), [make_event(i) for i in range(5)] + [make_event('broken')])
+    assert result[0] is False
+    resumed = backfill.Backfiller(backfiller.executor, state_file=str(tmp_path / 'backfill.json'))
+    service = FakeService()
+    await resumed.backfill('1', service, [make_event(i) for i in range(8)])
+    assert service.batches[0].request_ids == ['5', '6', '7']
+    assert not (tmp_path / 'backfill.json.tmp').exists()
+
+@pytest.mark.asyncio
+async def test_backfill_forgotten_after_relink(backfiller):
+    await backfiller.backfill('1', FakeService(), [make_event(i) for i in range(3)] + [make_event('broken')])
+    backfiller.forget('1')
+    service = FakeService()
+    await backfiller.backfill('1', service, [make_event(i) for i in range(3)])
+    assert service.batches[0].request_ids == ['0', '1', '2']
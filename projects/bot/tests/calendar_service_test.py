@@ -0,0 +1,134 @@
+from unittest.mock import MagicMock
+import asyncio
+import datetime
+import threading
+import time
+import pytest
+import calendar_service
+
+CREDS = {
+    "token": "abc",
+    "refresh_token": "def",
+    "token_uri": "https://accounts.google.com/o/oauth2/token",
+    "client_id": "ghi",
+    "client_secret": "jkl",
+    "scopes": ['scope1', 'scope2', 'scope3'],
+}
+
+@pytest.fixture
+def mock_build(mocker):
+    return mocker.patch.object(calendar_service, 'build', side_effect=lambda *args, **kwargs: MagicMock())
+
+def test_service_reused_for_guild(mock_build):
+    cache = calendar_service.CalendarServiceCache()
+    service = cache.get_service('123', CREDS)
+    assert cache.get_service('123', CREDS) is service
+    assert mock_build.call_count == 1
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+def test_least_recently_used_service_evicted(mock_build):
+    cache = calendar_service.CalendarServiceCache(max_size=2)
+    first = cache.get_service('1', CREDS)
+    cache.get_service('2', CREDS)
+    cache.get_service('1', CREDS)
+    cache.get_service('3', CREDS)
+    assert len(cache) == 2
+    assert '2' not in cache.services
+    assert cache.get_service('1', CREDS) is first
+    assert mock_build.call_count == 3
+
+def test_invalidate_rebuilds_service(mock_build):
+    cache = calendar_service.CalendarServiceCache()
+    service = cache.get_service('123', CREDS)
+    cache.invalidate('123')
+    service.close.assert_called_once()
+    assert cache.get_service('123', CREDS) is not service
+    assert mock_build.call_count == 2
+
+@pytest.mark.asyncio
+async def test_refreshed_token_reported(mock_build, mocker):
+    def refresh(credentials, request):
+        credentials.token = 'refreshed'
+        credentials.expiry = datetime.datetime(2030, 1, 1, 12, 0, 0)
+    mocker.patch.object(calendar_service.Credentials, 'refresh', refresh)
+    refreshed = []
+    cache = calendar_service.CalendarServiceCache(on_refresh=lambda guild_id, info: refreshed.append((guild_id, info)))
+    cache.get_service('123', CREDS)
+    credentials = cache.get_credentials('123')
+    assert credentials.expired
+    await asyncio.to_thread(credentials.refresh, None)
+    await asyncio.sleep(0)
+    assert refreshed == [('123', {'token': 'refreshed', 'refresh_token': 'def', 'expiry': '2030-01-01T12:00:00Z'})]
+
+    cache.invalidate('123')
+    assert cache.get_credentials('123') is None
+    cache.get_service('123', {**CREDS, **refreshed[0][1]})
+    assert cache.get_credentials('123').token == 'refreshed'
+    assert not cache.get_credentials('123').expired
+
+def test_credentials_updated_in_place(mock_build):
+    cache = calendar_service.CalendarServiceCache()
+    service = cache.get_service('123', CREDS)
+    refreshed = calendar_service.Credentials('refreshed', expiry=datetime.datetime(2030, 1, 1))
+    cache.update_credentials('123', refreshed)
+    cache.update_credentials('456', refreshed)
+    assert cache.get_service('123', CREDS) is service
+    assert cache.get_credentials('123').token == 'refreshed'
+    assert not cache.get_credentials('123').expired
+    assert cache.get_credentials('456') is None
+
+@pytest.mark.asyncio
+async def test_executor_runs_request_off_loop():
+    executor = calendar_service.CalendarExecutor(max_workers=2)
+    request = MagicMock()
+    request.execute.side_effect = lambda: threading.current_thread().name
+    thread_name = await executor.execute(request)
+    assert thread_name.startswith('calendar')
+    executor.shutdown()
+
+@pytest.mark.asyncio
+async def test_executor_timeout():
+    executor = calendar_service.CalendarExecutor(max_workers=1)
+    request = MagicMock()
+    request.execute.side_effect = lambda: time.sleep(0.5)
+    with pytest.raises(calendar_service.CalendarTimeoutError):
+        await executor.execute(request, timeout=0.05)
+    executor.shutdown()
+
+@pytest.mark.asyncio
+async def test_executor_serializes_shared_transport():
+    executor = calendar_service.CalendarExecutor(max_workers=4)
+    http = MagicMock()
+    running = []
+    overlap = []
+    def execute():
+        running.append(1)
+        overlap.append(len(running))
+        time.sleep(0.01)
+        running.pop()
+    requests = []
+    for _ in range(4):
+        request = MagicMock(http=http)
+        request.execute.side_effect = execute
+        requests.append(request)
+    await asyncio.gather(*(executor.execute(request) for request in requests))
+    assert max(overlap) == 1
+    executor.shutdown()
+
+@pytest.mark.asyncio
+async def test_busy_transport_does_not_hold_pool_threads():
+    executor = calendar_service.CalendarExecutor(max_workers=2)
+    busy_http = MagicMock()
+    busy = [MagicMock(http=busy_http) for _ in range(4)]
+    for request in busy:
+        request.execute.side_effect = lambda: time.sleep(0.1)
+    other = MagicMock(http=MagicMock())
+    other.execute.side_effect = lambda: time.perf_counter()
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(executor.execute(request)) for request in busy]
+    await asyncio.sleep(0.01)
+    # the queued requests of the busy transport wait on the loop, a pool thread is free for the other one
+    assert await executor.execute(other) - start < 0.1
+    await asyncio.gather(*tasks)
+    executor.shutdown()
@@ -0,0 +1,164 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from aiohttp import web
+import asyncio
+import pytest
+import pytest_asyncio
+import calendar_service
+import change_feed
+from fake_calendar import FakeCalendar
+from internal_server import InternalServer
+
+def make_event(event_id, guild_id=1, **fields):
+    event = dict(id=event_id, guild_id=guild_id, name=f'event {event_id}', location='here', description='',
+                 start_time=datetime(2030, 1, 1, tzinfo=timezone.utc), end_time=datetime(2030, 1, 1, 1, tzinfo=timezone.utc))
+    event.update(fields)
+    return SimpleNamespace(**event)
+
+@pytest_asyncio.fixture
+async def calendar():
+    calendar = FakeCalendar()
+    await calendar.start()
+    yield calendar
+    await calendar.stop()
+
+@pytest_asyncio.fixture
+async def executor():
+    executor = calendar_service.CalendarExecutor(max_workers=2)
+    yield executor
+    executor.shutdown()
+
+def make_feed(calendar, executor, tmp_path, push_url=None, **kwargs):
+    service = calendar.service()
+    applied = []
+    async def get_service(guild_id):
+        return service
+    async def apply(guild_id, changes):
+        applied.append((guild_id, [(change['id'], change.get('status'), change.get('summary')) for change in changes]))
+    feed = change_feed.ChangeFeed(executor, get_service, apply, push_url=push_url, secret='key',
+                                  state_file=str(tmp_path / 'change_feed.json'), **kwargs)
+    return feed, service, applied
+
+async def insert(executor, service, event):
+    return await executor.execute(service.events().insert(calendarId='primary', body=calendar_service.event_body(event)))
+
+def test_discord_changes():
+    event = make_event(1)
+    assert change_feed.discord_changes(event, {
+        'summary': 'event 1', 'description': '', 'location': 'here',
+        'start': {'dateTime': '2030-01-01T01:00:00+01:00'}, 'end': {'dateTime': '2030-01-01T01:00:00Z'},
+    }) == {}
+    assert change_feed.discord_changes(event, {
+        'summary': 'renamed', 'start': {'dateTime': '2030-01-02T00:00:00Z'},
+    }) == {'name': 'renamed', 'start_time': datetime(2030, 1, 2, tzinfo=timezone.utc)}
+    voice_event = make_event(2, location=None)
+    assert change_feed.discord_changes(voice_event, {'summary': 'event 2', 'location': 'elsewhere'}) == {}
+
+@pytest.mark.asyncio
+async def test_pull_returns_only_changed_guild_events(calendar, executor, tmp_path):
+    feed, service, applied = make_feed(calendar, executor, tmp_path)
+    await insert(executor, service, make_event(1))
+    await insert(executor, service, make_event(2, guild_id=2))
+
+    assert await feed.pull('1') == (True, [])
+    assert applied == []
+
+    calendar.edit('1', summary='edited in google')
+    calendar.edit('2', summary='other guild')
+    result = await feed.pull('1')
+    assert result[0] is True
+    assert applied == [('1', [('1', 'confirmed', 'edited in google')])]
+
+    await executor.execute(service.events().delete(calendarId='primary', eventId='1'))
+    await feed.pull('1')
+    assert applied[-1] == ('1', [('1', 'cancelled', None)])
+
+    await feed.pull('1')
+    assert len(applied) == 2
+    assert feed.stats()['pulls'] == 4
+
+    reloaded, _, _ = make_feed(calendar, executor, tmp_path)
+    assert reloaded.state['1']['sync_token'] == feed.state['1']['sync_token']
+
+@pytest.mark.asyncio
+async def test_expired_sync_token_resyncs(calendar, executor, tmp_path):
+    feed, service, applied = make_feed(calendar, executor, tmp_path)
+    await insert(executor, service, make_event(1))
+    await feed.pull('1')
+    calendar.expire_sync_tokens()
+    calendar.edit('1', summary='missed')
+    assert await feed.pull('1') == (True, [])
+    assert feed.resyncs == 1
+    calendar.edit('1', summary='seen')
+    await feed.pull('1')
+    assert applied == [('1', [('1', 'confirmed', 'seen')])]
+
+@pytest.mark.asyncio
+async def test_concurrent_saves_keep_the_latest_state(calendar, executor, tmp_path):
+    feed, service, applied = make_feed(calendar, executor, tmp_path)
+    saves = []
+    for n in range(20):
+        feed.state[str(n)] = {'sync_token': str(n)}
+        saves.append(asyncio.create_task(feed.save()))
+    await asyncio.gather(*saves)
+    reloaded, _, _ = make_feed(calendar, executor, tmp_path)
+    assert reloaded.state == feed.state
+    assert not (tmp_path / 'change_feed.json.tmp').exists()
+
+@pytest.mark.asyncio
+async def test_push_notification_triggers_pull(calendar, executor, tmp_path):
+    server = InternalServer(host='127.0.0.1', port=0, api_key='key')
+    notified = asyncio.Event()
+    async def receive(request: web.Request):
+        # stands in for the api, which checks the token and forwards the guild id to the bot
+        guild_id = request.headers['X-Goog-Channel-Token'].split('.')[0]
+        if request.headers['X-Goog-Resource-State'] == 'exists':
+            feed.notify(guild_id)
+            notified.set()
+        return web.Response()
+    server.add_route('POST', '/notifications', receive, public=True)
+    await server.start()
+    try:
+        feed, service, applied = make_feed(calendar, executor, tmp_path, push_url=f'http://127.0.0.1:{server.port}/notifications')
+        await insert(executor, service, make_event(1))
+        await feed.ensure('1')
+        assert feed.stats()['channels'] == 1
+        channel = calendar.channels[feed.state['1']['channel']['id']]
+        assert channel['token'] == change_feed.channel_token('1', 'key')
+
+        calendar.edit('1', summary='pushed')
+        await asyncio.wait_for(notified.wait(), 5)
+        await asyncio.gather(*feed.pulling.values())
+        assert applied == [('1', [('1', 'confirmed', 'pushed')])]
+        assert calendar.requests_to('GET') == 2
+    finally:
+        await server.stop()
+
+@pytest.mark.asyncio
+async def test_notifications_during_pull_coalesced(calendar, executor, tmp_path):
+    feed, service, applied = make_feed(calendar, executor, tmp_path)
+    await insert(executor, service, make_event(1))
+    await feed.pull('1')
+    calendar.latency = 0.05
+    feed.notify('1')
+    await asyncio.sleep(0.01)
+    for _ in range(4):
+        feed.notify('1')
+    await asyncio.gather(*feed.pulling.values())
+    assert feed.pulls == 3
+
+@pytest.mark.asyncio
+async def test_expiring_channels_renewed(calendar, executor, tmp_path):
+    feed, service, applied = make_feed(calendar, executor, tmp_path, push_url='https://api.example.com/notifications',
+                                       channel_ttl=60, renew_margin=120)
+    await feed.watch('1')
+    first = feed.state['1']['channel']
+    await feed.renew_expiring()
+    second = feed.state['1']['channel']
+    assert second['id'] != first['id']
+    assert list(calendar.channels) == [second['id']]
+    assert feed.renewals == 1
+
+    await feed.forget('1')
+    assert calendar.channels == {}
+    assert feed.stats()['guilds'] == 0
@@ -0,0 +1,99 @@
+from unittest.mock import MagicMock
+from googleapiclient.errors import HttpError
+import httplib2
+import pytest
+import event_mirror
+
+class FakeExecutor:
+    """runs requests inline and records them"""
+    def __init__(self):
+        self.requests = []
+
+    async def execute(self, request, timeout=None, transport=None, guild_id=None, cost=1):
+        self.requests.append(request)
+        return request.execute()
+
+def google_event(etag, attendees):
+    return {'id': '10', 'etag': etag, 'htmlLink': 'https://calendar/10', 'attendees': attendees, 'summary': 'event'}
+
+def add(email):
+    return lambda attendees: attendees + [{'email': email}]
+
+@pytest.fixture
+def service():
+    service = MagicMock()
+    service.events.return_value.patch.side_effect = lambda calendarId, eventId, body: MagicMock(
+        headers={}, body=body, **{'execute.return_value': google_event('"2"', body['attendees'])})
+    return service
+
+@pytest.mark.asyncio
+async def test_patch_uses_mirrored_etag(service):
+    mirror = event_mirror.EventMirror()
+    executor = FakeExecutor()
+    mirror.store('1', google_event('"1"', []))
+
+    entry = await mirror.patch_attendees(executor, service, '1', '10', add('a@example.com'))
+
+    assert len(executor.requests) == 1
+    assert executor.requests[0].headers['If-Match'] == '"1"'
+    assert executor.requests[0].body == {'attendees': [{'email': 'a@example.com'}]}
+    assert entry['etag'] == '"2"'
+    assert mirror.get('1', '10')['attendees'] == [{'email': 'a@example.com'}]
+    service.events.return_value.get.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_patch_fetches_unmirrored_event(service):
+    mirror = event_mirror.EventMirror()
+    executor = FakeExecutor()
+    service.events.return_value.get.return_value.execute.return_value = google_event('"1"', [{'email': 'b@example.com'}])
+
+    await mirror.patch_attendees(executor, service, '1', '10', add('a@example.com'))
+
+    assert len(executor.requests) == 2
+    assert executor.requests[1].body == {'attendees': [{'email': 'b@example.com'}, {'email': 'a@example.com'}]}
+    assert mirror.refreshes == 1
+
+@pytest.mark.asyncio
+async def test_patch_refreshes_mirror_on_etag_mismatch(service):
+    mirror = event_mirror.EventMirror()
+    executor = FakeExecutor()
+    mirror.store('1', google_event('"stale"', []))
+    stale = MagicMock(headers={})
+    stale.execute.side_effect = HttpError(httplib2.Response({'status': 412}), b'precondition failed')
+    patch = service.events.return_value.patch
+    fresh_patch = patch.side_effect
+    patch.side_effect = [stale, fresh_patch(calendarId='primary', eventId='10', body={'attendees': [{'email': 'b@example.com'}, {'email': 'a@example.com'}]})]
+    service.events.return_value.get.return_value.execute.return_value = google_event('"1"', [{'email': 'b@example.com'}])
+
+    entry = await mirror.patch_attendees(executor, service, '1', '10', add('a@example.com'))
+
+    assert entry['etag'] == '"2"'
+    assert mirror.refreshes == 1
+    assert len(executor.requests) == 3
+
+@pytest.mark.asyncio
+async def test_unchanged_attendees_skip_request(service):
+    mirror = event_mirror.EventMirror()
+    executor = FakeExecutor()
+    mirror.store('1', google_event('"1"', [{'email': 'a@example.com'}]))
+    await mirror.patch_attendees(executor, service, '1', '10', lambda attendees: attendees)
+    assert executor.requests == []
+
+def test_mirror_evicts_oldest():
+    mirror = event_mirror.EventMirror(max_size=1)
+    mirror.store('1', {'id': '10'})
+    mirror.store('1', {'id': '11'})
+    assert mirror.get('1', '10') is None
+    assert mirror.get('1', '11')['attendees'] == []
+
+def test_own_writes_recognized():
+    mirror = event_mirror.EventMirror()
+    mirror.store('1', {**google_event('"1"', []), 'updated': '2030-01-01T00:00:00Z'})
+    assert mirror.is_own_write('1', {'id': '10', 'etag': '"1"'})
+    assert mirror.is_own_write('1', {'id': '10', 'etag': '"x"', 'updated': '2030-01-01T00:00:00Z'})
+    assert not mirror.is_own_write('1', {'id': '10', 'etag': '"2"', 'updated': '2030-01-02T00:00:00Z'})
+    assert not mirror.is_own_write('1', {'id': '11', 'etag': '"1"'})
+    # a fetched event is not a write of the bot, the last write is kept
+    mirror.store('1', google_event('"2"', []), written=False)
+    assert not mirror.is_own_write('1', {'id': '10', 'etag': '"2"'})
+    assert mirror.is_own_write('1', {'id': '10', 'etag': '"1"'})
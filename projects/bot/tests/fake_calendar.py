@@ -0,0 +1,254 @@
+"""A local stand-in for the parts of the google calendar v3 api the bot uses, with sync tokens and push
+channels, so calendar syncing can be tested without google.
+"""
+from datetime import datetime, timezone
+import asyncio
+import itertools
+import json
+import random
+import time
+
+from aiohttp import ClientSession, web
+from googleapiclient.discovery import build
+import httplib2
+
+
+class FakeCalendar:
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed=None):
+        """ initializes an empty primary calendar
+
+        Args:
+            latency (float): seconds every request waits before it is answered
+            error_rate (float): the share of requests that fail with a 503 backendError
+            seed: seeds the choice of the failing requests so runs can be repeated
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.events = {}
+        self.changed = {}
+        self.sequence = itertools.count(1)
+        self.last_sequence = 0
+        self.expired_before = 0
+        self.channels = {}
+        self.notifications = []
+        self.requests = []
+        self.throttles = []
+        self.runner = None
+        self.url = None
+        self.session = None
+        self.app = web.Application(middlewares=[self.record])
+        prefix = '/calendar/v3'
+        self.app.router.add_post(f'{prefix}/calendars/{{calendar_id}}/events/watch', self.watch)
+        self.app.router.add_get(f'{prefix}/calendars/{{calendar_id}}/events', self.list_events)
+        self.app.router.add_post(f'{prefix}/calendars/{{calendar_id}}/events', self.insert)
+        self.app.router.add_get(f'{prefix}/calendars/{{calendar_id}}/events/{{event_id}}', self.get)
+        self.app.router.add_put(f'{prefix}/calendars/{{calendar_id}}/events/{{event_id}}', self.update)
+        self.app.router.add_patch(f'{prefix}/calendars/{{calendar_id}}/events/{{event_id}}', self.patch)
+        self.app.router.add_delete(f'{prefix}/calendars/{{calendar_id}}/events/{{event_id}}', self.delete)
+        self.app.router.add_post(f'{prefix}/channels/stop', self.stop_channel)
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f'http://127.0.0.1:{self.runner.addresses[0][1]}'
+        self.session = ClientSession()
+
+    async def stop(self):
+        if self.session is not None:
+            await self.session.close()
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def service(self):
+        """Returns:
+            googleapiclient.discovery.Resource: a calendar service that talks to the fake
+        """
+        return build('calendar', 'v3', http=httplib2.Http(), static_discovery=True,
+                     client_options={'api_endpoint': f'{self.url}/calendar/v3/'})
+
+    @web.middleware
+    async def record(self, request: web.Request, handler):
+        self.requests.append((request.method, request.path))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.throttles:
+            status, reason, retry_after = self.throttles.pop(0)
+            headers = {'Retry-After': str(retry_after)} if retry_after is not None else None
+            return web.json_response({'error': {'code': status, 'message': 'Rate Limit Exceeded',
+                                                'errors': [{'domain': 'usageLimits', 'reason': reason}]}},
+                                     status=status, headers=headers)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return web.json_response({'error': {'code': 503, 'message': 'Backend Error',
+                                                'errors': [{'domain': 'global', 'reason': 'backendError'}]}},
+                                     status=503)
+        return await handler(request)
+
+    def throttle(self, count: int = 1, status: int = 429, reason: str = 'rateLimitExceeded', retry_after=None):
+        """makes the next requests fail the way google answers requests over the quota
+
+        Args:
+            count (int): the number of requests to fail
+            status (int): the status of the failures
+            reason (str): the reason in the error body
+            retry_after: the Retry-After header to send, None to leave it out
+        """
+        self.throttles.extend([(status, reason, retry_after)] * count)
+
+    def requests_to(self, method: str) -> int:
+        return sum(1 for recorded, _ in self.requests if recorded == method)
+
+    def save(self, event: dict, notify: bool = True) -> dict:
+        sequence = next(self.sequence)
+        self.last_sequence = sequence
+        event['etag'] = f'"{sequence}"'
+        event['updated'] = datetime.now(timezone.utc).isoformat()
+        event['htmlLink'] = f'{self.url}/event?eid={event["id"]}'
+        self.events[event['id']] = event
+        self.changed[event['id']] = sequence
+        if notify:
+            self.notify_channels()
+        return event
+
+    def edit(self, event_id: str, **fields) -> dict:
+        """changes an event the way a user editing it in google calendar would
+
+        Args:
+            event_id (str): the id of the event
+            fields: the event fields to replace
+        """
+        return self.save({**self.events[event_id], **fields})
+
+    def expire_sync_tokens(self):
+        self.expired_before = self.last_sequence + 1
+
+    def notify_channels(self):
+        for channel in self.channels.values():
+            asyncio.get_running_loop().create_task(self.send_notification(channel, 'exists'))
+
+    async def send_notification(self, channel: dict, state: str):
+        channel['messages'] += 1
+        headers = {
+            'X-Goog-Channel-ID': channel['id'],
+            'X-Goog-Channel-Token': channel['token'],
+            'X-Goog-Resource-ID': channel['resourceId'],
+            'X-Goog-Resource-State': state,
+            'X-Goog-Message-Number': str(channel['messages']),
+        }
+        try:
+            async with self.session.post(channel['address'], headers=headers) as res:
+                self.notifications.append((channel['id'], state, res.status))
+        except Exception as err:
+            self.notifications.append((channel['id'], state, str(err)))
+
+    def matches(self, event: dict, query) -> bool:
+        private = query.get('privateExtendedProperty')
+        if private is not None:
+            key, value = private.split('=', 1)
+            if event.get('extendedProperties', {}).get('private', {}).get(key) != value:
+                return False
+        time_min = query.get('timeMin')
+        if time_min is not None and 'dateTime' in event.get('end', event.get('start', {})):
+            end = datetime.fromisoformat(event.get('end', event['start'])['dateTime'])
+            if end < datetime.fromisoformat(time_min):
+                return False
+        return True
+
+    async def list_events(self, request: web.Request):
+        query = request.query
+        sync_token = query.get('syncToken')
+        if sync_token is not None:
+            since = int(sync_token)
+            if since < self.expired_before:
+                return web.json_response({'error': {'code': 410, 'message': 'Sync token is no longer valid'}}, status=410)
+            events = [self.events[event_id] for event_id, sequence in self.changed.items() if sequence > since]
+        else:
+            show_deleted = query.get('showDeleted') == 'true'
+            events = [event for event in self.events.values()
+                      if (show_deleted or event.get('status') != 'cancelled') and self.matches(event, query)]
+
+        offset = int(query.get('pageToken', 0))
+        limit = int(query.get('maxResults', 250))
+        page = events[offset:offset + limit]
+        body = {'kind': 'calendar#events', 'items': page}
+        if offset + limit < len(events):
+            body['nextPageToken'] = str(offset + limit)
+        else:
+            body['nextSyncToken'] = str(self.last_sequence)
+        return web.json_response(body)
+
+    async def insert(self, request: web.Request):
+        body = await request.json()
+        body.pop('calendarId', None)
+        existing = self.events.get(body.get('id'))
+        if existing is not None:
+            return web.json_response({'error': {'code': 409, 'message': 'The requested identifier already exists.'}}, status=409)
+        body.setdefault('status', 'confirmed')
+        return web.json_response(self.save(body))
+
+    def find(self, request: web.Request) -> dict:
+        event = self.events.get(request.match_info['event_id'])
+        if event is None:
+            raise web.HTTPNotFound(text=json.dumps({'error': {'code': 404, 'message': 'Not Found'}}),
+                                   content_type='application/json')
+        return event
+
+    def check_etag(self, request: web.Request, event: dict):
+        if_match = request.headers.get('If-Match')
+        if if_match is not None and if_match != event['etag']:
+            raise web.HTTPPreconditionFailed(text=json.dumps({'error': {'code': 412, 'message': 'Precondition Failed'}}),
+                                             content_type='application/json')
+
+    async def get(self, request: web.Request):
+        return web.json_response(self.find(request))
+
+    async def update(self, request: web.Request):
+        event = self.find(request)
+        self.check_etag(request, event)
+        body = await request.json()
+        body.pop('calendarId', None)
+        body['id'] = event['id']
+        body.setdefault('status', 'confirmed')
+        return web.json_response(self.save(body))
+
+    async def patch(self, request: web.Request):
+        event = self.find(request)
+        self.check_etag(request, event)
+        return web.json_response(self.save({**event, **await request.json()}))
+
+    async def delete(self, request: web.Request):
+        event = self.find(request)
+        if event.get('status') == 'cancelled':
+            raise web.HTTPGone(text=json.dumps({'error': {'code': 410, 'message': 'Resource has been deleted'}}),
+                               content_type='application/json')
+        self.save({'id': event['id'], 'status': 'cancelled', 'extendedProperties': event.get('extendedProperties', {})})
+        return web.Response(status=204)
+
+    async def watch(self, request: web.Request):
+        body = await request.json()
+        ttl = int(body.get('params', {}).get('ttl', 604800))
+        channel = {
+            'kind': 'api#channel',
+            'id': body['id'],
+            'resourceId': f'resource-{body["id"]}',
+            'resourceUri': f'{self.url}{request.path}',
+            'token': body.get('token', ''),
+            'address': body['address'],
+            'expiration': str(int((time.time() + ttl) * 1000)),
+            'messages': 0,
+        }
+        self.channels[channel['id']] = channel
+        asyncio.get_running_loop().create_task(self.send_notification(channel, 'sync'))
+        return web.json_response({key: value for key, value in channel.items() if key not in ('address', 'messages')})
+
+    async def stop_channel(self, request: web.Request):
+        body = await request.json()
+        channel = self.channels.get(body['id'])
+        if channel is None or channel['resourceId'] != body.get('resourceId'):
+            raise web.HTTPNotFound(text=json.dumps({'error': {'code': 404, 'message': 'Channel not found'}}),
+                                   content_type='application/json')
+        del self.channels[body['id']]
+        return web.Response(status=204)
@@ -0,0 +1,93 @@
+"""A stand-in for the discord gateway that feeds scheduled event dispatches straight into the connection state
+of a bot, the way the websocket does once it decoded them, so the event handlers run without discord.
+"""
+from datetime import datetime, timedelta, timezone
+
+
+class FakeGateway:
+
+    def __init__(self, bot):
+        """ initializes a gateway for a bot that never logs in
+
+        Args:
+            bot (discord.Client): the bot whose handlers receive the dispatches
+        """
+        self.bot = bot
+        self.state = bot._connection
+        self.dispatched = 0
+
+    async def start(self):
+        """binds the bot to the running loop, which discord.py otherwise does when it logs in
+        """
+        await self.bot._async_setup_hook()
+
+    def dispatch(self, event_type: str, data: dict):
+        self.dispatched += 1
+        getattr(self.state, f'parse_{event_type.lower()}')(data)
+
+    def add_guild(self, guild_id: int, owner_id: int, name: str | None = None):
+        """Returns:
+            discord.Guild: a guild the bot sees as available
+        """
+        return self.state._add_guild_from_data({
+            'id': str(guild_id),
+            'name': name or f'guild {guild_id}',
+            'owner_id': str(owner_id),
+            'roles': [],
+            'emojis': [],
+            'stickers': [],
+            'features': [],
+            'channels': [],
+            'members': [],
+            'guild_scheduled_events': [],
+        })
+
+    def add_user(self, user_id: int):
+        return self.state.store_user({'id': str(user_id), 'username': f'user {user_id}', 'discriminator': '0',
+                                      'avatar': None, 'global_name': None})
+
+    @staticmethod
+    def scheduled_event(guild_id: int, event_id: int, creator_id: int, name: str | None = None,
+                        start: datetime | None = None, **fields) -> dict:
+        """builds the payload of an external scheduled event
+
+        Returns:
+            dict: the GUILD_SCHEDULED_EVENT_* payload
+        """
+        start = start or datetime(2030, 1, 1, tzinfo=timezone.utc)
+        return {
+            'id': str(event_id),
+            'guild_id': str(guild_id),
+            'channel_id': None,
+            'creator_id': str(creator_id),
+            'name': name or f'event {event_id}',
+            'description': '',
+            'scheduled_start_time': start.isoformat(),
+            'scheduled_end_time': (start + timedelta(hours=1)).isoformat(),
+            'privacy_level': 2,
+            'status': 1,
+            'entity_type': 3,
+            'entity_id': None,
+            'entity_metadata': {'location': 'here'},
+            'user_count': 0,
+            **fields,
+        }
+
+    def create_event(self, guild_id: int, event_id: int, creator_id: int, **fields):
+        self.dispatch('GUILD_SCHEDULED_EVENT_CREATE', self.scheduled_event(guild_id, event_id, creator_id, **fields))
+
+    def update_event(self, guild_id: int, event_id: int, creator_id: int, **fields):
+        self.dispatch('GUILD_SCHEDULED_EVENT_UPDATE', self.scheduled_event(guild_id, event_id, creator_id, **fields))
+
+    def delete_event(self, guild_id: int, event_id: int, creator_id: int, **fields):
+        self.dispatch('GUILD_SCHEDULED_EVENT_DELETE', self.scheduled_event(guild_id, event_id, creator_id, **fields))
+
+    def add_event_user(self, guild_id: int, event_id: int, user_id: int):
+        self.dispatch('GUILD_SCHEDULED_EVENT_USER_ADD', {'guild_id': str(guild_id),
+                                                         'guild_scheduled_event_id': str(event_id),
+                                                         'user_id': str(user_id)})
+
+    def remove_event_user(self, guild_id: int, event_id: int, user_id: int):
+        self.dispatch('GUILD_SCHEDULED_EVENT_USER_REMOVE', {'guild_id': str(guild_id),
+                                                            'guild_scheduled_event_id': str(event_id),
+                                                            'user_id': str(user_id)})
@@ -0,0 +1,69 @@
+from aiohttp import ClientSession, web
+import pytest
+import pytest_asyncio
+import internal_server
+import telemetry
+
+@pytest_asyncio.fixture
+async def server():
+    server = internal_server.InternalServer(host='127.0.0.1', port=0, api_key='key')
+    calls = []
+    async def handle_linked(request):
+        calls.append(request.match_info['guild_id'])
+        return web.json_response({'linked': True})
+    async def handle_health(request):
+        return web.Response(text='ok')
+    server.add_route('POST', '/linked/{guild_id}', handle_linked)
+    server.add_route('GET', '/health', handle_health, public=True)
+    server.add_route('GET', '/metrics', telemetry.handle_metrics)
+    server.calls = calls
+    await server.start()
+    yield server
+    await server.stop()
+
+@pytest.mark.asyncio
+async def test_notification_reaches_handler(server):
+    async with ClientSession() as session:
+        async with session.post(f'http://127.0.0.1:{server.port}/linked/123', headers={'Authorization': 'key'}) as res:
+            assert res.status == 200
+            assert await res.json() == {'linked': True}
+    assert server.calls == ['123']
+
+@pytest.mark.asyncio
+async def test_notification_requires_api_key(server):
+    async with ClientSession() as session:
+        async with session.post(f'http://127.0.0.1:{server.port}/linked/123', headers={'Authorization': 'wrong'}) as res:
+            assert res.status == 403
+        async with session.get(f'http://127.0.0.1:{server.port}/health') as res:
+            assert res.status == 200
+    assert server.calls == []
+
+@pytest.mark.asyncio
+async def test_server_without_api_key_serves_only_public_routes():
+    server = internal_server.InternalServer(host='127.0.0.1', port=0)
+    async def handle(request):
+        return web.Response(text='ok')
+    server.add_route('POST', '/linked/{guild_id}', handle)
+    server.add_route('GET', '/health', handle, public=True)
+    await server.start()
+    try:
+        async with ClientSession() as session:
+            async with session.post(f'http://127.0.0.1:{server.port}/linked/123') as res:
+                assert res.status == 403
+            async with session.post(f'http://127.0.0.1:{server.port}/linked/123', headers={'Authorization': 'None'}) as res:
+                assert res.status == 403
+            async with session.get(f'http://127.0.0.1:{server.port}/health') as res:
+                assert res.status == 200
+    finally:
+        await server.stop()
+
+@pytest.mark.asyncio
+async def test_metrics_scraped_with_bearer_token(server):
+    telemetry.google_calls.inc('calendar.events.list', 200)
+    async with ClientSession() as session:
+        async with session.get(f'http://127.0.0.1:{server.port}/metrics', headers={'Authorization': 'Bearer wrong'}) as res:
+            assert res.status == 403
+        async with session.get(f'http://127.0.0.1:{server.port}/metrics', headers={'Authorization': 'Bearer key'}) as res:
+            assert res.status == 200
+            assert res.headers['Content-Type'] == telemetry.CONTENT_TYPE
+            assert 'bot_google_calls_total{method="calendar.events.list",status="200"}' in await res.text()
@@ -0,0 +1,192 @@
+import asyncio
+import time
+import pytest
+from sqlalchemy import text
+import outbox
+import sync_queue
+from sync_queue import CREATE, UPDATE, DELETE, ATTENDEE
+
+@pytest.fixture
+def store(tmp_path):
+    return outbox.OutboxStore(f'sqlite:///{tmp_path / "outbox.db"}')
+
+def make_outbox(store, results=None, delay=0, **kwargs):
+    calls = []
+    async def handler(guild_id, event_id, payload):
+        calls.append((event_id, payload['n']))
+        await asyncio.sleep(delay)
+        return results.pop(0) if results else (True, None)
+    queue = sync_queue.EventSyncQueue(on_drop=lambda operation: box.drop(operation))
+    box = outbox.Outbox(store, queue, {kind: handler for kind in (CREATE, UPDATE, DELETE, ATTENDEE)}, **kwargs)
+    return box, queue, calls
+
+def test_shared_sqlite_pragmas(store):
+    with store.engine.connect() as con:
+        assert con.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+        assert con.execute(text('PRAGMA busy_timeout')).scalar() == 5000
+
+def test_same_pending_sync_recorded_once(store):
+    first = store.add('1', '10', CREATE, {'n': 1})
+    assert store.add('1', '10', CREATE, {'n': 1}) is None
+    assert store.add('1', '10', CREATE, {'n': 2}) is not None
+    store.complete(first)
+    assert store.add('1', '10', CREATE, {'n': 1}) is not None
+    assert store.counts() == {'pending': 2, 'done': 1, 'superseded': 0, 'dead': 0}
+
+def test_change_made_again_after_another_is_recorded(store):
+    first = store.add('1', '10', UPDATE, {'n': 1})
+    store.fail(first, 'google is down', 60, max_attempts=5)
+    second = store.add('1', '10', UPDATE, {'n': 2})
+    third = store.add('1', '10', UPDATE, {'n': 1})
+    assert third is not None
+    store.complete(second)
+    # the retry of the first sync is superseded, the newest one still brings google back to it
+    assert store.get(first['id'])['state'] == outbox.SUPERSEDED
+    assert [entry['id'] for entry in store.due()] == [third['id']]
+
+def test_completed_syncs_supersede_older_ones(store):
+    create = store.add('1', '10', CREATE, {'n': 1})
+    first = store.add('1', '10', UPDATE, {'n': 2})
+    other_event = store.add('1', '11', UPDATE, {'n': 3})
+    second = store.add('1', '10', UPDATE, {'n': 4})
+    assert store.complete(second) == 1
+    assert store.get(first['id'])['state'] == outbox.SUPERSEDED
+    assert store.get(other_event['id'])['state'] == outbox.PENDING
+    assert store.get(create['id'])['state'] == outbox.PENDING
+    delete = store.add('1', '10', DELETE, {'n': 5})
+    assert store.complete(delete) == 1
+    assert store.get(create['id'])['state'] == outbox.SUPERSEDED
+
+def test_completed_attendee_sync_trims_older_ones(store):
+    older = store.add('1', '10', ATTENDEE, {'changes': {'1': True, '2': True}})
+    oldest_member = store.add('1', '10', ATTENDEE, {'changes': {'2': True}})
+    other_event = store.add('1', '11', ATTENDEE, {'changes': {'2': True}})
+    store.fail(older, 'google is down', 0, max_attempts=5)
+    newer = store.add('1', '10', ATTENDEE, {'changes': {'2': False}})
+    assert store.complete(newer) == 1
+    # a retry of the older sync must not add back the member the newer one removed
+    assert store.get(older['id'])['payload'] == {'changes': {'1': True}}
+    assert store.get(oldest_member['id'])['state'] == outbox.SUPERSEDED
+    assert store.get(other_event['id'])['payload'] == {'changes': {'2': True}}
+
+def test_pending_events(store):
+    store.add('1', '10', UPDATE, {'n': 1})
+    done = store.add('1', '11', UPDATE, {'n': 2})
+    store.complete(done)
+    store.add('1', '12', ATTENDEE, {'changes': {'1': True}})
+    store.add('2', '20', CREATE, {'n': 3})
+    assert store.pending_events('1', (CREATE, UPDATE)) == {'10'}
+    assert store.pending_events('1', (ATTENDEE,)) == {'12'}
+
+def test_buffered_attendee_changes_netted_in_open_sync(store):
+    opened = store.net_attendee_change('1', '10', 'a', True, 60)
+    assert store.net_attendee_change('1', '10', 'b', True, 60) is None
+    assert store.net_attendee_change('1', '10', 'a', False, 60) is None
+    assert store.get(opened['id'])['payload'] == {'changes': {'b': True}}
+    # the sweep leaves an open sync alone until its window passed
+    assert store.due() == []
+    assert [entry['id'] for entry in store.close_attendee_changes('1', '10')] == [opened['id']]
+    assert [entry['id'] for entry in store.due()] == [opened['id']]
+    reopened = store.net_attendee_change('1', '10', 'b', False, 60)
+    assert reopened['id'] != opened['id']
+    assert store.net_attendee_change('1', '10', 'b', True, 60) is None
+    assert store.get(reopened['id'])['state'] == outbox.SUPERSEDED
+
+def test_reconciled_events_superseded(store):
+    stale = store.add('1', '10', UPDATE, {'n': 1})
+    attendees = store.add('1', '10', ATTENDEE, {'changes': {'1': True}})
+    other_event = store.add('1', '11', UPDATE, {'n': 2})
+    loaded_at = time.time()
+    newer = store.add('1', '10', UPDATE, {'n': 3})
+    assert store.supersede_events('1', {'10'}, (CREATE, UPDATE, DELETE), loaded_at) == 1
+    assert store.get(stale['id'])['state'] == outbox.SUPERSEDED
+    assert store.get(attendees['id'])['state'] == outbox.PENDING
+    assert store.get(other_event['id'])['state'] == outbox.PENDING
+    assert store.get(newer['id'])['state'] == outbox.PENDING
+    assert store.supersede_events('1', set(), (UPDATE,), loaded_at) == 0
+
+def test_failed_sync_retried_until_dead_and_replayed(store):
+    entry = store.add('1', '10', CREATE, {'n': 1})
+    assert store.fail(entry, 'google is down', 60, max_attempts=2) == outbox.PENDING
+    assert store.due() == []
+    assert store.fail(entry, 'google is down', 0, max_attempts=2) == outbox.DEAD
+    dead = store.entries(state=outbox.DEAD)
+    assert [(e['id'], e['attempts'], e['last_error']) for e in dead] == [(entry['id'], 2, 'google is down')]
+
+    duplicate = store.add('1', '10', CREATE, {'n': 1})
+    assert store.replay() == 0
+    store.complete(duplicate)
+    assert store.replay() == 1
+    assert [e['id'] for e in store.due()] == [entry['id']]
+    assert store.get(entry['id'])['attempts'] == 0
+
+@pytest.mark.asyncio
+async def test_syncs_run_in_order_and_coalesced_updates_superseded(store):
+    box, queue, calls = make_outbox(store, delay=0.02)
+    await box.submit('1', '10', CREATE, {'n': 1})
+    for n in range(2, 5):
+        await box.submit('1', '10', UPDATE, {'n': n})
+    assert await box.submit('1', '10', UPDATE, {'n': 4}) is None
+    await queue.join()
+    await box.run_store(lambda: None)
+    assert calls == [('10', 1), ('10', 4)]
+    assert store.counts() == {'pending': 0, 'done': 2, 'superseded': 2, 'dead': 0}
+    stats = box.stats()
+    assert stats['recorded'] == 4
+    assert stats['deduped'] == 1
+    assert stats['completed'] == 2
+    assert stats['inflight'] == 0
+
+@pytest.mark.asyncio
+async def test_pending_syncs_replayed_after_restart(store):
+    store.add('1', '10', CREATE, {'n': 1})
+    store.add('1', '10', UPDATE, {'n': 2})
+    store.add('2', '20', CREATE, {'n': 3})
+
+    box, queue, calls = make_outbox(store, results=[(None, 'google is down')], retry_delay=60)
+    assert await box.sweep() == 3
+    assert await box.sweep() == 0
+    await queue.join()
+    assert sorted(calls) == [('10', 1), ('10', 2), ('20', 3)]
+    counts = store.counts()
+    assert counts['pending'] == 1
+    assert counts['done'] == 2
+    assert box.stats()['failed'] == 1
+    # the failed sync waits for its retry delay
+    assert await box.sweep() == 0
+
+@pytest.mark.asyncio
+async def test_perform_runs_inline(store):
+    box, queue, calls = make_outbox(store, results=[(False, None)])
+    assert await box.perform('1', '10', ATTENDEE, {'n': 1}) == (False, None)
+    assert calls == [('10', 1)]
+    assert store.counts()['done'] == 1
+
+@pytest.mark.asyncio
+async def test_flush_runs_buffered_attendee_changes(store):
+    box, queue, calls = make_outbox(store)
+    applied = []
+    async def handler(guild_id, event_id, payload):
+        applied.append(payload['changes'])
+        return (True, None)
+    box.handlers[ATTENDEE] = handler
+    await box.buffer_attendee_change('1', '10', 'a', True, 60)
+    await box.buffer_attendee_change('1', '10', 'b', True, 60)
+    assert await box.flush_attendee_changes('1', '10') == (True, None)
+    assert await box.flush_attendee_changes('1', '10') is None
+    assert applied == [{'a': True, 'b': True}]
+    assert store.counts()['done'] == 1
+    assert box.stats()['recorded'] == 1
+
+def test_cli(store, capsys):
+    url = str(store.engine.url)
+    entry = store.add('1', '10', CREATE, {'n': 1})
+    store.fail(entry, 'google is down', 0, max_attempts=1)
+    outbox.main(['--database', url, 'list', '--state', 'dead'])
+    assert 'google is down' in capsys.readouterr().out
+    outbox.main(['--database', url, 'show', str(entry['id'])])
+    assert '"kind": "create"' in capsys.readouterr().out
+    outbox.main(['--database', url, 'replay', str(entry['id'])])
+    assert '1 entries replayed' in capsys.readouterr().out
+    outbox.main(['--database', url, 'stats'])
+    assert 'pending    1' in capsys.readouterr().out
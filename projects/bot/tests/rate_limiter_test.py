@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from types import SimpleNamespace
+from googleapiclient.errors import HttpError
+import json
+import time
+import httplib2
+import pytest
+import pytest_asyncio
+import calendar_service
+import rate_limiter
+import telemetry
+from fake_calendar import FakeCalendar
+
+def http_error(status, reason=None, headers=None):
+    body = {'error': {'code': status, 'message': 'error', 'errors': [{'reason': reason}] if reason else []}}
+    return HttpError(httplib2.Response({'status': status, **(headers or {})}), json.dumps(body).encode())
+
+def make_event(event_id):
+    return SimpleNamespace(id=event_id, guild_id=1, name=f'event {event_id}', location='here', description='',
+                           start_time=datetime(2030, 1, 1, tzinfo=timezone.utc), end_time=None)
+
+@pytest_asyncio.fixture
+async def calendar():
+    calendar = FakeCalendar()
+    await calendar.start()
+    yield calendar
+    await calendar.stop()
+
+def make_executor(**limits):
+    limiter = rate_limiter.RateLimiter(**{'backoff_base': 0.01, **limits})
+    return calendar_service.CalendarExecutor(max_workers=2, limiter=limiter)
+
+def test_token_bucket_goes_into_debt():
+    bucket = rate_limiter.TokenBucket(rate=10, capacity=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+    bucket.pause(1)
+    assert bucket.reserve() >= 0.9
+    assert not bucket.idle()
+
+def test_retryable_errors():
+    assert rate_limiter.is_retryable(http_error(429, 'rateLimitExceeded'))
+    assert rate_limiter.is_retryable(http_error(403, 'userRateLimitExceeded'))
+    assert rate_limiter.is_retryable(http_error(503, 'backendError'))
+    assert not rate_limiter.is_retryable(http_error(403, 'forbidden'))
+    assert not rate_limiter.is_retryable(http_error(404))
+    assert not rate_limiter.is_retryable(ValueError('not an http error'))
+
+def test_retry_after():
+    assert rate_limiter.retry_after(http_error(429, headers={'retry-after': '3'})) == 3
+    date = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 < rate_limiter.retry_after(http_error(429, headers={'retry-after': date})) <= 30
+    assert rate_limiter.retry_after(http_error(429)) is None
+    limiter = rate_limiter.RateLimiter(backoff_base=0.01)
+    assert limiter.backoff(0, http_error(429, headers={'retry-after': '2'})) == 2
+    assert limiter.backoff(3) <= 0.08
+
+@pytest.mark.asyncio
+async def test_busy_guild_does_not_hold_back_others():
+    limiter = rate_limiter.RateLimiter(project_rate=1000, project_burst=1000, guild_rate=20, guild_burst=2)
+    start = time.perf_counter()
+    for _ in range(4):
+        await limiter.acquire('1')
+    assert time.perf_counter() - start >= 0.09
+    assert await limiter.acquire('2') == 0
+    stats = limiter.stats()
+    assert stats['requests'] == 5
+    assert stats['throttled'] == 2
+    assert stats['guilds'] == 2
+
+@pytest.mark.asyncio
+async def test_throttled_request_retried(calendar):
+    executor = make_executor()
+    try:
+        service = calendar.service()
+        calls = dict(telemetry.google_calls.current())
+        calendar.throttle(2)
+        body = calendar_service.event_body(make_event(1))
+        google_event = await executor.execute(service.events().insert(calendarId='primary', body=body), guild_id='1')
+        assert google_event['id'] == '1'
+        assert calendar.requests_to('POST') == 3
+        assert executor.limiter.stats()['retries'] == 2
+        assert executor.limiter.stats()['rate_limited'] == 2
+        counted = telemetry.google_calls.current()
+        for status, count in ((429, 2), (200, 1)):
+            key = ('calendar.events.insert', status)
+            assert counted[key] - calls.get(key, 0) == count
+    finally:
+        executor.shutdown()
+
+@pytest.mark.asyncio
+async def test_google_call_status_recorded(calendar):
+    executor = make_executor()
+    try:
+        service = calendar.service()
+        calls = dict(telemetry.google_calls.current())
+        body = calendar_service.event_body(make_event(2))
+        await executor.execute(service.events().insert(calendarId='primary', body=body), guild_id='1')
+        await executor.execute(service.events().delete(calendarId='primary', eventId='2'), guild_id='1')
+        key = ('calendar.events.delete', 204)
+        assert telemetry.google_calls.current()[key] - calls.get(key, 0) == 1
+        assert ('calendar.events.delete', 200) not in telemetry.google_calls.current()
+    finally:
+        executor.shutdown()
+
+@pytest.mark.asyncio
+async def test_retry_after_honored(calendar):
+    executor = make_executor()
+    try:
+        service = calendar.service()
+        calendar.throttle(status=403, reason='userRateLimitExceeded', retry_after=1)
+        start = time.perf_counter()
+        await executor.execute(service.events().list(calendarId='primary'), guild_id='1')
+        assert time.perf_counter() - start >= 1
+        # the rest of the guild's requests wait for the quota as well
+        assert executor.limiter.guild_bucket('1').paused_until > 0
+    finally:
+        executor.shutdown()
+
+@pytest.mark.asyncio
+async def test_gives_up_after_max_retries(calendar):
+    executor = make_executor(max_retries=1)
+    try:
+        service = calendar.service()
+        calendar.throttle(3, status=503, reason='backendError')
+        with pytest.raises(HttpError):
+            await executor.execute(service.events().list(calendarId='primary'), guild_id='1')
+        assert calendar.requests_to('GET') == 2
+        assert executor.limiter.stats()['gave_up'] == 1
+        assert executor.limiter.stats()['rate_limited'] == 0
+    finally:
+        executor.shutdown()
@@ -0,0 +1,166 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+from googleapiclient.errors import HttpError
+import asyncio
+import time
+import httplib2
+import pytest
+import calendar_service
+import event_mirror
+import reconcile
+
+def make_event(event_id, name=None):
+    return SimpleNamespace(id=event_id, guild_id=1, name=name or f'event {event_id}', location='here', description='',
+                           start_time=datetime(2030, 1, 1, tzinfo=timezone.utc), end_time=None)
+
+def google_event(event, status='confirmed'):
+    body = calendar_service.event_body(event)
+    return {'id': body['id'], 'status': status, 'extendedProperties': body['extendedProperties']}
+
+class FakeBatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append(request_id)
+
+    def execute(self):
+        for request_id in self.requests:
+            if request_id == 'delete:gone':
+                self.callback(request_id, None, HttpError(httplib2.Response({'status': 410}), b'gone'))
+            elif request_id == 'create:legacy':
+                self.callback(request_id, None, HttpError(httplib2.Response({'status': 409}), b'duplicate'))
+            else:
+                self.callback(request_id, {'id': request_id.split(':')[1]}, None)
+
+class FakeService:
+    def __init__(self, pages):
+        self.pages = pages
+        self.batches = []
+        self.list_calls = []
+        self.calendar_events = MagicMock()
+        self.calendar_events.list.side_effect = self.list
+
+    def list(self, **kwargs):
+        self.list_calls.append(kwargs)
+        page = self.pages[len(self.list_calls) - 1]
+        return MagicMock(execute=MagicMock(return_value=page))
+
+    def new_batch_http_request(self, callback):
+        batch = FakeBatch(callback)
+        self.batches.append(batch)
+        return batch
+
+    def events(self):
+        return self.calendar_events
+
+@pytest.fixture
+def executor():
+    executor = calendar_service.CalendarExecutor(max_workers=2)
+    yield executor
+    executor.shutdown()
+
+def test_event_body_hash_tracks_synced_fields():
+    body = calendar_service.event_body(make_event(1))
+    assert body['extendedProperties']['private'][calendar_service.GUILD_PROPERTY] == '1'
+    same = calendar_service.event_body(make_event(1))
+    renamed = calendar_service.event_body(make_event(1, name='renamed'))
+    assert same['extendedProperties'] == body['extendedProperties']
+    assert renamed['extendedProperties'] != body['extendedProperties']
+
+@pytest.mark.asyncio
+async def test_reconcile_applies_minimal_changes(executor):
+    unchanged, renamed, restored, missing = make_event(1), make_event(2), make_event(3), make_event(4)
+    pages = [
+        {'items': [google_event(unchanged), google_event(make_event(2, name='old name'))], 'nextPageToken': 'next'},
+        {'items': [google_event(restored, status='cancelled'), google_event(make_event(5)),
+                   google_event(make_event(6), status='cancelled')]},
+    ]
+    service = FakeService(pages)
+    mirror = event_mirror.EventMirror()
+    reconciler = reconcile.Reconciler(executor, mirror=mirror)
+
+    result = await reconciler.reconcile('1', service, [unchanged, renamed, restored, missing])
+    assert result == (True, {'guild_id': '1', 'created': 1, 'updated': 2, 'deleted': 1, 'unchanged': 1, 'failed': 0,
+                             'seconds': result[1]['seconds']})
+    assert service.list_calls[0]['privateExtendedProperty'] == f'{calendar_service.GUILD_PROPERTY}=1'
+    assert service.list_calls[1]['pageToken'] == 'next'
+    assert len(service.batches) == 1
+    assert service.batches[0].requests == ['create:4', 'update:2', 'update:3', 'delete:5']
+    patch = service.calendar_events.patch.call_args_list[0].kwargs
+    assert patch['eventId'] == '2'
+    assert patch['body']['status'] == 'confirmed'
+    assert 'calendarId' not in patch['body']
+    assert mirror.get('1', '4') is not None
+
+@pytest.mark.asyncio
+async def test_reconcile_nothing_to_do(executor):
+    events = [make_event(1), make_event(2)]
+    service = FakeService([{'items': [google_event(event) for event in events]}])
+    result = await reconcile.Reconciler(executor).reconcile('1', service, events)
+    assert result[1]['unchanged'] == 2
+    assert service.batches == []
+
+@pytest.mark.asyncio
+async def test_already_deleted_event_is_not_a_failure(executor):
+    service = FakeService([{'items': [google_event(SimpleNamespace(**{**vars(make_event(1)), 'id': 'gone'}))]}])
+    result = await reconcile.Reconciler(executor).reconcile('1', service, [])
+    assert result[0] is True
+    assert result[1]['deleted'] == 1
+
+@pytest.mark.asyncio
+async def test_legacy_event_without_guild_property_is_adopted(executor):
+    # events synced before the guild property existed are missing from list_owned, google rejects the create
+    legacy = SimpleNamespace(**{**vars(make_event(1)), 'id': 'legacy'})
+    service = FakeService([{'items': []}])
+    mirror = event_mirror.EventMirror()
+    result = await reconcile.Reconciler(executor, mirror=mirror).reconcile('1', service, [legacy])
+    assert result[0] is True
+    assert result[1]['failed'] == 0
+    assert [batch.requests for batch in service.batches] == [['create:legacy'], ['adopt:legacy']]
+    patch = service.calendar_events.patch.call_args.kwargs
+    assert patch['eventId'] == 'legacy'
+    assert patch['body']['extendedProperties']['private'][calendar_service.GUILD_PROPERTY] == '1'
+    assert mirror.get('1', 'legacy') is not None
+
+@pytest.mark.asyncio
+async def test_reconciled_events_reported(executor):
+    reported = []
+    async def on_reconciled(guild_id, event_ids, loaded_at):
+        reported.append((guild_id, event_ids, loaded_at))
+    events = [make_event(1), make_event(2)]
+    service = FakeService([{'items': [google_event(events[0]), google_event(make_event(3))]}])
+    reconciler = reconcile.Reconciler(executor, on_reconciled=on_reconciled)
+    async def load():
+        return (service, events)
+    result = await reconciler.reconcile_all({'1': load})
+    assert result['failed_guilds'] == 0
+    assert [(guild_id, event_ids) for guild_id, event_ids, _ in reported] == [('1', {'1', '2', '3'})]
+    assert reported[0][2] <= time.time()
+
+@pytest.mark.asyncio
+async def test_reconcile_all_caps_concurrency(executor):
+    running = 0
+    max_running = 0
+    def loader(guild_id):
+        async def load():
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.02)
+            running -= 1
+            if guild_id == 'broken':
+                raise RuntimeError('discord is down')
+            return (FakeService([{'items': []}]), [make_event(1)])
+        return load
+
+    reconciler = reconcile.Reconciler(executor, concurrency=2)
+    result = await reconciler.reconcile_all({guild_id: loader(guild_id) for guild_id in ['1', '2', '3', 'broken']})
+    assert max_running == 2
+    assert result['guilds'] == 4
+    assert result['failed_guilds'] == 1
+    assert result['created'] == 3
+    assert result['seconds'] >= 0.04
+    assert reconciler.last_run is result
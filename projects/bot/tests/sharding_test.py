@@ -0,0 +1,42 @@
+import pytest
+import launcher
+import sharding
+
+def test_guild_served_by_the_process_of_its_shard():
+    guilds = [(n << 22) + 12345 for n in range(40)]
+    for processes, shard_count in ((2, 2), (2, 8), (4, 12)):
+        owned = {}
+        for index in range(processes):
+            shards = sharding.process_shard_ids(index, processes, shard_count)
+            for guild_id in guilds:
+                if sharding.shard_id(guild_id, shard_count) in shards:
+                    owned[guild_id] = index
+        assert owned == {guild_id: sharding.owner_process(guild_id, processes) for guild_id in guilds}
+
+def test_shard_options(monkeypatch):
+    assert sharding.bot_shard_options() == {}
+    monkeypatch.setattr(sharding, 'SHARD_PROCESSES', 2)
+    monkeypatch.setattr(sharding, 'SHARD_INDEX', 1)
+    assert sharding.bot_shard_options() == {'shard_count': 2, 'shard_ids': [1]}
+    monkeypatch.setattr(sharding, 'SHARD_COUNT', 6)
+    assert sharding.bot_shard_options() == {'shard_count': 6, 'shard_ids': [1, 3, 5]}
+    monkeypatch.setattr(sharding, 'SHARD_COUNT', 3)
+    with pytest.raises(ValueError):
+        sharding.bot_shard_options()
+
+def test_process_files_and_ownership(monkeypatch):
+    assert sharding.shard_file('backfill.json') == 'backfill.json'
+    assert sharding.owns(1 << 22)
+    monkeypatch.setattr(sharding, 'SHARD_PROCESSES', 2)
+    monkeypatch.setattr(sharding, 'SHARD_INDEX', 1)
+    assert sharding.shard_file('state/backfill.json') == 'state/backfill.1.json'
+    assert sharding.owns(1 << 22)
+    assert not sharding.owns(2 << 22)
+
+def test_launcher_offsets_ports_per_process(monkeypatch):
+    monkeypatch.delenv('METRICS_PORT', raising=False)
+    supervisor = launcher.Launcher(2, 4, 0, internal_port=8765, metrics_port=9100)
+    environments = [supervisor.environment(index) for index in range(2)]
+    assert [(environment['INTERNAL_PORT'], environment['METRICS_PORT']) for environment in environments] == [
+        ('8765', '9100'), ('8766', '9101')]
+    assert 'METRICS_PORT' not in launcher.Launcher(2, 4, 0, metrics_port=None).environment(1)
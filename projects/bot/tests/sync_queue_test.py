@@ -0,0 +1,115 @@
+import asyncio
+import pytest
+import sync_queue
+from sync_queue import CREATE, UPDATE, DELETE, ATTENDEE
+
+def recorder(calls, name, delay=0):
+    async def operation():
+        await asyncio.sleep(delay)
+        calls.append(name)
+    return operation
+
+@pytest.mark.asyncio
+async def test_operations_run_in_order():
+    queue = sync_queue.EventSyncQueue()
+    calls = []
+    queue.submit('1', '10', CREATE, recorder(calls, 'create', delay=0.02))
+    queue.submit('1', '10', ATTENDEE, recorder(calls, 'attendee'))
+    queue.submit('1', '10', DELETE, recorder(calls, 'delete'))
+    await queue.join()
+    assert calls == ['create', 'attendee', 'delete']
+    assert queue.depth == 0
+    assert queue.processed == 3
+
+@pytest.mark.asyncio
+async def test_pending_updates_coalesced():
+    queue = sync_queue.EventSyncQueue()
+    calls = []
+    queue.submit('1', '10', CREATE, recorder(calls, 'create', delay=0.02))
+    for i in range(5):
+        queue.submit('1', '10', UPDATE, recorder(calls, f'update {i}'))
+    assert queue.depth_of('1', '10') == 2
+    await queue.join()
+    assert calls == ['create', 'update 4']
+    assert queue.coalesced == 4
+
+@pytest.mark.asyncio
+async def test_delete_drops_pending_updates():
+    queue = sync_queue.EventSyncQueue()
+    calls = []
+    queue.submit('1', '10', CREATE, recorder(calls, 'create', delay=0.02))
+    queue.submit('1', '10', UPDATE, recorder(calls, 'update'))
+    queue.submit('1', '10', DELETE, recorder(calls, 'delete'))
+    await queue.join()
+    assert calls == ['create', 'delete']
+    assert queue.coalesced == 1
+
+@pytest.mark.asyncio
+async def test_failed_operation_does_not_stop_queue():
+    queue = sync_queue.EventSyncQueue()
+    calls = []
+    async def fail():
+        raise RuntimeError('google is down')
+    queue.submit('1', '10', CREATE, fail)
+    queue.submit('1', '10', UPDATE, recorder(calls, 'update'))
+    await queue.join()
+    assert calls == ['update']
+
+@pytest.mark.asyncio
+async def test_events_run_concurrently():
+    queue = sync_queue.EventSyncQueue()
+    calls = []
+    queue.submit('1', '10', UPDATE, recorder(calls, 'slow', delay=0.05))
+    queue.submit('1', '11', UPDATE, recorder(calls, 'fast'))
+    await queue.join()
+    assert calls == ['fast', 'slow']
+
+@pytest.mark.asyncio
+async def test_attendee_changes_batched_per_window():
+    queue = sync_queue.EventSyncQueue()
+    applied = []
+    async def apply(guild_id, event_id, changes):
+        applied.append((guild_id, event_id, changes))
+    buffer = sync_queue.AttendeeBuffer(queue, apply, window=0.05)
+    buffer.add('1', '10', 'a')
+    buffer.add('1', '10', 'b')
+    buffer.remove('1', '10', 'c')
+    await asyncio.sleep(0.1)
+    await queue.join()
+    assert applied == [('1', '10', {'a': True, 'b': True, 'c': False})]
+    assert buffer.stats()['flushes'] == 1
+    assert buffer.stats()['max_batch_size'] == 3
+    assert buffer.stats()['max_flush_latency'] >= 0.05
+    assert buffer.batch_sizes.count == 1 and buffer.batch_sizes.sum == 3
+    assert buffer.flush_latency.count == 1
+
+@pytest.mark.asyncio
+async def test_opposite_attendee_changes_net_out():
+    queue = sync_queue.EventSyncQueue()
+    applied = []
+    async def apply(guild_id, event_id, changes):
+        applied.append(changes)
+    buffer = sync_queue.AttendeeBuffer(queue, apply, window=0.05)
+    buffer.add('1', '10', 'a')
+    buffer.remove('1', '10', 'a')
+    buffer.add('1', '10', 'b')
+    buffer.add('1', '10', 'b')
+    await asyncio.sleep(0.1)
+    await queue.join()
+    assert applied == [{'b': True}]
+    assert buffer.stats()['received'] == 4
+
+@pytest.mark.asyncio
+async def test_attendee_buffer_flushes_early_at_max_changes():
+    queue = sync_queue.EventSyncQueue()
+    applied = []
+    async def apply(guild_id, event_id, changes):
+        applied.append(len(changes))
+    buffer = sync_queue.AttendeeBuffer(queue, apply, window=10, max_changes=2)
+    for member_id in 'abcde':
+        buffer.add('1', '10', member_id)
+    await queue.join()
+    assert applied == [2, 2]
+    buffer.flush_all()
+    await queue.join()
+    assert applied == [2, 2, 1]
@@ -0,0 +1,103 @@
+from datetime import datetime
+import asyncio
+import time
+import pytest
+import token_refresher
+
+def test_expiry_timestamp():
+    assert token_refresher.expiry_timestamp('2030-01-01T00:00:00Z') == 1893456000
+    assert token_refresher.expiry_timestamp('2030-01-01T00:00:00.123456Z') == 1893456000
+    assert token_refresher.expiry_timestamp(datetime(2030, 1, 1)) == 1893456000
+
+@pytest.mark.asyncio
+async def test_refreshes_in_expiry_order():
+    refreshed = []
+    async def refresh(guild_id):
+        refreshed.append(guild_id)
+        return None
+    async def unlink(guild_id):
+        pass
+    refresher = token_refresher.TokenRefresher(refresh, unlink, margin=1, jitter=0)
+    now = time.time()
+    refresher.schedule('late', now + 1.1)
+    refresher.schedule('early', now + 1.05)
+    refresher.schedule('later', now + 60)
+    refresher.start()
+    await asyncio.sleep(0.3)
+    await refresher.stop()
+    assert refreshed == ['early', 'late']
+    assert refresher.stats()['scheduled'] == 1
+
+@pytest.mark.asyncio
+async def test_rescheduled_with_new_expiry():
+    refreshed = []
+    async def refresh(guild_id):
+        refreshed.append(guild_id)
+        return time.time() + 60
+    async def unlink(guild_id):
+        pass
+    refresher = token_refresher.TokenRefresher(refresh, unlink, margin=1, jitter=0)
+    refresher.schedule('1', None)
+    refresher.schedule('2', None)
+    refresher.unschedule('2')
+    refresher.start()
+    await asyncio.sleep(0.1)
+    await refresher.stop()
+    assert refreshed == ['1']
+    assert refresher.due['1'] > time.time() + 50
+    assert refresher.stats()['refreshes'] == 1
+
+@pytest.mark.asyncio
+async def test_unknown_expiry_spread_over_jitter():
+    async def refresh(guild_id):
+        return None
+    async def unlink(guild_id):
+        pass
+    refresher = token_refresher.TokenRefresher(refresh, unlink, jitter=30)
+    now = time.time()
+    for guild_id in range(20):
+        refresher.schedule(str(guild_id), None)
+    assert all(now <= due <= now + 31 for due in refresher.due.values())
+    assert len(set(refresher.due.values())) == 20
+
+@pytest.mark.asyncio
+async def test_concurrency_bounded():
+    running = 0
+    max_running = 0
+    async def refresh(guild_id):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.02)
+        running -= 1
+    async def unlink(guild_id):
+        pass
+    refresher = token_refresher.TokenRefresher(refresh, unlink, jitter=0, concurrency=2)
+    for guild_id in range(6):
+        refresher.schedule(str(guild_id), None)
+    refresher.start()
+    await asyncio.sleep(0.2)
+    await refresher.stop()
+    assert max_running == 2
+    assert refresher.refreshes == 6
+
+@pytest.mark.asyncio
+async def test_invalid_grant_unlinks_and_failures_retry():
+    unlinked = []
+    async def refresh(guild_id):
+        if guild_id == 'revoked':
+            raise Exception('invalid_grant: Token has been expired or revoked.')
+        raise Exception('token endpoint unavailable')
+    async def unlink(guild_id):
+        unlinked.append(guild_id)
+    refresher = token_refresher.TokenRefresher(refresh, unlink, margin=1, jitter=0, retry_delay=30)
+    refresher.schedule('revoked', None)
+    refresher.schedule('flaky', None)
+    refresher.start()
+    await asyncio.sleep(0.1)
+    await refresher.stop()
+    assert unlinked == ['revoked']
+    assert 'revoked' not in refresher.due
+    assert refresher.due['flaky'] == pytest.approx(time.time() + 30, abs=1)
+    assert refresher.stats()['failures'] == 1
+    assert refresher.stats()['revoked'] == 1
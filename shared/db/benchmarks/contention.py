@@ -0,0 +1,97 @@
+"""Measures write throughput on a shared guilds database while several api workers and the bot poller
+hit it at the same time, once with sqlite defaults and once with the tuned pragmas.
+
+usage: python benchmarks/contention.py [--workers 4] [--seconds 10] [--guilds 500]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine, text, bindparam
+from sqlalchemy.exc import OperationalError
+
+from db import SQLITE_PRAGMAS, set_sqlite_pragmas
+
+
+def make_engine(path: str, tuned: bool):
+    engine = create_engine(f'sqlite:///{path}', connect_args={'timeout': 5})
+    if tuned:
+        set_sqlite_pragmas(engine, SQLITE_PRAGMAS)
+    return engine
+
+def api_worker(path: str, tuned: bool, guilds: int, deadline: float, results):
+    """stores credentials like oauth2callback does, one short transaction per request"""
+    engine = make_engine(path, tuned)
+    writes = errors = 0
+    while time.time() < deadline:
+        try:
+            with engine.connect() as con:
+                guild_id = str(random.randrange(guilds))
+                con.execute(text("SELECT * FROM guild WHERE guild_id=:id"), {'id': guild_id}).fetchone()
+                con.execute(text("UPDATE guild SET credential=:cred WHERE guild_id=:id"),
+                            {'id': guild_id, 'cred': json.dumps({'token': random.random()})})
+                con.commit()
+                writes += 1
+        except OperationalError:
+            errors += 1
+    results.put(('api', writes, errors))
+
+def bot_worker(path: str, tuned: bool, guilds: int, deadline: float, results):
+    """polls sign ins in batches and starts new sign ins like GoogeAuthConnect does"""
+    engine = make_engine(path, tuned)
+    writes = errors = reads = 0
+    query = text("SELECT guild_id, credential, state FROM guild WHERE guild_id IN :ids AND credential IS NOT NULL"
+                 ).bindparams(bindparam('ids', expanding=True))
+    while time.time() < deadline:
+        try:
+            with engine.connect() as con:
+                con.execute(query, {'ids': [str(random.randrange(guilds)) for _ in range(10)]}).fetchall()
+                reads += 1
+                con.execute(text("INSERT OR REPLACE INTO guild (guild_id, credential, state) VALUES (:id, NULL, :state)"),
+                            {'id': str(random.randrange(guilds)), 'state': str(random.random())})
+                con.commit()
+                writes += 1
+        except OperationalError:
+            errors += 1
+    results.put(('bot', writes, errors, reads))
+
+def run(tuned: bool, workers: int, seconds: float, guilds: int) -> dict:
+    path = os.path.join(tempfile.mkdtemp(), 'guilds.db')
+    engine = make_engine(path, tuned)
+    with engine.begin() as con:
+        con.execute(text("CREATE TABLE guild (guild_id TEXT PRIMARY KEY, credential TEXT, state TEXT)"))
+        for guild_id in range(guilds):
+            con.execute(text("INSERT INTO guild VALUES (:id, NULL, 'state')"), {'id': str(guild_id)})
+    engine.dispose()
+
+    results = multiprocessing.Queue()
+    deadline = time.time() + seconds
+    processes = [multiprocessing.Process(target=api_worker, args=(path, tuned, guilds, deadline, results))
+                 for _ in range(workers)]
+    processes.append(multiprocessing.Process(target=bot_worker, args=(path, tuned, guilds, deadline, results)))
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    writes = sum(outcome[1] for outcome in outcomes)
+    return {
+        'mode': 'tuned' if tuned else 'default',
+        'writes_per_second': round(writes / seconds, 1),
+        'bot_polls_per_second': round(sum(outcome[3] for outcome in outcomes if outcome[0] == 'bot') / seconds, 1),
+        'locked_errors': sum(outcome[2] for outcome in outcomes),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--guilds', type=int, default=500)
+    args = parser.parse_args()
+    for tuned in (False, True):
+        print(json.dumps(run(tuned, args.workers, args.seconds, args.guilds)))
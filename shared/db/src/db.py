@@ -1,18 +1,145 @@
-from sqlalchemy import create_engine, text, Connection, Engine
+from sqlalchemy import create_engine, event, text, Connection, Engine
 from flask import current_app, g, Flask
 import click
+import threading
+import time
+from metrics import QueryProfiler, time_statements
+from pragmas import SQLITE_PRAGMAS, set_sqlite_pragmas, sqlite_pragmas
 
-def db(uri=None):
-    engine = None
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_TIMEOUT = 30
+
+
+class PoolStats:
+
+    def __init__(self, engine: Engine):
+        """ tracks checkouts of an engine's connection pool
+
+        Args:
+            engine (Engine): the engine whose pool is tracked
+        """
+        self.engine = engine
+        self.checked_out = 0
+        self.checkouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        event.listen(engine, 'checkout', self.on_checkout)
+        event.listen(engine, 'checkin', self.on_checkin)
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.checked_out += 1
+        self.checkouts += 1
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        self.checked_out -= 1
+
+    def record_wait(self, seconds: float):
+        self.wait_time_total += seconds
+        self.wait_time_max = max(self.wait_time_max, seconds)
+
+    def as_dict(self) -> dict:
+        pool = self.engine.pool
+        size = getattr(pool, 'size', None)
+        overflow = getattr(pool, 'overflow', None)
+        return {
+            'pool': type(pool).__name__,
+            'size': size() if callable(size) else size,
+            'checked_out': self.checked_out,
+            'overflow': overflow() if callable(overflow) else None,
+            'checkouts': self.checkouts,
+            'wait_time_total': self.wait_time_total,
+            'wait_time_max': self.wait_time_max,
+        }
+
+
+engines_lock = threading.Lock()
+
+def get_engine(uri=None) -> Engine:
+    """gets the engine of the current app for a database uri, engines are created once per app
+    and uri so every request shares the same connection pool
+
+    Args:
+        uri (str | None): the database uri, defaults to the DATABASE config of the app
+
+    Returns:
+        Engine: the sqlalchemy engine
+    """
+    return get_engine_entry(uri)[0]
+
+def get_engine_entry(uri=None) -> tuple[Engine, PoolStats]:
     if uri is None:
-        engine = create_engine(current_app.config.get('DATABASE'),
-                               pool_recycle=3600,
-                               echo=True)
-    else:
-        engine = create_engine(uri, pool_recycle=3600, echo=True)
-    
+        uri = current_app.config.get('DATABASE')
+    engines = current_app.extensions.setdefault('db_engines', {})
+    entry = engines.get(uri)
+    if entry is None:
+        with engines_lock:
+            entry = engines.get(uri)
+            if entry is None:
+                options = {'pool_recycle': 3600, 'echo': current_app.config.get('DATABASE_ECHO', False)}
+                if ':memory:' not in uri:
+                    options.update({
+                        'pool_size': current_app.config.get('DATABASE_POOL_SIZE', DEFAULT_POOL_SIZE),
+                        'max_overflow': current_app.config.get('DATABASE_MAX_OVERFLOW', DEFAULT_MAX_OVERFLOW),
+                        'pool_timeout': current_app.config.get('DATABASE_POOL_TIMEOUT', DEFAULT_POOL_TIMEOUT),
+                    })
+                engine = create_engine(uri, **options)
+                if uri.startswith('sqlite'):
+                    set_sqlite_pragmas(engine, sqlite_pragmas(current_app.config))
+                profiler = get_query_profiler()
+                if profiler is not None:
+                    profiler.attach(engine)
+                # set by the app to observe the time of every statement
+                statement_latency = current_app.extensions.get('db_statement_latency')
+                if statement_latency is not None:
+                    time_statements(engine, statement_latency)
+                entry = (engine, PoolStats(engine))
+                engines[uri] = entry
+    return entry
+
+def get_query_profiler() -> QueryProfiler | None:
+    """gets the query profiler of the current app, profiling is opt in through the QUERY_PROFILING config
+
+    Returns:
+        QueryProfiler | None: the profiler, None if profiling is disabled
+    """
+    if not current_app.config.get('QUERY_PROFILING', False):
+        return None
+    profiler = current_app.extensions.get('query_profiler')
+    if profiler is None:
+        profiler = current_app.extensions.setdefault('query_profiler', QueryProfiler(
+            sample_rate=current_app.config.get('QUERY_SAMPLE_RATE', 1.0),
+            slow_query_threshold=current_app.config.get('SLOW_QUERY_THRESHOLD', 0.5)))
+    return profiler
+
+def dispose_engines(app: Flask):
+    """drops the pooled connections a forked worker inherited from its parent without closing them,
+    the parent keeps using its own connections and the worker opens new ones
+
+    Args:
+        app (Flask): the app whose engines are disposed
+    """
+    for engine, stats in app.extensions.get('db_engines', {}).values():
+        engine.dispose(close=False)
+
+def pool_stats(app: Flask | None = None) -> dict:
+    """
+    Args:
+        app (Flask | None): the app whose engines are read, the current app if None. metric collectors run
+            outside the app context and pass the app
+
+    Returns:
+        dict: the pool statistics of every engine of the app keyed by database uri
+    """
+    engines = (app or current_app).extensions.get('db_engines', {})
+    return {uri: stats.as_dict() for uri, (engine, stats) in engines.items()}
+
+def db(uri=None):
     if 'con' not in g:
-        g.con = next(get_connection(engine))
+        engine, stats = get_engine_entry(uri)
+        start = time.perf_counter()
+        g.con = engine.connect()
+        stats.record_wait(time.perf_counter() - start)
 
     return g.con
 
@@ -37,9 +164,9 @@ def init_db():
     con.commit()
 
 def close_db(e=None):
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    con = g.pop('con', None)
+    if con is not None:
+        con.close()
 
 @click.command('init-db')
 def init_db_command():
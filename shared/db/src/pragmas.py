@@ -0,0 +1,37 @@
+from sqlalchemy import event, Engine
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 268435456,
+    'cache_size': -20000,
+}
+
+
+def set_sqlite_pragmas(engine: Engine, pragmas: dict):
+    """runs PRAGMA statements on every new connection of a sqlite engine, WAL journaling lets the api
+    workers and the bot read while another process writes to the shared database
+
+    Args:
+        engine (Engine): the sqlite engine
+        pragmas (dict): pragma names mapped to their values
+    """
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    event.listen(engine, 'connect', on_connect)
+
+def sqlite_pragmas(config) -> dict:
+    """reads the sqlite pragmas from a config, SQLITE_<PRAGMA> overrides the default of a pragma
+
+    Args:
+        config (flask.Config | os._Environ): the app config or the environment
+
+    Returns:
+        dict: pragma names mapped to their values
+    """
+    return {name: config.get(f'SQLITE_{name.upper()}', value) for name, value in SQLITE_PRAGMAS.items()}
@@ -3,13 +3,122 @@ import os
 import asyncio
 import time
 import secrets
-from sqlalchemy import create_engine, text
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from sqlalchemy import create_engine, text, bindparam
 from termcolor import colored
+from metrics import Histogram, QueryProfiler
+from pragmas import set_sqlite_pragmas, sqlite_pragmas
 POLLING_INTERVAL = 5
+FALLBACK_POLLING_INTERVAL = 60
 BATCH_SIZE = 10
 EXPIRATION_TIME = 500
 LINKED_FILE = 'linked.json'
-engine = create_engine(os.environ.get('DATABASE_URL', 'sqlite:///database/guilds.db'), pool_recycle=3600, echo=True)
+EMAIL_CACHE_SIZE = 512
+EMAIL_CACHE_TTL = 600
+# the queries use sqlite syntax like INSERT OR REPLACE, aiosqlite is the only declared asyncio driver
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+}
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///database/guilds.db')
+DATABASE_ECHO = os.environ.get('DATABASE_ECHO', 'false').lower() == 'true'
+engine = create_engine(DATABASE_URL, pool_recycle=3600, echo=DATABASE_ECHO)
+async_engine = None
+
+# SQLITE_<PRAGMA> environment variables override the default pragmas of shared/db
+if engine.dialect.name == 'sqlite':
+    set_sqlite_pragmas(engine, sqlite_pragmas(os.environ))
+
+query_profiler = None
+if os.environ.get('QUERY_PROFILING', 'false').lower() == 'true':
+    query_profiler = QueryProfiler(sample_rate=float(os.environ.get('QUERY_SAMPLE_RATE', 1.0)),
+                                   slow_query_threshold=float(os.environ.get('SLOW_QUERY_THRESHOLD', 0.5)))
+    query_profiler.attach(engine)
+
+def async_database_url(url: str) -> str:
+    """ swaps the driver of a database url for an asyncio driver, urls that already name a driver are kept
+
+    Args:
+        url (str): the database url
+
+    Returns:
+        str: the url with an asyncio driver
+
+    Raises:
+        ValueError: if there is no asyncio driver for the database of the url
+    """
+    scheme, separator, rest = url.partition('://')
+    if '+' in scheme:
+        return url
+    if scheme not in ASYNC_DRIVERS:
+        raise ValueError(f'no asyncio driver for {scheme} databases, set ASYNC_DATABASE_URL')
+    return f'{ASYNC_DRIVERS[scheme]}{separator}{rest}'
+
+def get_async_engine():
+    """ gets the asyncio engine, it is created on first use so the async driver is only needed when
+    async database access is enabled. ASYNC_DATABASE_URL overrides the url derived from DATABASE_URL
+    Returns:
+        AsyncEngine: the sqlalchemy asyncio engine
+    """
+    global async_engine
+    if async_engine is None:
+        from sqlalchemy.ext.asyncio import create_async_engine
+        url = os.environ.get('ASYNC_DATABASE_URL') or async_database_url(DATABASE_URL)
+        options = {'pool_recycle': 3600, 'echo': DATABASE_ECHO}
+        if ':memory:' not in url:
+            options.update({
+                'pool_size': int(os.environ.get('DATABASE_POOL_SIZE', 5)),
+                'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW', 10)),
+            })
+        async_engine = create_async_engine(url, **options)
+        if async_engine.dialect.name == 'sqlite':
+            set_sqlite_pragmas(async_engine.sync_engine, sqlite_pragmas(os.environ))
+        if query_profiler is not None:
+            query_profiler.attach(async_engine.sync_engine)
+    return async_engine
+
+def write_linked_file(linked: dict, path: str):
+    """ atomically replaces the linked credentials file, the data is written to a temporary file
+    that is renamed over the old file so a crash never leaves a partially written file behind
+
+    Args:
+        linked (dict): the linked credentials to save
+        path (str): the path of the file
+    """
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(linked, f, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+def init_shared_state(con):
+    """ creates the sign in table, sign ins are kept in the database when several bot processes share the
+    link state. a guild is linked once its credentials are stored and it has no sign in row left
+
+    Args:
+        con (Connection): the connection to create the table on
+    """
+    con.execute(text('''CREATE TABLE IF NOT EXISTS sign_in (
+        guild_id TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        expire_time REAL NOT NULL
+    )'''))
+
+def load_shared_linked(owns) -> dict:
+    """ loads the linked credentials of the guilds a bot process serves from the database
+
+    Args:
+        owns (Callable[[str], bool]): decides if a guild is served by the process
+
+    Returns:
+        dict: guild ids mapped to their linked credentials
+    """
+    with engine.begin() as con:
+        init_shared_state(con)
+        rows = con.execute(text('''SELECT guild_id, credential FROM guild WHERE credential IS NOT NULL
+            AND guild_id NOT IN (SELECT guild_id FROM sign_in)''')).fetchall()
+    return {row[0]: json.loads(row[1]) for row in rows if owns(row[0])}
 
 def get_connection():
     """ gets a connection to the database
@@ -21,13 +130,36 @@ def get_connection():
 
 class GoogeAuthConnect:
 
-    def __init__(self, api_prefix='http://localhost:5000/'):
+    def __init__(self, api_prefix='http://localhost:5000/', push_enabled=False, async_db=False,
+                 shared_state=False, owns=None):
         """ initializes the GoogleAuthConnect class
+
+        Args:
+            api_prefix (str): the base url of the api server
+            push_enabled (bool): if the api notifies the bot when credentials are stored, polling then only
+                runs every FALLBACK_POLLING_INTERVAL seconds
+            async_db (bool): if queries go through the pooled asyncio engine instead of blocking the event loop
+            shared_state (bool): if linked credentials and sign ins live in the database instead of the process
+                and linked.json, so several bot processes can share them
+            owns (Callable[[str], bool] | None): decides if a guild is served by this process, the guilds of other
+                processes are not loaded or linked. every guild is served if None
         """
+        self.push_enabled = push_enabled
+        self.async_db = async_db
+        self.shared_state = shared_state
+        self.owns = owns if owns is not None else (lambda guild_id: True)
         self.active_sign_ins = {}
         self.linked = {}
+        self.linked_dirty = False
+        self.save_lock = asyncio.Lock()
+        self.link_listeners = []
+        self.email_cache = OrderedDict()
         self.api_prefix = api_prefix
-        if os.path.exists(LINKED_FILE):
+        self.poll_latency = Histogram()
+        if shared_state:
+            self.linked = load_shared_linked(self.owns)
+            print(colored(f'loaded {colored(len(self.linked), 'light_cyan')} {colored('linked credentials', 'green')}', 'green'))
+        elif os.path.exists(LINKED_FILE):
             with open(LINKED_FILE, 'r') as f:
                 try:
                     self.linked = json.load(f)
@@ -40,12 +172,94 @@ class GoogeAuthConnect:
         self.exiting = False 
     
     async def save_linked(self):
-        """saves linked credentials to a json file
+        """saves linked credentials to a json file if they changed since the last save, the file is
+        written in a worker thread so the event loop is not blocked
         Returns:
             None: None 
         """
-        with open(LINKED_FILE, 'w') as f:
-            json.dump(self.linked, f, indent=4)
+        if not self.linked_dirty or self.shared_state:
+            return
+        async with self.save_lock:
+            if not self.linked_dirty:
+                return
+            self.linked_dirty = False
+            snapshot = dict(self.linked)
+            try:
+                await asyncio.to_thread(write_linked_file, snapshot, LINKED_FILE)
+            except Exception:
+                self.linked_dirty = True
+                raise
+
+    @asynccontextmanager
+    async def connection(self):
+        """ opens a database connection, an AsyncConnection from the asyncio engine's pool if async_db
+        is set and a blocking Connection otherwise
+        """
+        if self.async_db:
+            async with get_async_engine().connect() as con:
+                yield con
+        else:
+            con = get_connection()
+            try:
+                yield con
+            finally:
+                con.close()
+
+    async def fetch_all(self, statement, params: dict, con=None):
+        """ runs a query and ends its transaction so the connection does not hold a read snapshot
+
+        Args:
+            statement (TextClause): the query to run
+            params (dict): the query parameters
+            con (AsyncConnection | Connection | None): a connection from connection() to reuse, a new one is opened if None
+
+        Returns:
+            list[Row]: the result rows
+        """
+        if con is None:
+            async with self.connection() as con:
+                return await self.fetch_all(statement, params, con)
+        if self.async_db:
+            rows = (await con.execute(statement, params)).fetchall()
+            await con.rollback()
+        else:
+            rows = con.execute(statement, params).fetchall()
+            con.rollback()
+        return rows
+
+    async def execute_commit(self, statement, params: dict):
+        """ runs a write statement on a new connection and commits it
+
+        Args:
+            statement (TextClause): the statement to run
+            params (dict): the statement parameters
+
+        Returns:
+            int: the number of rows the statement changed
+        """
+        async with self.connection() as con:
+            if self.async_db:
+                result = await con.execute(statement, params)
+                await con.commit()
+            else:
+                result = con.execute(statement, params)
+                con.commit()
+            return result.rowcount
+
+    def add_link_listener(self, listener):
+        """ registers a callback that is called with the guild id whenever the linked credentials of a guild change
+
+        Args: listener (Callable[[str], None]): the callback to register
+        """
+        self.link_listeners.append(listener)
+
+    def notify_link_listeners(self, guild_id: str):
+        """ calls every registered link listener for a guild whose linked credentials changed
+
+        Args: guild_id (str): the id of the guild that changed
+        """
+        for listener in self.link_listeners:
+            listener(guild_id)
 
     async def stop_polling(self):
         """ stops the polling task
@@ -53,33 +267,87 @@ class GoogeAuthConnect:
         self.exiting = True
         await self.poll()
 
-    async def poll_batch(self, batch: dict[str, dict[str:str]]):
+    async def poll_batch(self, batch: dict[str, dict[str:str]], con=None):
         """processes batches of login requests and links credentials
 
-        Args: batch (dict[str, dict[str:str]]): a dictionary of guild ids to info (expire_time, state) dictionaries
+        Args:
+            batch (dict[str, dict[str:str]]): a dictionary of guild ids to info (expire_time, state) dictionaries
+            con (Connection | None): a connection to reuse for the credential lookup
         Returns:
             None: None
         """
+        credentials = await self.get_credentials_batch(list(batch), con)
         for guild_id, info in batch.items():
-            result = await self.get_credentials(guild_id)
+            result = credentials.get(guild_id, (None, None))
             if info.get('state') == result[1] and result[0] is not None and info.get('expire_time') > time.time():
+                if self.shared_state and not await self.claim_sign_in(guild_id, info['state']):
+                    self.active_sign_ins.pop(guild_id, None)
+                    continue
                 self.linked[guild_id] = result[0]
-                self.active_sign_ins.pop(guild_id)
+                self.linked_dirty = True
+                self.active_sign_ins.pop(guild_id, None)
+                self.notify_link_listeners(guild_id)
             if info.get('expire_time') <= time.time():
-                self.active_sign_ins.pop(guild_id)
+                self.active_sign_ins.pop(guild_id, None)
         await self.save_linked()
 
+    async def claim_sign_in(self, guild_id: str, state: str) -> bool:
+        """ removes the sign in row of a guild that finished signing in, only one process can remove it so
+        a guild is linked once
+
+        Returns:
+            bool: True if this process completed the sign in
+        """
+        return await self.execute_commit(
+            text("DELETE FROM sign_in WHERE guild_id=:guild_id AND state=:state"),
+            {'guild_id': guild_id, 'state': state}) == 1
+
+    async def load_sign_ins(self):
+        """ replaces the active sign ins with the unexpired sign ins of the served guilds in the database, which
+        includes the sign ins started before the process restarted
+        """
+        rows = await self.fetch_all(
+            text("SELECT guild_id, state, expire_time FROM sign_in WHERE expire_time > :now"), {'now': time.time()})
+        self.active_sign_ins = {row[0]: {'expire_time': row[2], 'state': row[1]} for row in rows if self.owns(row[0])}
+
     async def poll(self):
         while True:
-            for i in range(0, len(self.active_sign_ins), BATCH_SIZE):
-                batch = dict(
-                    list(self.active_sign_ins.items())[i:i + BATCH_SIZE])
-                await self.poll_batch(batch)
-            await asyncio.sleep(POLLING_INTERVAL)
+            start = time.perf_counter()
+            if self.shared_state:
+                await self.load_sign_ins()
+            if self.active_sign_ins:
+                sign_ins = list(self.active_sign_ins.items())
+                async with self.connection() as con:
+                    for i in range(0, len(sign_ins), BATCH_SIZE):
+                        await self.poll_batch(dict(sign_ins[i:i + BATCH_SIZE]), con)
+            self.poll_latency.observe(time.perf_counter() - start)
+            await asyncio.sleep(FALLBACK_POLLING_INTERVAL if self.push_enabled else POLLING_INTERVAL)
             if self.exiting is True:
                 self.polling_task.cancel()
                 break
 
+    async def complete_sign_in(self, guild_id: str):
+        """links a guild as soon as the api reports its credentials were stored
+
+        Args:
+            guild_id (str): the id of the guild that finished signing in
+
+        Returns:
+            tuple: tuple[bool, str] True and a message if the guild was linked, None and an error otherwise
+        """
+        guild_id = str(guild_id)
+        if self.shared_state and guild_id not in self.active_sign_ins:
+            if not self.owns(guild_id):
+                return (None, f'guild {guild_id} is served by another process')
+            await self.load_sign_ins()
+        info = self.active_sign_ins.get(guild_id)
+        if info is None:
+            return (None, f'no active sign in for guild {guild_id}')
+        await self.poll_batch({guild_id: info})
+        if guild_id not in self.linked:
+            return (None, f'credentials for guild {guild_id} could not be linked')
+        return (True, f'linked guild {guild_id}')
+
     async def get_credentials(self, guild_id):
         """Gets the credentials for a guild from the database.
 
@@ -89,19 +357,39 @@ class GoogeAuthConnect:
         Returns:
             tuple: tuple[dict[str: str], str] A tuple containing the credentials and the state.
         """
-        con = get_connection()
-        result = con.execute(
+        results = await self.fetch_all(
             text(
                 "SELECT credential, state FROM guild WHERE guild_id=:guild_id AND credential IS NOT NULL"
             ), {
                 'guild_id': guild_id
-            }).fetchone()
+            })
+        result = results[0] if results else None
         if result is None:
             print(f'googleauthconnect: No credentials found for guild {guild_id}')
             return (None, None)
 
-        con.close()
         return (json.loads(result[0]), result[1])
+
+    async def get_credentials_batch(self, guild_ids: list[str], con=None):
+        """Gets the credentials for several guilds with a single query.
+
+        Args:
+            guild_ids: The IDs of the guilds to get credentials for.
+            con: A connection to reuse, a new connection is opened and closed if None.
+
+        Returns:
+            dict: dict[str, tuple[dict[str: str], str]] guild ids mapped to their credentials and state,
+            guilds without credentials are left out.
+        """
+        if not guild_ids:
+            return {}
+        results = await self.fetch_all(
+            text(
+                "SELECT guild_id, credential, state FROM guild WHERE guild_id IN :guild_ids AND credential IS NOT NULL"
+            ).bindparams(bindparam('guild_ids', expanding=True)), {
+                'guild_ids': list(guild_ids)
+            }, con)
+        return {row[0]: (json.loads(row[1]), row[2]) for row in results}
     
     async def get_auth_url(self, guild_id): 
         """Generates an authorization URL to start the OAuth flow.
@@ -112,9 +400,9 @@ class GoogeAuthConnect:
         Returns:
             str: The authorization URL
         """
+        guild_id = str(guild_id)
         state = secrets.token_urlsafe(16)
-        con = get_connection()
-        con.execute(
+        await self.execute_commit(
             text(
                 "INSERT OR REPLACE INTO guild (guild_id, credential ,state) VALUES (:guild_id,:credential ,:state)"
             ), {
@@ -122,25 +410,98 @@ class GoogeAuthConnect:
                 'credential': None,
                 'state': state
             })
-        con.commit()
         self.active_sign_ins[guild_id] = {
             'expire_time': time.time() + EXPIRATION_TIME,
             'state': state
         }
-        con.close()
+        if self.shared_state:
+            await self.execute_commit(
+                text("INSERT OR REPLACE INTO sign_in (guild_id, state, expire_time) VALUES (:guild_id, :state, :expire_time)"), {
+                    'guild_id': guild_id,
+                    'state': state,
+                    'expire_time': self.active_sign_ins[guild_id]['expire_time']
+                })
         return f'{self.api_prefix}authorize/{guild_id}/{state}'
 
     async def get_linked_credentials(self, guild_id: str):
         return self.linked.get(guild_id)
-    
-    async def add_user_email(self, guild_id: str, member_id: str, email: str):
+
+    async def update_credentials(self, guild_id: str, changes: dict):
+        """saves a refreshed access token of a linked guild to the linked credentials and the database,
+        link listeners are not notified since the guild is still linked to the same account
+
+        Args:
+            guild_id (str): the id of the guild
+            changes (dict): the credential fields that changed, like token and expiry
+
+        Returns:
+            tuple: tuple[bool, str] True and a message if the credentials were saved, None and an error otherwise
+        """
+        guild_id = str(guild_id)
+        current = self.linked.get(guild_id)
+        if current is None:
+            return (None, f'no linked credentials for guild {guild_id}')
+        changes = {key: value for key, value in changes.items() if value is not None}
+        if all(current.get(key) == value for key, value in changes.items()):
+            return (True, f'credentials of guild {guild_id} are up to date')
+        # replaced instead of updated in place so snapshots taken by save_linked stay consistent
+        credentials = {**current, **changes}
+        self.linked[guild_id] = credentials
+        self.linked_dirty = True
         try:
+            await self.execute_commit(
+                text("UPDATE guild SET credential=:credential WHERE guild_id=:guild_id"), {
+                    'guild_id': guild_id,
+                    'credential': json.dumps(credentials)
+                })
+        except Exception as e:
+            return (None, str(e))
+        await self.save_linked()
+        return (True, f'saved refreshed credentials of guild {guild_id}')
 
-            if guild_id not in self.linked:
-                return (None, 'No linked credentials for guild')
+    async def unlink(self, guild_id: str):
+        """removes the linked credentials of a guild, used when its refresh token was revoked so the
+        guild has to sign in again. link listeners are notified
+
+        Args:
+            guild_id (str): the id of the guild
+
+        Returns:
+            tuple: tuple[bool, str] True and a message if the guild was unlinked, None and an error otherwise
+        """
+        guild_id = str(guild_id)
+        if self.linked.pop(guild_id, None) is None:
+            return (None, f'guild {guild_id} is not linked')
+        self.linked_dirty = True
+        self.email_cache.pop(guild_id, None)
+        try:
+            await self.execute_commit(
+                text("UPDATE guild SET credential=NULL WHERE guild_id=:guild_id"), {'guild_id': guild_id})
+        except Exception as e:
+            return (None, str(e))
+        finally:
+            self.notify_link_listeners(guild_id)
+        await self.save_linked()
+        return (True, f'unlinked guild {guild_id}')
     
-            con = get_connection()
-            con.execute(text('''
+    async def add_user_email(self, guild_id: str, member_id: str, email: str):
+        """adds or replaces the email of a guild member and drops the cached emails of the guild
+
+        Args:
+            guild_id (str): the id of the guild
+            member_id (str): the id of the member
+            email (str): the email the member receives calendar invites at
+
+        Returns:
+            tuple: tuple[bool, str] True and a message if successful, None and an error otherwise
+        """
+        guild_id = str(guild_id)
+        member_id = str(member_id)
+        if guild_id not in self.linked:
+            return (None, 'No linked credentials for guild')
+
+        try:
+            await self.execute_commit(text('''
                 INSERT OR REPLACE INTO linked (guild_id, member_id, email) VALUES (:guild_id, :member_id, :email)
             '''), {
                 'guild_id': guild_id,
@@ -148,35 +509,80 @@ class GoogeAuthConnect:
                 'email': email
             })
 
+            # INSERT OR REPLACE deletes the rows it conflicts with, the cache is reloaded instead of patched
+            self.email_cache.pop(guild_id, None)
+
             return (True, f'Added member {member_id} to guild {guild_id}')
 
         except Exception as e:
             return (None, str(e))
 
-        finally:
-            con.commit()
-            con.close()
+    def cached_emails(self, guild_id: str):
+        """gets the cached email map of a guild if it has not expired
+
+        Args:
+            guild_id (str): the id of the guild
+
+        Returns:
+            dict[str, str] | None: member ids mapped to emails, None on a cache miss
+        """
+        cached = self.email_cache.get(guild_id)
+        if cached is None:
+            return None
+        if cached[0] + EMAIL_CACHE_TTL <= time.time():
+            self.email_cache.pop(guild_id)
+            return None
+        self.email_cache.move_to_end(guild_id)
+        return cached[1]
 
     async def get_user_emails(self, guild_id: str):
-        try:
-            if guild_id not in self.linked:
-                return (None, 'No linked credentials for guild')
+        """gets the emails of the linked members of a guild, loading them with a single query on a cache miss
 
-            con = get_connection()
-            results = con.execute(text('''
+        Args:
+            guild_id (str): the id of the guild
+
+        Returns:
+            tuple: tuple[dict[str, str], str] member ids mapped to emails and a message, None and an error otherwise
+        """
+        guild_id = str(guild_id)
+        if guild_id not in self.linked:
+            return (None, 'No linked credentials for guild')
+
+        results_dict = self.cached_emails(guild_id)
+        if results_dict is not None:
+            return (results_dict, f'retrieved linked members for {guild_id}')
+
+        try:
+            results = await self.fetch_all(text('''
                 SELECT member_id, email FROM linked WHERE guild_id=:guild_id
             '''), {
                 'guild_id': guild_id
-            }).fetchall()
-
-            if results is None:
-                return (None, 'guild has no linked members')
+            })
 
             results_dict = {row[0]:row[1] for row in results}
+            self.email_cache[guild_id] = (time.time(), results_dict)
+            if len(self.email_cache) > EMAIL_CACHE_SIZE:
+                self.email_cache.popitem(last=False)
 
             return (results_dict, f'retrieved linked members for {guild_id}')
 
         except Exception as e:
             return (None, str(e))
-        finally:
-            con.close()
\ No newline at end of file
+
+    async def get_user_email(self, guild_id: str, member_id: str):
+        """gets the email of a single guild member
+
+        Args:
+            guild_id (str): the id of the guild
+            member_id (str): the id of the member
+
+        Returns:
+            tuple: tuple[str, str] the email and a message, None and an error otherwise
+        """
+        emails = await self.get_user_emails(guild_id)
+        if emails[0] is None:
+            return emails
+        email = emails[0].get(str(member_id))
+        if email is None:
+            return (None, 'User has not added their email to the bot')
+        return (email, f'retrieved email of member {member_id}')
@@ -0,0 +1,17 @@
+import hashlib
+import hmac
+
+
+def channel_token(guild_id: str, secret: str | None) -> str:
+    """builds the token the bot gives the google calendar push channel of a guild, google sends it back
+    with every notification and the api checks the signature before waking the bot
+
+    Args:
+        guild_id (str): the id of the guild the channel watches
+        secret (str | None): the api key shared by the bot and the api
+
+    Returns:
+        str: the guild id and its signature
+    """
+    signature = hmac.new((secret or '').encode(), str(guild_id).encode(), hashlib.sha256).hexdigest()[:32]
+    return f'{guild_id}.{signature}'
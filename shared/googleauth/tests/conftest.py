@@ -0,0 +1,21 @@
+from sqlalchemy import text
+import pytest
+import googleauth
+
+"""Creates the guild tables in the test database before each test."""
+@pytest.fixture(autouse=True)
+def init_db():
+    con = googleauth.get_connection()
+    con.execute(text('''CREATE TABLE IF NOT EXISTS guild (
+        guild_id TEXT PRIMARY KEY,
+        credential TEXT,
+        state TEXT
+    )'''))
+    con.execute(text('''CREATE TABLE IF NOT EXISTS linked (
+        guild_id TEXT PRIMARY KEY,
+        member_id TEXT NOT NULL UNIQUE,
+        email TEXT NOT NULL UNIQUE
+    )'''))
+    con.commit()
+    con.close()
+    return True
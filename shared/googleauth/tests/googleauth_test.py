@@ -2,6 +2,7 @@ from pytest_mock import MockerFixture
 from sqlalchemy import text
 import pytest
 import googleauth
+import push_channels
 import json
 import time
 import asyncio
@@ -83,7 +84,7 @@ async def test_polling(mocker: MockerFixture):
         con = googleauth.get_connection()
         test_ga = googleauth.GoogeAuthConnect()
 
-        get_cred_spy = mocker.spy(test_ga, 'get_credentials')
+        get_cred_spy = mocker.spy(test_ga, 'get_credentials_batch')
         batch_spy = mocker.spy(test_ga, 'poll_batch')
         creds = json.dumps({
             "token": "abc",
@@ -121,3 +122,276 @@ async def test_polling(mocker: MockerFixture):
 
     finally:
         reset_database(con)
+
+@pytest.mark.asyncio
+async def test_link_listener_notified(mocker: MockerFixture, tmp_path):
+    mocker.patch.object(googleauth, 'LINKED_FILE', str(tmp_path / 'linked.json'))
+    test_ga = googleauth.GoogeAuthConnect()
+    listener = mocker.Mock()
+    test_ga.add_link_listener(listener)
+    mocker.patch.object(test_ga, 'get_credentials_batch', return_value={'123': ({'token': 'abc'}, 'xyz')})
+    test_ga.active_sign_ins = {'123': {'expire_time': time.time() + 300, 'state': 'xyz'}}
+
+    await test_ga.poll_batch(dict(test_ga.active_sign_ins))
+
+    listener.assert_called_once_with('123')
+    assert test_ga.linked['123'] == {'token': 'abc'}
+    await test_ga.stop_polling()
+
+@pytest.mark.asyncio
+async def test_user_emails_cached(mocker: MockerFixture, tmp_path):
+    try:
+        mocker.patch.object(googleauth, 'LINKED_FILE', str(tmp_path / 'linked.json'))
+        con = googleauth.get_connection()
+        test_ga = googleauth.GoogeAuthConnect()
+        test_ga.linked['123'] = {'token': 'abc'}
+        con.execute(text("INSERT INTO linked VALUES('123', '1', 'a@example.com')"))
+        con.commit()
+        connection_spy = mocker.spy(googleauth, 'get_connection')
+
+        emails, _ = await test_ga.get_user_emails('123')
+        assert emails == {'1': 'a@example.com'}
+        email, _ = await test_ga.get_user_email('123', '1')
+        assert email == 'a@example.com'
+        missing, _ = await test_ga.get_user_email('123', '2')
+        assert missing is None
+        assert connection_spy.call_count == 1
+
+        await test_ga.stop_polling()
+    finally:
+        con.execute(text("DELETE FROM linked"))
+        reset_database(con)
+
+@pytest.mark.asyncio
+async def test_add_user_email_invalidates_cache(mocker: MockerFixture, tmp_path):
+    try:
+        mocker.patch.object(googleauth, 'LINKED_FILE', str(tmp_path / 'linked.json'))
+        con = googleauth.get_connection()
+        test_ga = googleauth.GoogeAuthConnect()
+        test_ga.linked['123'] = {'token': 'abc'}
+        await test_ga.get_user_emails('123')
+
+        result = await test_ga.add_user_email('123', '1', 'a@example.com')
+        assert result[0] is True
+        assert '123' not in test_ga.email_cache
+        email, _ = await test_ga.get_user_email('123', '1')
+        assert email == 'a@example.com'
+        assert con.execute(text("SELECT email FROM linked WHERE member_id = '1'")).scalar() == 'a@example.com'
+
+        await test_ga.stop_polling()
+    finally:
+        con.execute(text("DELETE FROM linked"))
+        reset_database(con)
+
+@pytest.mark.asyncio
+async def test_user_emails_cache_expires(mocker: MockerFixture, tmp_path):
+    mocker.patch.object(googleauth, 'LINKED_FILE', str(tmp_path / 'linked.json'))
+    mocker.patch.object(googleauth, 'EMAIL_CACHE_TTL', 0)
+    test_ga = googleauth.GoogeAuthConnect()
+    test_ga.linked['123'] = {'token': 'abc'}
+    connection_spy = mocker.spy(googleauth, 'get_connection')
+    await test_ga.get_user_emails('123')
+    await test_ga.get_user_emails('123')
+    assert connection_spy.call_count == 2
+    await test_ga.stop_polling()
+
+@pytest.mark.asyncio
+async def test_complete_sign_in(mocker: MockerFixture, tmp_path):
+    mocker.patch.object(googleauth, 'LINKED_FILE', str(tmp_path / 'linked.json'))
+    test_ga = googleauth.GoogeAuthConnect(push_enabled=True)
+    mocker.patch.object(test_ga, 'get_credentials_batch', return_value={'123': ({'token': 'abc'}, 'xyz')})
+    test_ga.active_sign_ins = {'123': {'expire_time': time.time() + 300, 'state': 'xyz'}}
+
+    result = await test_ga.complete_sign_in('123')
+    assert result[0] is True
+    assert test_ga.linked['123'] == {'token': 'abc'}
+    assert len(test_ga.active_sign_ins) == 0
+
+    result = await test_ga.complete_sign_in('123')
+    assert result[0] is None
+    test_ga.polling_task.cancel()
+
+@pytest.mark.asyncio
+async def test_get_credentials_batch(mocker: MockerFixture, tmp_path):
+    try:
+        mocker.patch.object(googleauth, 'LINKED_FILE', str(tmp_path / 'linked.json'))
+        con = googleauth.get_connection()
+        test_ga = googleauth.GoogeAuthConnect()
+        for guild_id in ('1', '2', '3'):
+            con.execute(text("INSERT INTO guild VALUES(:id, :credential, :state)"),
+                        {'id': guild_id, 'credential': json.dumps({'token': guild_id}), 'state': f'state{guild_id}'})
+        con.execute(text("INSERT INTO guild VALUES('4', NULL, 'state4')"))
+        con.commit()
+
+        credentials = await test_ga.get_credentials_batch(['1', '3', '4', '5'])
+        assert credentials == {'1': ({'token': '1'}, 'state1'), '3': ({'token': '3'}, 'state3')}
+        assert await test_ga.get_credentials_batch([]) == {}
+
+        await test_ga.stop_polling()
+    finally:
+        reset_database(con)
+
+@pytest.mark.asyncio
+async def test_save_linked_only_on_change(mocker: MockerFixture, tmp_path):
+    linked_file = str(tmp_path / 'linked.json')
+    mocker.patch.object(googleauth, 'LINKED_FILE', linked_file)
+    write_spy = mocker.spy(googleauth, 'write_linked_file')
+    test_ga = googleauth.GoogeAuthConnect()
+    mocker.patch.object(test_ga, 'get_credentials_batch', return_value={'123': ({'token': 'abc'}, 'xyz')})
+
+    await test_ga.save_linked()
+    assert write_spy.call_count == 0
+
+    test_ga.active_sign_ins = {'123': {'expire_time': time.time() + 300, 'state': 'xyz'}}
+    await test_ga.poll_batch(dict(test_ga.active_sign_ins))
+    await test_ga.poll_batch({})
+    assert write_spy.call_count == 1
+    with open(linked_file) as f:
+        assert json.load(f) == {'123': {'token': 'abc'}}
+
+    reloaded = googleauth.GoogeAuthConnect()
+    assert reloaded.linked == {'123': {'token': 'abc'}}
+    test_ga.polling_task.cancel()
+    reloaded.polling_task.cancel()
+
+def test_sqlite_pragmas_applied():
+    con = googleauth.get_connection()
+    try:
+        assert con.execute(text('PRAGMA busy_timeout')).scalar() == 5000
+        assert con.execute(text('PRAGMA synchronous')).scalar() == 1
+    finally:
+        con.close()
+
+def test_async_database_url():
+    assert googleauth.async_database_url('sqlite:///database/guilds.db') == 'sqlite+aiosqlite:///database/guilds.db'
+    assert googleauth.async_database_url('sqlite+pysqlite:///guilds.db') == 'sqlite+pysqlite:///guilds.db'
+    with pytest.raises(ValueError):
+        googleauth.async_database_url('postgresql://user@host/db')
+
+@pytest.mark.asyncio
+async def test_async_database_access(mocker: MockerFixture, tmp_path):
+    from sqlalchemy import create_engine
+    from sqlalchemy.ext.asyncio import create_async_engine
+    database = tmp_path / 'guilds.db'
+    sync_engine = create_engine(f'sqlite:///{database}')
+    with sync_engine.connect() as con:
+        con.execute(text('CREATE TABLE guild (guild_id TEXT PRIMARY KEY, credential TEXT, state TEXT)'))
+        con.execute(text('CREATE TABLE linked (guild_id TEXT, member_id TEXT, email TEXT)'))
+        con.commit()
+    async_engine = create_async_engine(f'sqlite+aiosqlite:///{database}')
+    mocker.patch.object(googleauth, 'async_engine', async_engine)
+    mocker.patch.object(googleauth, 'LINKED_FILE', str(tmp_path / 'linked.json'))
+    connection_spy = mocker.spy(googleauth, 'get_connection')
+    test_ga = googleauth.GoogeAuthConnect(async_db=True)
+    test_ga.polling_task.cancel()
+    try:
+        await test_ga.get_auth_url('123')
+        with sync_engine.connect() as con:
+            state = con.execute(text("SELECT state FROM guild WHERE guild_id = '123'")).scalar()
+            con.execute(text("UPDATE guild SET credential = :credential"), {'credential': json.dumps({'token': 'abc'})})
+            con.commit()
+        assert state == test_ga.active_sign_ins['123']['state']
+        assert await test_ga.get_credentials('123') == ({'token': 'abc'}, state)
+        assert await test_ga.get_credentials_batch(['123', '456']) == {'123': ({'token': 'abc'}, state)}
+
+        test_ga.linked['123'] = {'token': 'abc'}
+        assert (await test_ga.add_user_email('123', member_id='1', email='a@example.com'))[0] is True
+        test_ga.email_cache.clear()
+        assert await test_ga.get_user_email('123', '1') == ('a@example.com', 'retrieved email of member 1')
+        assert connection_spy.call_count == 0
+    finally:
+        await async_engine.dispose()
+        sync_engine.dispose()
+
+@pytest.mark.asyncio
+async def test_update_credentials(mocker: MockerFixture, tmp_path):
+    mocker.patch.object(googleauth, 'LINKED_FILE', str(tmp_path / 'linked.json'))
+    con = googleauth.get_connection()
+    try:
+        test_ga = googleauth.GoogeAuthConnect()
+        listener = mocker.Mock()
+        test_ga.add_link_listener(listener)
+        original = {'token': 'abc', 'refresh_token': 'def'}
+        test_ga.linked['123'] = original
+        con.execute(text("INSERT INTO guild VALUES('123', :credential, 'xyz')"), {'credential': json.dumps(original)})
+        con.commit()
+
+        result = await test_ga.update_credentials('123', {'token': 'new', 'expiry': '2030-01-01T12:00:00Z'})
+        assert result[0] is True
+        assert test_ga.linked['123'] == {'token': 'new', 'refresh_token': 'def', 'expiry': '2030-01-01T12:00:00Z'}
+        assert original == {'token': 'abc', 'refresh_token': 'def'}
+        assert await test_ga.get_credentials('123') == (test_ga.linked['123'], 'xyz')
+        with open(googleauth.LINKED_FILE) as f:
+            assert json.load(f)['123']['token'] == 'new'
+        listener.assert_not_called()
+
+        assert (await test_ga.update_credentials('456', {'token': 'new'}))[0] is None
+        await test_ga.stop_polling()
+    finally:
+        reset_database(con)
+
+@pytest.mark.asyncio
+async def test_unlink(mocker: MockerFixture, tmp_path):
+    mocker.patch.object(googleauth, 'LINKED_FILE', str(tmp_path / 'linked.json'))
+    con = googleauth.get_connection()
+    try:
+        test_ga = googleauth.GoogeAuthConnect()
+        listener = mocker.Mock()
+        test_ga.add_link_listener(listener)
+        test_ga.linked['123'] = {'token': 'abc'}
+        con.execute(text("INSERT INTO guild VALUES('123', :credential, 'xyz')"), {'credential': json.dumps({'token': 'abc'})})
+        con.commit()
+
+        assert (await test_ga.unlink('123'))[0] is True
+        assert '123' not in test_ga.linked
+        assert await test_ga.get_credentials('123') == (None, None)
+        listener.assert_called_once_with('123')
+        assert (await test_ga.unlink('123'))[0] is None
+        await test_ga.stop_polling()
+    finally:
+        reset_database(con)
+
+@pytest.mark.asyncio
+async def test_shared_link_state(mocker: MockerFixture, tmp_path):
+    mocker.patch.object(googleauth, 'LINKED_FILE', str(tmp_path / 'linked.json'))
+    con = googleauth.get_connection()
+    owns = lambda guild_id: guild_id != '124'
+    instances = []
+    def start():
+        instance = googleauth.GoogeAuthConnect(push_enabled=True, shared_state=True, owns=owns)
+        instance.polling_task.cancel()
+        instances.append(instance)
+        return instance
+    try:
+        for guild_id in ('123', '124'):
+            con.execute(text("INSERT INTO guild VALUES(:id, :credential, 'xyz')"),
+                        {'id': guild_id, 'credential': json.dumps({'token': guild_id})})
+        con.commit()
+        first = start()
+        assert first.linked == {'123': {'token': '123'}}
+
+        await first.get_auth_url('200')
+        con.execute(text("UPDATE guild SET credential=:credential WHERE guild_id='200'"),
+                    {'credential': json.dumps({'token': '200'})})
+        con.commit()
+
+        # a restarted or second process picks up the sign in from the database
+        second = start()
+        assert '200' not in second.linked
+        assert (await second.complete_sign_in('200'))[0] is True
+        assert second.linked['200'] == {'token': '200'}
+        assert (await first.complete_sign_in('200'))[0] is None
+        assert '200' not in first.linked
+
+        assert start().linked == {'123': {'token': '123'}, '200': {'token': '200'}}
+        assert (await second.complete_sign_in('124'))[1] == 'guild 124 is served by another process'
+        assert not (tmp_path / 'linked.json').exists()
+    finally:
+        con.execute(text("DELETE FROM sign_in"))
+        reset_database(con)
+
+def test_channel_token_signed_per_guild():
+    token = push_channels.channel_token('123', 'key')
+    assert token.startswith('123.')
+    assert token != push_channels.channel_token('123', 'other key')
+    assert token != push_channels.channel_token('124', 'key')
@@ -0,0 +1,449 @@
+from bisect import bisect_left
+from collections import deque
+import functools
+import glob
+import json
+import logging
+import os
+import random
+import secrets
+import threading
+import time
+
+from sqlalchemy import Engine, event
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SLOW_QUERY_LOG_SIZE = 100
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+logger = logging.getLogger('metrics')
+
+
+class Histogram:
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        """ initializes a histogram with fixed upper bounds
+
+        Args:
+            buckets (tuple[float, ...]): the sorted upper bounds of the buckets, values above the last
+                bound are counted in an overflow bucket
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """estimates a quantile as the upper bound of the bucket it falls in
+
+        Args:
+            q (float): the quantile between 0 and 1
+
+        Returns:
+            float: the estimated quantile, the largest observed value if it falls in the overflow bucket
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra: str = '') -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (), collect=None):
+        """ initializes a metric holding a number per combination of label values
+
+        Args:
+            name (str): the prometheus name of the metric
+            documentation (str): the help text of the metric
+            labels (tuple[str, ...]): the names of the labels
+            collect (Callable[[], float | dict[tuple, float]] | None): reads the values when the metric is scraped
+                instead of them being counted on the hot path, returns a dict of label values to values if the
+                metric has labels
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.collect = collect
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def current(self) -> dict[tuple, float]:
+        if self.collect is None:
+            with self.lock:
+                return dict(self.values)
+        values = self.collect()
+        return values if isinstance(values, dict) else {(): values}
+
+    def snapshot(self) -> list:
+        return [[list(labels), value] for labels, value in self.current().items()]
+
+    def render(self, values: dict[tuple, float]) -> list[str]:
+        return [f'{self.name}{format_labels(self.labels, labels)} {format_value(value)}'
+                for labels, value in values.items()]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value: float, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+
+class LabeledHistogram:
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS, collect=None):
+        """ initializes a histogram per combination of label values
+
+        Args:
+            name (str): the prometheus name of the metric
+            documentation (str): the help text of the metric
+            labels (tuple[str, ...]): the names of the labels
+            buckets (tuple[float, ...]): the upper bounds of the buckets
+            collect (Callable[[], Histogram | dict[tuple, Histogram]] | None): reads histograms kept elsewhere
+                when the metric is scraped
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.collect = collect
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        with self.lock:
+            histogram = self.histograms.get(labels)
+            if histogram is None:
+                histogram = self.histograms[labels] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def time(self, *labels):
+        """decorates a coroutine function to observe how long every call takes
+        """
+        def decorate(function):
+            @functools.wraps(function)
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, *labels)
+            return timed
+        return decorate
+
+    def current(self) -> dict[tuple, Histogram]:
+        if self.collect is None:
+            with self.lock:
+                return dict(self.histograms)
+        histograms = self.collect()
+        return histograms if isinstance(histograms, dict) else {(): histograms}
+
+    def snapshot(self) -> list:
+        return [[list(labels), {'buckets': list(histogram.buckets), 'counts': list(histogram.counts),
+                                'sum': histogram.sum, 'count': histogram.count}]
+                for labels, histogram in self.current().items()]
+
+    def render(self, values: dict[tuple, dict]) -> list[str]:
+        lines = []
+        for labels, histogram in values.items():
+            seen = 0
+            for bound, count in zip(histogram['buckets'] + [float('inf')], histogram['counts']):
+                seen += count
+                le = 'le="' + format_value(float(bound)) + '"'
+                lines.append(f'{self.name}_bucket{format_labels(self.labels, labels, le)} {seen}')
+            label_text = format_labels(self.labels, labels)
+            lines.append(f'{self.name}_sum{label_text} {format_value(float(histogram["sum"]))}')
+            lines.append(f'{self.name}_count{label_text} {histogram["count"]}')
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        """ initializes an empty set of metrics that renders in the prometheus text format
+        """
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f'metric {metric.name} is already registered')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: tuple[str, ...] = (), collect=None) -> Counter:
+        return self.register(Counter(name, documentation, labels, collect))
+
+    def gauge(self, name: str, documentation: str, labels: tuple[str, ...] = (), collect=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labels, collect))
+
+    def histogram(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS, collect=None) -> LabeledHistogram:
+        return self.register(LabeledHistogram(name, documentation, labels, buckets, collect))
+
+    def snapshot(self) -> dict:
+        """Returns:
+            dict: the json serializable values of every metric, other processes merge it into their output
+        """
+        snapshot = {}
+        for name, metric in self.metrics.items():
+            try:
+                snapshot[name] = metric.snapshot()
+            except Exception:
+                logger.exception(f'collecting metric {name} failed')
+        return snapshot
+
+    def render(self, others: list[dict] = ()) -> str:
+        """renders the metrics in the prometheus text format
+
+        Args:
+            others (list[dict]): snapshots of the same registry in other processes, their counters and
+                histograms are added to the ones of this process, gauges only come from this process
+
+        Returns:
+            str: the metrics page
+        """
+        lines = []
+        for name, samples in self.snapshot().items():
+            metric = self.metrics[name]
+            values = {tuple(labels): value for labels, value in samples}
+            if metric.type != 'gauge':
+                for other in others:
+                    for labels, value in other.get(name, ()):
+                        values[tuple(labels)] = merge_samples(values.get(tuple(labels)), value)
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.type}')
+            lines.extend(metric.render(values))
+        return '\n'.join(lines) + '\n'
+
+
+class ProcessSnapshots:
+
+    def __init__(self, registry: Registry, directory: str, interval: float = 1.0):
+        """ initializes the sharing of a registry between processes that serve the same metrics, like the
+        workers of gunicorn. every process writes a snapshot of its metrics to the directory at most every
+        `interval` seconds and the process that is scraped adds the snapshots of the others. snapshots of
+        exited processes are kept so counters never go down, clear the directory when the server starts
+
+        Args:
+            registry (Registry): the registry of this process
+            directory (str): the directory the processes share
+            interval (float): the shortest time between two writes of a process
+        """
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self.written = 0.0
+        self.names = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def path(self) -> str:
+        # the name is picked in the process that writes, a forked worker gets its own file
+        pid = os.getpid()
+        name = self.names.get(pid)
+        if name is None:
+            name = self.names.setdefault(pid, f'{pid}-{secrets.token_hex(4)}.json')
+        return os.path.join(self.directory, name)
+
+    def write(self):
+        path = self.path
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.registry.snapshot(), f)
+        os.replace(f'{path}.tmp', path)
+
+    def maybe_write(self):
+        """writes the snapshot of this process if the last write is older than the interval, meant to run
+        after requests so an idle process does no work
+        """
+        now = time.monotonic()
+        if now - self.written < self.interval or not self.lock.acquire(blocking=False):
+            return
+        try:
+            self.written = now
+            self.write()
+        except OSError:
+            logger.exception('writing the metrics snapshot failed')
+        finally:
+            self.lock.release()
+
+    def others(self) -> list[dict]:
+        """Returns:
+            list[dict]: the snapshots of the other processes
+        """
+        own = self.path
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            if path == own:
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+
+def merge_samples(current, other):
+    if current is None:
+        return other
+    if isinstance(current, dict):
+        return {'buckets': current['buckets'], 'counts': [a + b for a, b in zip(current['counts'], other['counts'])],
+                'sum': current['sum'] + other['sum'], 'count': current['count'] + other['count']}
+    return current + other
+
+
+def statement_kind(statement: str) -> str:
+    """Returns:
+        str: the first keyword of a statement in lower case, like select or insert
+    """
+    words = statement.lstrip()[:16].split(None, 1)
+    return words[0].lower() if words else ''
+
+def time_statements(engine: Engine, histogram: LabeledHistogram):
+    """observes the time of every statement of an engine in a histogram labeled with the kind of statement,
+    a cheaper always-on counterpart of QueryProfiler
+
+    Args:
+        engine (Engine): the engine to time
+        histogram (LabeledHistogram): a histogram with a single label for the first keyword of the statement
+    """
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('statement_start_times', []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['statement_start_times'].pop()
+        histogram.observe(elapsed, statement_kind(statement))
+
+    def handle_error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get('statement_start_times'):
+            conn.info['statement_start_times'].pop()
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(engine, 'handle_error', handle_error)
+
+
+class QueryProfiler:
+
+    def __init__(self, sample_rate: float = 1.0, slow_query_threshold: float = 0.5):
+        """ initializes a profiler that times the statements of sqlalchemy engines through engine events
+
+        Args:
+            sample_rate (float): the fraction of statements to time, between 0 and 1
+            slow_query_threshold (float): statements taking longer than this many seconds are logged
+        """
+        self.sample_rate = sample_rate
+        self.slow_query_threshold = slow_query_threshold
+        self.statements = {}
+        self.slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+        self.lock = threading.Lock()
+        self.info_key = f'query_start_time_{id(self)}'
+
+    def attach(self, engine: Engine):
+        """starts timing the statements of an engine
+
+        Args:
+            engine (Engine): the engine to instrument
+        """
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+        event.listen(engine, 'handle_error', self.handle_error)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        sampled = self.sample_rate >= 1.0 or random.random() < self.sample_rate
+        conn.info.setdefault(self.info_key, []).append(time.perf_counter() if sampled else None)
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = conn.info[self.info_key].pop()
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        key = ' '.join(statement.split())
+        with self.lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = {'latency': Histogram(), 'rows': None}
+            stats['latency'].observe(elapsed)
+            # a statement returning rows has no affected row count, sqlite reports -1 for a SELECT
+            if cursor.description is None and cursor.rowcount >= 0:
+                stats['rows'] = (stats['rows'] or 0) + cursor.rowcount
+        if elapsed >= self.slow_query_threshold:
+            self.slow_queries.append({'statement': key, 'seconds': elapsed, 'at': time.time()})
+            logger.warning(f'slow query took {elapsed:.3f}s: {key}')
+
+    def handle_error(self, exception_context):
+        # a failed statement never reaches after_cursor_execute
+        conn = exception_context.connection
+        if conn is not None and conn.info.get(self.info_key):
+            conn.info[self.info_key].pop()
+
+    def profile(self) -> dict:
+        """Returns:
+            dict: the latency histogram and affected row count of every sampled statement, ordered by total time,
+            and the most recent slow queries, the row count is None for statements that return rows
+        """
+        with self.lock:
+            statements = [
+                dict(statement=key, rows=stats['rows'], **stats['latency'].as_dict())
+                for key, stats in self.statements.items()
+            ]
+        statements.sort(key=lambda stats: stats['sum'], reverse=True)
+        return {
+            'sample_rate': self.sample_rate,
+            'statements': statements,
+            'slow_queries': list(self.slow_queries),
+        }
+
+    def reset(self):
+        with self.lock:
+            self.statements.clear()
+            self.slow_queries.clear()
@@ -0,0 +1,113 @@
+from sqlalchemy import create_engine, text
+import pytest
+import metrics
+
+def test_histogram_quantiles():
+    histogram = metrics.Histogram(buckets=(0.01, 0.1, 1.0))
+    for value in [0.005] * 90 + [0.05] * 9 + [0.5]:
+        histogram.observe(value)
+    assert histogram.count == 100
+    assert histogram.quantile(0.5) == 0.01
+    assert histogram.quantile(0.95) == 0.1
+    assert histogram.quantile(1.0) == 0.5
+    assert histogram.max == 0.5
+
+def test_histogram_overflow_bucket():
+    histogram = metrics.Histogram(buckets=(0.01,))
+    histogram.observe(3.0)
+    assert histogram.counts == [0, 1]
+    assert histogram.quantile(0.99) == 3.0
+
+def test_profiler_times_statements():
+    engine = create_engine('sqlite:///:memory:')
+    profiler = metrics.QueryProfiler()
+    profiler.attach(engine)
+    with engine.connect() as con:
+        con.execute(text('CREATE TABLE guild (guild_id TEXT)'))
+        con.execute(text("INSERT INTO guild VALUES ('1'), ('2')"))
+        for _ in range(3):
+            con.execute(text('SELECT * FROM   guild')).fetchall()
+
+    profile = profiler.profile()
+    statements = {stats['statement']: stats for stats in profile['statements']}
+    assert statements['SELECT * FROM guild']['count'] == 3
+    assert statements['SELECT * FROM guild']['rows'] is None
+    assert statements["INSERT INTO guild VALUES ('1'), ('2')"]['rows'] == 2
+    assert profile['slow_queries'] == []
+
+def test_profiler_samples_and_logs_slow_queries():
+    engine = create_engine('sqlite:///:memory:')
+    unsampled = metrics.QueryProfiler(sample_rate=0.0)
+    unsampled.attach(engine)
+    slow = metrics.QueryProfiler(slow_query_threshold=0.0)
+    slow.attach(engine)
+    with engine.connect() as con:
+        con.execute(text('SELECT 1'))
+    assert unsampled.profile()['statements'] == []
+    assert slow.profile()['slow_queries'][0]['statement'] == 'SELECT 1'
+
+def test_registry_renders_prometheus_text():
+    registry = metrics.Registry()
+    calls = registry.counter('google_calls_total', 'google calls', labels=('method', 'status'))
+    calls.inc('calendar.events.insert', 200)
+    calls.inc('calendar.events.insert', 200)
+    registry.gauge('sign_ins', 'active sign ins', collect=lambda: 3)
+    latency = registry.histogram('handler_seconds', 'handler latency', labels=('event',), buckets=(0.1, 1.0))
+    latency.observe(0.05, 'create')
+    latency.observe(2.0, 'create')
+    page = registry.render()
+    assert '# TYPE google_calls_total counter' in page
+    assert 'google_calls_total{method="calendar.events.insert",status="200"} 2' in page
+    assert 'sign_ins 3' in page
+    assert 'handler_seconds_bucket{event="create",le="0.1"} 1' in page
+    assert 'handler_seconds_bucket{event="create",le="1.0"} 1' in page
+    assert 'handler_seconds_bucket{event="create",le="+Inf"} 2' in page
+    assert 'handler_seconds_count{event="create"} 2' in page
+    assert 'handler_seconds_sum{event="create"} 2.05' in page
+
+def test_registry_merges_other_processes():
+    registry = metrics.Registry()
+    requests = registry.counter('requests_total', 'requests', labels=('route',))
+    registry.gauge('workers', 'workers', collect=lambda: 1)
+    registry.histogram('seconds', 'latency', buckets=(1.0,)).observe(0.5)
+    requests.inc('/')
+    other = registry.snapshot()
+    requests.inc('/revoke')
+    page = registry.render([other])
+    assert 'requests_total{route="/"} 2' in page
+    assert 'requests_total{route="/revoke"} 1' in page
+    assert 'workers 1' in page
+    assert 'seconds_count 2' in page
+
+@pytest.mark.asyncio
+async def test_histogram_times_coroutines():
+    latency = metrics.LabeledHistogram('seconds', 'latency', labels=('kind',))
+
+    @latency.time('create')
+    async def handler(value):
+        return value
+    assert await handler(1) == 1
+    assert latency.current()[('create',)].count == 1
+    assert handler.__name__ == 'handler'
+
+def test_statement_timer():
+    engine = create_engine('sqlite:///:memory:')
+    histogram = metrics.LabeledHistogram('db_seconds', 'db time', labels=('statement',))
+    metrics.time_statements(engine, histogram)
+    with engine.connect() as con:
+        con.execute(text('SELECT 1'))
+        con.execute(text('  select 2'))
+    assert histogram.current()[('select',)].count == 2
+
+def test_process_snapshots_shared_through_directory(tmp_path):
+    registry = metrics.Registry()
+    requests = registry.counter('requests_total', 'requests')
+    snapshots = metrics.ProcessSnapshots(registry, str(tmp_path), interval=60)
+    requests.inc()
+    snapshots.maybe_write()
+    requests.inc()
+    snapshots.maybe_write()
+    # another worker wrote its snapshot as well
+    (tmp_path / '1-abcd.json').write_text('{"requests_total": [[[], 5]]}')
+    assert len(list(tmp_path.glob('*.json'))) == 2
+    assert 'requests_total 7' in registry.render(snapshots.others())